@@ -44,40 +44,55 @@ import ntpath
 import datetime
 import netCDF4
 import gc
+import hashlib
+import json
+import time
+import threading
+import queue
+import itertools
+import multiprocessing
+import tarfile
+import importlib
+import warnings
+import io
 
 from psutil import virtual_memory
+from concurrent.futures import ProcessPoolExecutor
 
-from dask.distributed import Client
+from dask.distributed import Client, as_completed, get_client
 from annotationtools import readers
 
 from rechunker.api import rechunk
 
 import pyarrow as pa
 import pyarrow.parquet as pq
+import pyarrow.dataset as pds
 
 from matplotlib import pyplot as plt, colors
+import matplotlib.dates as mdates
+from matplotlib.path import Path
 from matplotlib.colors import LinearSegmentedColormap, Colormap
 import math
 from numcodecs import Blosc
 
-def append_to_parquet(df, pq_filepath, pq_obj=None):
-    # Must set the schema to avoid mismatched schema errors
-    fields = [
-        pa.field('ping_time', pa.timestamp('ns')),
-        pa.field('mask_depth_upper', pa.float64()),
-        pa.field('mask_depth_lower', pa.float64()),
-        pa.field('priority', pa.int64()),
-        pa.field('acoustic_category', pa.string()),
-        pa.field('proportion', pa.float64()),
-        pa.field('object_id', pa.string()),
-        pa.field('channel_id', pa.string())
-    ]
-    df_schema = pa.schema(fields)
-    pa_tbl = pa.Table.from_pandas(df, schema=df_schema, preserve_index=False)
-    if pq_obj == None:
-        pq_obj = pq.ParquetWriter(pq_filepath, pa_tbl.schema)
-    pq_obj.write_table(table=pa_tbl)
-    return pq_obj
+import EK80Splitter
+
+# Must set the schema to avoid mismatched schema errors
+annotation_schema = pa.schema([
+    pa.field('ping_time', pa.timestamp('ns')),
+    pa.field('mask_depth_upper', pa.float64()),
+    pa.field('mask_depth_lower', pa.float64()),
+    pa.field('priority', pa.int64()),
+    pa.field('acoustic_category', pa.string()),
+    pa.field('proportion', pa.float64()),
+    pa.field('object_id', pa.string()),
+    pa.field('channel_id', pa.string()),
+    pa.field('work_file', pa.string())
+])
+annotation_row_group_size = 100000
+
+# Annotation masks rasterized onto the sv grid of the zarr output
+annotation_arrays = ["annotation", "annotation_proportion"]
 
 # From https://github.com/pydata/xarray/issues/1672#issuecomment-685222909
 def _expand_variable(nc_variable, data, expanding_dim, nc_shape, added_size):
@@ -129,7 +144,7 @@ def append_to_netcdf(filename, ds_to_append, unlimited_dims):
 
 # Detect FileType
 def ek_detect(fname):
-    with open(fname, 'rb') as f:
+    with EK80Splitter.open_raw(fname) as f:
         file_header = f.read(8)
         file_magic = file_header[-4:]
         if file_magic.startswith(b'XML'):
@@ -139,19 +154,94 @@ def ek_detect(fname):
         else:
             return None
 
-def ek_read(fname):
+# raw_view selects a virtual split of an EK80 file ('CW', 'FM' or a channel ID),
+# assembled in memory by EK80Splitter instead of writing split files to disk.
+# The datagram index sidecars are kept in raw_index_dir (default: next to the file).
+# Compressed files (.raw.gz/.raw.bz2/.raw.zst) are decompressed into memory.
+def ek_read(fname, raw_view = None, raw_index_dir = None):
     ftype = ek_detect(fname)
     if ftype == "EK80":
         ek80_obj = EK80.EK80()
-        ek80_obj.read_raw(fname)
+        if raw_view is None and not EK80Splitter.is_compressed(fname):
+            ek80_obj.read_raw(fname)
+        else:
+            with EK80Splitter.raw_view(fname, raw_view, raw_index_dir) as view_fname:
+                ek80_obj.read_raw(view_fname)
         return ek80_obj
     elif ftype == "EK60":
+        if raw_view is not None:
+            print("Raw views are only supported for EK80 files, reading all of " + str(fname))
         ek60_obj = EK60.EK60()
-        ek60_obj.read_raw(fname)
+        if not EK80Splitter.is_compressed(fname):
+            ek60_obj.read_raw(fname)
+        else:
+            with EK80Splitter.raw_view(fname, None) as view_fname:
+                ek60_obj.read_raw(view_fname)
         return ek60_obj
 
 # Simple plot function
-def plot_all(ds, out_name, range_res = 600, time_res = 800, interpolate = False):
+def render_chunk(sv, ping_start, n_ping, n_range, width, height, reduce = "mean"):
+    # Reduce a block of pings (frequency, ping_time, range, in dB) into the pixel
+    # columns it covers. Returns the first column, the per-pixel linear sum (or max)
+    # and sample count of each frequency, and the min and max sv of the block
+    columns = (np.arange(ping_start, ping_start + sv.shape[1]) * width) // n_ping
+    rows = (np.arange(sv.shape[2]) * height) // n_range
+    c0 = columns[0]
+    n_cols = columns[-1] - c0 + 1
+    pixel = rows[None, :] * n_cols + (columns - c0)[:, None]
+    value = np.zeros((sv.shape[0], height * n_cols))
+    count = np.zeros((sv.shape[0], height * n_cols))
+    for i in range(sv.shape[0]):
+        valid = ~np.isnan(sv[i])
+        linear = np.power(10, sv[i][valid] / 10.0)
+        if reduce == "max":
+            np.maximum.at(value[i], pixel[valid], linear)
+        else:
+            value[i] = np.bincount(pixel[valid], linear, minlength = height * n_cols)
+        count[i] = np.bincount(pixel[valid], minlength = height * n_cols)
+    with np.errstate(all = 'ignore'):
+        vmin = np.nanmin(sv) if sv.size > 0 else np.nan
+        vmax = np.nanmax(sv) if sv.size > 0 else np.nan
+    return c0, value.reshape(sv.shape[0], height, n_cols), count.reshape(sv.shape[0], height, n_cols), vmin, vmax
+
+def render_echogram(ds, width = 800, height = 600, reduce = "mean"):
+    """
+    Render sv into a (frequency, height, width) raster in dB, each pixel the mean
+    (or max) in the linear domain of the samples it covers. The ping chunks are
+    reduced in parallel straight into their pixel columns, collecting the min and
+    max sv in the same pass, so memory stays bounded by the chunk size.
+    Returns the raster, vmin and vmax.
+    """
+    sv = ds.sv.transpose("frequency", "ping_time", "range")
+    if sv.chunks is None:
+        sv = sv.chunk({"frequency": -1, "ping_time": "auto", "range": -1})
+    n_freq, n_ping, n_range = sv.shape
+    width = min(width, n_ping)
+    height = min(height, n_range)
+    tasks = []
+    p0 = 0
+    for size in sv.chunks[1]:
+        tasks.append(dask.delayed(render_chunk)(sv.data[:, p0:p0 + size, :], p0, n_ping, n_range, width, height, reduce))
+        p0 = p0 + size
+    value = np.zeros((n_freq, height, width))
+    count = np.zeros((n_freq, height, width))
+    vmin = np.inf
+    vmax = -np.inf
+    for _, (c0, chunk_value, chunk_count, chunk_min, chunk_max) in compute_as_completed(tasks):
+        columns = slice(c0, c0 + chunk_value.shape[2])
+        if reduce == "max":
+            value[:, :, columns] = np.maximum(value[:, :, columns], chunk_value)
+        else:
+            value[:, :, columns] += chunk_value
+        count[:, :, columns] += chunk_count
+        vmin = np.nanmin([vmin, chunk_min])
+        vmax = np.nanmax([vmax, chunk_max])
+    with np.errstate(all = 'ignore'):
+        raster = 10 * np.log10(value if reduce == "max" else value / count)
+    raster[count == 0] = np.nan
+    return raster, vmin, vmax
+
+def plot_all(ds, out_name, range_res = 600, time_res = 800, reduce = "mean"):
     # Prepare simrad cmap
     simrad_color_table = [(1, 1, 1),
                                         (0.6235, 0.6235, 0.6235),
@@ -170,50 +260,33 @@ def plot_all(ds, out_name, range_res = 600, time_res = 800, interpolate = False)
                                 ('Simrad', simrad_color_table))
     simrad_cmap.set_bad(color='grey')
 
-    sv = ds.sv
-
-    range_len = len(ds.sv.range)
-    time_len = len(ds.sv.ping_time)
-
-    if range_len > range_res or time_len > time_res:
-        mult_range = math.floor(range_len/range_res)
-        mult_time = math.floor(time_len/time_res)
-
-        if mult_range == 0:
-            mult_range = 1
-
-        if mult_time == 0:
-            mult_time = 1
-
-        if interpolate == False:
-            sv = ds.sv[:, ::mult_time,::mult_range]
-        else:
-            sv = ds.sv.coarsen(range = mult_range, ping_time = mult_time, boundary="trim").mean(skipna=True)
-
-    vmin = sv.min(skipna=True).compute()
-    vmax = sv.max(skipna=True).compute()
+    raster, vmin, vmax = render_echogram(ds, width = time_res, height = range_res, reduce = reduce)
 
     # Handle duplicate frequencies
-    if len(sv.frequency.data) == len(np.unique(sv.frequency.data)):
-        sv.plot(x="ping_time", y="range", row= "frequency", vmin = vmin, vmax = vmax, norm=colors.LogNorm(), cmap=simrad_cmap)
-    else:
-        frstr = ["%.2f" % i for i in sv.frequency.data]
-        new_coords = []
-        for frname in frstr:
-            orig = frname
-            i = 1
-            while frname in new_coords:
-                frname = orig + " #" + str(i)
-                i += 1
-            new_coords.append(frname)
-        sv.coords["frequency"] = new_coords
-        sv.plot(x="ping_time", y="range", row= "frequency", vmin = vmin, vmax = vmax, norm=colors.LogNorm(), cmap=simrad_cmap)
-
-    plt.gca().invert_yaxis()
-    plt.gcf().set_size_inches(8,11)
+    frstr = ["%.2f" % i for i in ds.frequency.data]
+    titles = []
+    for frname in frstr:
+        orig = frname
+        i = 1
+        while frname in titles:
+            frname = orig + " #" + str(i)
+            i += 1
+        titles.append(frname)
+
+    ping_time = ds.ping_time.values
+    extent = [mdates.date2num(ping_time[0]), mdates.date2num(ping_time[-1]), float(ds.range[-1]), float(ds.range[0])]
+    fig, axes = plt.subplots(len(titles), 1, squeeze = False, sharex = True, figsize = (8, 11))
+    for i, ax in enumerate(axes[:, 0]):
+        im = ax.imshow(raster[i], aspect = "auto", extent = extent, vmin = vmin, vmax = vmax, cmap = simrad_cmap, interpolation = "nearest")
+        ax.set_title("frequency = " + titles[i])
+        ax.set_ylabel("range")
+        fig.colorbar(im, ax = ax, label = "sv")
+    axes[-1, 0].xaxis_date()
+    axes[-1, 0].set_xlabel("ping_time")
     plt.savefig(out_name + "." + 'png', bbox_inches = 'tight', pad_inches = 0)
+    plt.close(fig)
 
-def process_data_to_xr(raw_data, raw_obj=None, get_positions=False):
+def process_data(raw_data, raw_obj=None, get_positions=False):
     # Get calibration object
     cal_obj = raw_data.get_calibration()
     sv_obj = None
@@ -230,24 +303,6 @@ def process_data_to_xr(raw_data, raw_obj=None, get_positions=False):
     #sv_obj_as_depth = raw_data.get_sv(calibration = cal_obj,
     #    return_depth=True)
 
-    # Get frequency label
-    freq = sv_obj.frequency
-
-    # Expand sv values into a 3d object
-    data3d = np.expand_dims(sv_obj.data, axis=0)
-
-    # This is the sv data in 3d    
-    sv = xr.DataArray(name="sv", data=data3d, dims=['frequency', 'ping_time', 'range'],
-                           coords={ 'frequency': [freq],
-                                    'ping_time': sv_obj.ping_time,
-                                    'range': sv_obj.range,
-                                   })
-    # This is the depth data
-    trdraft = xr.DataArray(name="transducer_draft", data=np.expand_dims(sv_obj.transducer_offset, axis=0), dims=['frequency', 'ping_time'],
-                           coords={ 'frequency': [freq],
-                                    'ping_time': sv_obj.ping_time,
-                                   })
-
     # Additional data
     pulse_length = None
     angle_alongship = None
@@ -260,7 +315,7 @@ def process_data_to_xr(raw_data, raw_obj=None, get_positions=False):
     else:
         pulse_length = 0
 
-    # Calculate angles
+    # Calculate angles (None leaves them as NaN in the output)
     # TODO: Get angles for FM raw data (and OneOcean's intermittent CW data) will trigger errors
     try:
         ang1, ang2 = raw_data.get_physical_angles(calibration = cal_obj)
@@ -268,20 +323,87 @@ def process_data_to_xr(raw_data, raw_obj=None, get_positions=False):
         e = sys.exc_info()[0]
         print(e)
         print("Setting NaN for angles for this channel")
-        angle_alongship = np.full(sv.shape, np.nan)
-        angle_athwartship = np.full(sv.shape, np.nan)
     else:
-        angle_alongship = sv.copy(data = np.expand_dims(ang1.data, axis=0))
-        angle_athwartship = sv.copy(data = np.expand_dims(ang2.data, axis=0))
+        angle_alongship = ang1.data
+        angle_athwartship = ang2.data
 
     if get_positions:
         position = raw_obj.nmea_data.interpolate(sv_obj, 'position')
         speed = raw_obj.nmea_data.interpolate(sv_obj, 'speed')
         distance = raw_obj.nmea_data.interpolate(sv_obj, 'distance')
         positions = {"position": position, "speed": speed, "distance": distance}
-        return [sv, trdraft, pulse_length, angle_alongship, angle_athwartship, positions]
+        return [sv_obj, pulse_length, angle_alongship, angle_athwartship, positions]
     else:
-        return [sv, trdraft, pulse_length, angle_alongship, angle_athwartship]
+        return [sv_obj, pulse_length, angle_alongship, angle_athwartship]
+
+def _binEdges(r):
+    """
+    Bin edges around the bin centres r (half way between the centres, and half
+    a bin outside the first and the last centre)
+    """
+    edges = np.append(r[0]-(r[1] - r[0])/2, (r[0:-1] + r[1:])/2)
+    return np.append(edges, r[-1]+(r[-1] - r[-2])/2)
+
+def _resampleCumulative(values, bin_s, bin_t, shift = None):
+    """
+    Resample values (ping, bin) from the source bins (edges bin_s) onto the target
+    bins (edges bin_t). Each target bin is the overlap weighted mean of the source
+    bins, the same linear combination as _resampleWeight, taken as differences of
+    the cumulative sum of the source so that all the pings are done at once.
+    shift (one value per ping) moves the source bins. Target bins not inside the
+    source, or overlapping a NaN, are NaN.
+    """
+    n_ping, n_s = values.shape
+    nan = np.isnan(values)
+    rows = np.arange(n_ping)[:, None]
+    cum = np.zeros((n_ping, n_s + 1))
+    cum[:, 1:] = np.cumsum(np.where(nan, 0, values) * np.diff(bin_s), axis = 1)
+    cum_nan = np.zeros((n_ping, n_s + 1), dtype = int)
+    cum_nan[:, 1:] = np.cumsum(nan, axis = 1)
+
+    # Target edges as fractional source bin positions
+    x = np.broadcast_to(bin_t[None, :] - (0 if shift is None else shift[:, None]), (n_ping, len(bin_t)))
+    pos = np.interp(x, bin_s, np.arange(n_s + 1))
+    j = np.clip(np.floor(pos).astype(int), 0, n_s - 1)
+    c = cum[rows, j] + (pos - j) * (cum[rows, j + 1] - cum[rows, j])
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        out = (c[:, 1:] - c[:, :-1]) / np.diff(bin_t)
+    n_nan = cum_nan[rows, np.ceil(pos[:, 1:]).astype(int)] - cum_nan[rows, np.floor(pos[:, :-1]).astype(int)]
+    tolerance = 1e-9 * (bin_s[-1] - bin_s[0])
+    outside = (x[:, :-1] < bin_s[0] - tolerance) | (x[:, 1:] > bin_s[-1] + tolerance)
+    out[(n_nan > 0) | outside] = np.nan
+    return out
+
+def depth_axis(range_values, transducer_draft, heave):
+    """
+    Depth axis of depth_grid_sv: the bins of the range axis, continued down by the
+    largest transducer draft + heave of the pings, so that the deepest samples
+    are kept.
+    """
+    range_values = np.asarray(range_values)
+    step = range_values[-1] - range_values[-2]
+    shift = np.nan_to_num(transducer_draft) + np.nan_to_num(heave)[None, :]
+    n_extra = int(np.ceil(max(0.0, np.max(shift, initial = 0.0)) / step - 1e-6))
+    return np.concatenate([range_values, range_values[-1] + step * np.arange(1, n_extra + 1)])
+
+def depth_grid_sv(sv, range_values, transducer_draft, heave, depth_values = None):
+    """
+    Shift sv (frequency, ping_time, range, in dB) to depth (range + transducer
+    draft + heave, on depth_values, by default depth_axis), resampled in the
+    linear domain in one vectorized pass per channel. Depth bins above the
+    transducer or deeper than the shifted range are NaN.
+    """
+    if depth_values is None:
+        depth_values = depth_axis(range_values, transducer_draft, heave)
+    edges = _binEdges(range_values)
+    depth_edges = _binEdges(np.asarray(depth_values))
+    out = np.empty(sv.shape[:2] + (len(depth_values),), dtype = sv.dtype)
+    heave = np.nan_to_num(heave)
+    for i in range(sv.shape[0]):
+        shift = np.nan_to_num(transducer_draft[i]) + heave
+        with np.errstate(divide = 'ignore'):
+            out[i] = 10 * np.log10(_resampleCumulative(np.power(10, sv[i] / 10.0), edges, depth_edges, shift))
+    return out
 
 def _resampleWeight(r_t, r_s):
     """
@@ -291,12 +413,10 @@ def _resampleWeight(r_t, r_s):
     """
 
     # Create target bins from target range
-    bin_r_t = np.append(r_t[0]-(r_t[1] - r_t[0])/2, (r_t[0:-1] + r_t[1:])/2)
-    bin_r_t = np.append(bin_r_t, r_t[-1]+(r_t[-1] - r_t[-2])/2)
+    bin_r_t = _binEdges(r_t)
 
     # Create source bins from source range
-    bin_r_s = np.append(r_s[0]-(r_s[1] - r_s[0])/2, (r_s[0:-1] + r_s[1:])/2)
-    bin_r_s = np.append(bin_r_s, r_s[-1]+(r_s[-1] - r_s[-2])/2)
+    bin_r_s = _binEdges(r_s)
 
     # Initialize W matrix (sparse)
     W = np.zeros([len(r_t), len(r_s)+1])
@@ -375,33 +495,21 @@ def _regrid(sv_s, W, n_pings):
     # Do the dot product
     return np.dot(W, sv_s_mod)
 
-def regrid_sv(sv, reference_range):
-    print("Channel with frequency " + str(sv.frequency.values[0]) + " range mismatch! Reference range size: " + str(reference_range.size) + " != " + str(sv.range.size))
+def regrid_sv(sv_obj, reference_range):
+    print("Channel with frequency " + str(sv_obj.frequency) + " range mismatch! Reference range size: " + str(reference_range.size) + " != " + str(sv_obj.range.size))
     # Re-grid this channel sv
-    sv_obj = sv[0,]
-    W = _resampleWeight(reference_range.values, sv_obj.range)
-    sv_tmp = _regrid(sv_obj.data.transpose(), W, sv_obj.ping_time.size).transpose()
-    # Create new xarray with the same frequency
-    sv = xr.DataArray(name="sv", data=np.expand_dims(sv_tmp, axis = 0), dims=['frequency', 'ping_time', 'range'],
-                    coords={ 'frequency': sv.frequency,
-                            'ping_time': sv.ping_time,
-                            'range': reference_range.values,
-                    })
-    return sv
+    W = _resampleWeight(reference_range, sv_obj.range)
+    return _regrid(sv_obj.data.transpose(), W, sv_obj.ping_time.size).transpose()
 
 def expand_range(old_range, target, interval):
 
     # Create new range data using np.arange with a given interval
-    new_range_data = np.arange(old_range[0].values, target, interval)
+    new_range_data = np.arange(old_range[0], target, interval)
 
     # Remove values > target
     new_range_data = new_range_data[new_range_data < target]
 
-    # Construct a new range
-    new_range = xr.DataArray(name="range", data=new_range_data, dims=['range'],
-                    coords={'range': new_range_data})
-
-    return new_range
+    return new_range_data
 
 def compare_range(ref_range, src_range):
     len_ref = len(ref_range)
@@ -410,50 +518,399 @@ def compare_range(ref_range, src_range):
     if len_src > len_ref:
         return False
     else:
-        if ref_range[:len_src].equals(src_range) == True:
-            return True
-        else:
-            return False
+        return np.array_equal(ref_range[:len_src], src_range)
 
-def process_channel(raw_data, channel, raw_data_main, reference_range):
+# Channel pings within this of a main channel ping are the same ping
+ping_match_tolerance = np.timedelta64(10, 'ms')
+# Motion and navigation records further than this from a ping are not used for it
+stream_tolerance = np.timedelta64(60, 's')
 
-    # Process channels with different ping times and with different frequencies
-    # TODO: Check how to deal with the EK80 data
-    if(np.array_equal(raw_data.ping_time, raw_data_main.ping_time) == False
-        and raw_data.get_frequency(unique=True) != raw_data_main.get_frequency(unique=True)
-        and type(raw_data).__module__ != "echolab2.instruments.EK80"
-        and type(raw_data_main).__module__ != "echolab2.instruments.EK80"):
-        print("This channel's time mismatched the main channel's, attempting match_pings() within 100th of a second.")
-        raw_data.match_pings(raw_data_main)
+def align_index(times, ping_time, method = "nearest", tolerance = None):
+    """
+    Index of the record in the sorted times matched to each ping ("nearest" or
+    "previous" record), -1 when there is none within the tolerance.
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+    ping_time = np.asarray(ping_time, dtype='datetime64[ns]')
+    if len(times) == 0:
+        return np.full(len(ping_time), -1)
+    right = np.searchsorted(times, ping_time, side='right')
+    if method == "previous":
+        idx = right - 1
+    elif method == "nearest":
+        left = np.clip(right - 1, 0, len(times) - 1)
+        right = np.clip(right, 0, len(times) - 1)
+        idx = np.where(np.abs(times[right] - ping_time) < np.abs(ping_time - times[left]), right, left)
+    else:
+        raise ValueError("Unknown alignment method: " + str(method))
+    valid = idx >= 0
+    if tolerance is not None:
+        valid &= np.abs(ping_time - times[np.clip(idx, 0, None)]) <= tolerance
+    return np.where(valid, idx, -1)
 
-    # Process it into xarray
-    sv_bundle = process_data_to_xr(raw_data)
+def align_to_pings(times, values, ping_time, method = "nearest", tolerance = None):
+    """
+    Map a timestamped stream (sorted times, values along the first axis) onto the
+    ping axis with "nearest", "previous" or "linear" semantics. Pings without a
+    record within the tolerance (for "linear", on both sides) get NaN.
+    """
+    values = np.asarray(values, dtype='float64')
+    if method != "linear":
+        idx = align_index(times, ping_time, method, tolerance)
+        if len(values) == 0:
+            return np.full((len(ping_time),) + values.shape[1:], np.nan)
+        out = values[np.clip(idx, 0, None)]
+        out[idx < 0] = np.nan
+        return out
+
+    out = np.full((len(ping_time),) + values.shape[1:], np.nan)
+    if len(values) == 0:
+        return out
+    t = np.asarray(times, dtype='datetime64[ns]').astype('int64')
+    p = np.asarray(ping_time, dtype='datetime64[ns]').astype('int64')
+    right = np.searchsorted(t, p, side='right')
+    lo = np.clip(right - 1, 0, len(t) - 1)
+    hi = np.clip(right, 0, len(t) - 1)
+    span = (t[hi] - t[lo]).astype('float64')
+    weight = np.divide((p - t[lo]).astype('float64'), span, out=np.zeros(len(p)), where=span > 0)
+    weight = weight.reshape((-1,) + (1,) * (values.ndim - 1))
+    valid = (p >= t[0]) & (p <= t[-1])
+    if tolerance is not None:
+        tolerance = tolerance.astype('timedelta64[ns]').astype('int64')
+        valid &= (p - t[lo] <= tolerance) & ((t[hi] - p <= tolerance) | (p == t[lo]))
+    out[valid] = (values[lo] + weight * (values[hi] - values[lo]))[valid]
+    return out
+
+class CarryOver:
+    """
+    Keeps the last records of the timestamped streams (motion, navigation) of the
+    previous raw file, so that the first pings of the next file are aligned against
+    them instead of getting NaN.
+    """
+    def __init__(self, span = stream_tolerance):
+        self.span = span
+        self.streams = {}
+
+    def extend(self, name, times, values):
+        # Prepend the previous file's tail (if it is older) and keep this file's tail
+        tail = self.streams.get(name)
+        if len(times) > 0:
+            keep = times >= times[-1] - self.span
+            self.streams[name] = (times[keep], values[keep])
+        if tail is not None and len(tail[0]) > 0 and (len(times) == 0 or tail[0][-1] < times[0]):
+            times = np.concatenate([tail[0], times])
+            values = np.concatenate([tail[1], values])
+        return times, values
+
+    def get_state(self):
+        # The kept records as JSON (e.g. to cache them with the processed dataset)
+        return {name: [times.astype('datetime64[ns]').astype('int64').tolist(), np.asarray(values, dtype='float64').tolist()]
+                for name, (times, values) in sorted(self.streams.items())}
+
+    def set_state(self, state):
+        self.streams = {name: (np.array(times, dtype='int64').astype('datetime64[ns]'), np.array(values, dtype='float64'))
+                        for name, (times, values) in state.items()}
+
+    def state_hash(self):
+        return hashlib.sha256(json.dumps(self.get_state()).encode()).hexdigest()
+
+def align_stream(times, values, ping_time, method, carry = None, name = None, tolerance = stream_tolerance):
+    # Align one stream onto the pings, dropping missing values and using the carry-over (if any)
+    times = np.asarray(times, dtype='datetime64[ns]')
+    values = np.asarray(values, dtype='float64')
+    keep = ~np.isnan(values)
+    times = times[keep]
+    values = values[keep]
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        values = values[order]
+    if carry is not None:
+        times, values = carry.extend(name, times, values)
+    return align_to_pings(times, values, ping_time, method, tolerance)
+
+def sailed_distance(latitude, longitude):
+    # Cumulative great-circle distance (nautical miles) along a track of positions
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    return np.concatenate([[0.0], np.cumsum(2 * 3440.065 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))])
+
+def continue_distance(distance, last = None, offset = 0.0):
+    """
+    Sailed distance of a raw file (the valid values, in ping order) made
+    non-decreasing across the raw files for the distance outputs. Without
+    NAV_DIR the distance is the log's, which may reset or restart in the next
+    raw file: it is moved by offset (that of the previous raw files) and each
+    decrease, from last (where the previous raw file ended) on, is offset so
+    that the distance goes on from where it was. Returns the distance and the
+    offset for the next raw file.
+    """
+    distance = distance + offset
+    if len(distance) == 0:
+        return distance, offset
+    previous = np.append(distance[0] if last is None else last, distance[:-1])
+    shift = np.cumsum(np.maximum(previous - distance, 0))
+    return distance + shift, offset + float(shift[-1])
+
+def build_navigation(dir_loc, raw_fname, nav_dir, raw_index_dir = None):
+    """
+    Cruise-wide navigation track. The NMEA and motion records of every raw file are
+    extracted once into <nav_dir>/files/<raw file>.parquet (redone when the raw
+    file's size or mtime changes) and combined into <nav_dir>/track.parquet, sorted
+    by time, with the sailed distance along the whole track.
+    """
+    os.makedirs(nav_dir + "/files", exist_ok=True)
+    track_fname = nav_dir + "/track.parquet"
+    changed = not os.path.isfile(track_fname)
+    parts = []
+    for fn in raw_fname:
+        part_fname = nav_dir + "/files/" + fn + ".parquet"
+        stat = os.stat(dir_loc + "/" + fn)
+        source = json.dumps([stat.st_size, stat.st_mtime_ns]).encode()
+        parts.append(part_fname)
+        if os.path.isfile(part_fname) and (pq.read_schema(part_fname).metadata or {}).get(b"source") == source:
+            continue
+        print("Reading the navigation of " + fn)
+        columns = EK80Splitter.read_navigation(dir_loc + "/" + fn, raw_index_dir)
+        columns["raw_file"] = np.full(len(columns["time"]), fn)
+        table = pa.table(columns).replace_schema_metadata({"source": source})
+        pq.write_table(table, part_fname + ".tmp")
+        os.replace(part_fname + ".tmp", part_fname)
+        changed = True
+
+    if changed:
+        track = pa.concat_tables([pq.read_table(part).replace_schema_metadata(None) for part in parts])
+        track = track.take(pa.array(np.argsort(track.column("time").to_numpy(), kind='stable')))
+        latitude = track.column("latitude").to_numpy()
+        longitude = track.column("longitude").to_numpy()
+        fixes = ~np.isnan(latitude) & ~np.isnan(longitude)
+        distance = np.full(len(latitude), np.nan)
+        distance[fixes] = sailed_distance(latitude[fixes], longitude[fixes])
+        track = track.append_column("distance", pa.array(distance))
+        pq.write_table(track, track_fname + ".tmp")
+        os.replace(track_fname + ".tmp", track_fname)
+    return track_fname
+
+def load_navigation(nav_dir):
+    # The track as {variable: (times, values)}, without the missing values
+    track = pq.read_table(nav_dir + "/track.parquet")
+    times = track.column("time").to_numpy().astype('datetime64[ns]')
+    navigation = {}
+    for var in EK80Splitter.nav_fields + ["distance"]:
+        values = track.column(var).to_numpy()
+        keep = ~np.isnan(values)
+        navigation[var] = (times[keep], values[keep])
+    return navigation
+
+# Calibration parameters stored per channel and ping with the power (see process_power)
+calibration_variables = ["gain", "sa_correction", "equivalent_beam_angle", "absorption_coefficient", "sound_speed", "transmit_power", "pulse_duration"]
+# Names of the parameters in pyEcholab, where they differ
+calibration_aliases = {"sound_speed": ["sound_speed", "sound_velocity"], "pulse_duration": ["pulse_length", "pulse_duration"]}
+# Terms fitted against pyEcholab's sv and stored with the power as well (see fit_power_terms)
+fitted_variables = ["range_offset", "sv_offset"]
+power_variables = calibration_variables + fitted_variables
+
+def calibration_parameters(cal_obj, raw_data, n_ping):
+    # The calibration parameters of a channel per ping, from the calibration object
+    # or else from the raw data (NaN when missing)
+    params = {}
+    for name in calibration_variables:
+        value = None
+        for alias in calibration_aliases.get(name, [name]):
+            for source in (cal_obj, raw_data):
+                if value is None:
+                    value = getattr(source, alias, None)
+        params[name] = np.full(n_ping, np.nan)
+        if value is not None:
+            value = np.asarray(value, dtype = float).ravel()
+            if value.size in (1, n_ping):
+                params[name][:] = value
+    return params
+
+def calibration_constant(gain, sa_correction, equivalent_beam_angle, transmit_power, pulse_duration, sound_speed, frequency):
+    # The calibration term of the sv equation (dB), 10 log10(Pt G^2 lambda^2 c tau psi / (32 pi^2)) + 2 Sa
+    # with the gain G, the equivalent beam angle psi and the Sa correction in dB
+    wavelength = sound_speed / frequency
+    return (10 * np.log10(transmit_power * wavelength ** 2 * sound_speed * pulse_duration / (32 * np.pi ** 2))
+            + 2 * gain + equivalent_beam_angle + 2 * sa_correction)
+
+def power_constant(params, frequency):
+    # The calibration constant of a channel per ping, 0 where a parameter is missing
+    return np.nan_to_num(calibration_constant(params["gain"], params["sa_correction"], params["equivalent_beam_angle"],
+                                              params["transmit_power"], params["pulse_duration"], params["sound_speed"], frequency))
+
+def power_tvg(range_values, range_offset, absorption_coefficient):
+    # The range terms of the sv equation (dB), 20 log10(r) (not below 0) + 2 alpha r, on the
+    # range corrected by range_offset (not below 0)
+    r = np.maximum(range_values - range_offset, 0)
+    return 20 * np.log10(np.maximum(r, 1)) + 2 * absorption_coefficient * r
+
+def fit_power_terms(sv, power, range_values, params, frequency, max_offset = 3, n_fit = 100):
+    """
+    The range_offset (m) and sv_offset (dB) per ping with which sv_from_power gives
+    back pyEcholab's sv (ping, range) of a channel from its power and calibration
+    parameters (see calibration_parameters). range_offset is the TVG range
+    correction, the whole number of samples (up to max_offset, chosen on n_fit
+    pings) that leaves the smallest deviation. sv_offset is the rest of the
+    difference, e.g. the effective pulse duration of EK80 instead of the nominal
+    one, or a calibration parameter that is missing (the constant is then left to
+    sv_offset). Returns them with the median deviation that remains (dB).
+    """
+    n_ping = sv.shape[0]
+    step = np.median(np.diff(range_values))
+    constant = power_constant(params, frequency)
+    alpha = np.nan_to_num(params["absorption_coefficient"])[:, None]
+    # Compared where none of the candidate TVGs is clipped
+    use = range_values - max_offset * step >= 1
+    rows = np.unique(np.linspace(0, n_ping - 1, min(n_ping, n_fit)).astype(int))
+    best_k = 0
+    best_deviation = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category = RuntimeWarning)
+        for k in range(max_offset + 1):
+            residual = sv[rows][:, use] - power[rows][:, use] - power_tvg(range_values[use][None, :], k * step, alpha[rows]) + constant[rows, None]
+            deviation = np.nanmedian(np.abs(residual - np.nanmedian(residual, axis = 1)[:, None]))
+            if np.isnan(best_deviation) or deviation < best_deviation:
+                best_k = k
+                best_deviation = deviation
+        range_offset = np.full(n_ping, best_k * step)
+        sv_offset = np.full(n_ping, np.nan)
+        for a in range(0, n_ping, 1000):
+            residual = sv[a:a + 1000][:, use] - power[a:a + 1000][:, use] - power_tvg(range_values[use][None, :], range_offset[a:a + 1000, None], alpha[a:a + 1000]) + constant[a:a + 1000, None]
+            sv_offset[a:a + 1000] = np.nanmedian(residual, axis = 1)
+    return range_offset, sv_offset, best_deviation
+
+def process_power(raw_data, reference_range, sv_obj, sv_data):
+    """
+    Received power (dB) of a channel on the reference range, with its calibration
+    parameters and the terms fitted against its sv (on the channel's own range, see
+    fit_power_terms). For a channel regridded onto the reference range (sv_data),
+    the power is the one giving its regridded sv.
+    """
+    cal_obj = raw_data.get_calibration()
+    power_obj = raw_data.get_power(calibration = cal_obj)
+    params = calibration_parameters(cal_obj, raw_data, power_obj.data.shape[0])
+    params["range_offset"], params["sv_offset"], deviation = fit_power_terms(sv_obj.data, power_obj.data, np.asarray(power_obj.range), params, sv_obj.frequency)
+    if deviation > 0.01:
+        print("WARNING: sv from the power of " + str(sv_obj.frequency) + " Hz differs from pyEcholab's by " + str(deviation) + " dB (median)")
+    if compare_range(reference_range, power_obj.range) == False:
+        alpha = np.nan_to_num(params["absorption_coefficient"])[:, None]
+        tvg = power_tvg(np.asarray(reference_range)[None, :], params["range_offset"][:, None], alpha)
+        power_data = (sv_data - tvg + (power_constant(params, sv_obj.frequency) - params["sv_offset"])[:, None]).astype(sv_data.dtype)
+    else:
+        power_data = power_obj.data
+    return power_data, params
+
+def sv_from_power(ds):
+    """
+    sv = power + 20 log10(r) + 2 alpha r - calibration_constant + sv_offset, with r
+    the range less range_offset, from the power and the calibration parameters and
+    fitted terms (frequency, ping_time) of a dataset written with STORE_POWER. This
+    is pyEcholab's sv (see fit_power_terms), and moves with the calibration
+    parameters. Lazy when the dataset is (e.g. opened with xr.open_zarr).
+    """
+    dtype = ds.power.dtype
+    constant = calibration_constant(ds.gain, ds.sa_correction, ds.equivalent_beam_angle, ds.transmit_power,
+                                    ds.pulse_duration, ds.sound_speed, ds.frequency).fillna(0)
+    tvg = power_tvg(ds.range, ds.range_offset, ds.absorption_coefficient.fillna(0))
+    sv = ds.power + tvg.astype(dtype) + (ds.sv_offset - constant).astype(dtype)
+    return sv.transpose("frequency", "ping_time", "range").astype(dtype)
+
+def _sv_array(group):
+    # The array with the shape and chunks of sv in a zarr output (the power when sv is not stored)
+    return group["sv"] if "sv" in group else group["power"]
+
+def read_sv(group, p0, p1):
+    # sv (frequency, ping_time, range) of the pings p0:p1 of a zarr output
+    if "sv" in group:
+        return group["sv"][:, p0:p1, :]
+    ds = xr.Dataset({name: (["frequency", "ping_time"], group[name][:, p0:p1]) for name in power_variables},
+                    coords = {"frequency": group["frequency"][:], "range": group["range"][:]})
+    ds["power"] = (["frequency", "ping_time", "range"], group["power"][:, p0:p1, :])
+    return sv_from_power(ds).values
+
+def open_zarr_output(store, **kwargs):
+    # Open a zarr output, with sv computed lazily from the power when it is not stored
+    ds = xr.open_zarr(store, **kwargs)
+    if "sv" not in ds and "power" in ds:
+        ds["sv"] = sv_from_power(ds)
+    return ds
+
+def store_channel(buffers, i, ping_time, sv_obj, sv_data, trdraft, angle_alongship, angle_athwartship, power_bundle = None):
+    # Write a channel into its slice of the preallocated (frequency, ping_time, range) buffers.
+    # Samples beyond the channel's range and missing pings stay NaN.
+    if np.array_equal(ping_time, sv_obj.ping_time):
+        pidx = slice(None)
+        rows = slice(None)
+    else:
+        pidx = align_index(ping_time, sv_obj.ping_time, "nearest", ping_match_tolerance)
+        rows = pidx >= 0
+        pidx = pidx[rows]
+    n_range = sv_data.shape[1]
+    buffers["sv"][i, pidx, :n_range] = sv_data[rows]
+    buffers["transducer_draft"][i, pidx] = trdraft[rows]
+    if angle_alongship is not None:
+        buffers["angle_alongship"][i, pidx, :n_range] = angle_alongship[rows]
+    if angle_athwartship is not None:
+        buffers["angle_athwartship"][i, pidx, :n_range] = angle_athwartship[rows]
+    if power_bundle is not None:
+        buffers["power"][i, pidx, :n_range] = power_bundle[0][rows]
+        for name in power_variables:
+            buffers[name][i, pidx] = power_bundle[1][name][rows]
+
+def compute_as_completed(tasks):
+    # Yield (position, result) as the delayed tasks finish, so that each result can be
+    # released before the others are done (plain dask.compute without a client)
+    try:
+        client = get_client()
+    except ValueError:
+        for i, result in enumerate(dask.compute(*tasks)):
+            yield i, result
+        return
+    futures = client.compute(tasks)
+    positions = {future.key: i for i, future in enumerate(futures)}
+    for future in as_completed(futures):
+        result = future.result()
+        future.release()
+        yield positions[future.key], result
+
+def process_channel(raw_data, reference_range, store_power = False):
+
+    # Get the sv and angles
+    sv_bundle = process_data(raw_data)
 
     # Handle processing error
     if sv_bundle is None:
-        return [None, None, None, None, None, None]
+        return None
+
+    return grid_channel(raw_data, sv_bundle, reference_range, store_power)
+
+def grid_channel(raw_data, sv_bundle, reference_range, store_power = False):
+    # The sv and angles of a channel (from process_data) on the reference range
+
+    sv_obj, pulse_length, angle_alongship, angle_athwartship = sv_bundle[:4]
 
-    # Check if we need to regrid this channel's sv
-    if(compare_range(reference_range, sv_bundle[0].range) == False):
-        sv_bundle[0] = regrid_sv(sv_bundle[0], reference_range)
+    # Check if we need to regrid this channel's sv, otherwise it is padded with NaN in the output buffer
+    if(compare_range(reference_range, sv_obj.range) == False):
+        sv_data = regrid_sv(sv_obj, reference_range)
         # Regridding means emptying the angles (TODO)
-        sv_bundle[3] = sv_bundle[0].copy(data = np.full(sv_bundle[0].shape, np.nan))
-        sv_bundle[4] = sv_bundle[0].copy(data = np.full(sv_bundle[0].shape, np.nan))
+        angle_alongship = None
+        angle_athwartship = None
     else:
-        # Ordinary padding (sv and angles)
-        if(len(reference_range) != len(sv_bundle[0].range)):
-            for it in [0, 3, 4]:
-                sv_bundle[it] = sv_bundle[it].pad(range =(0, len(reference_range) - len(sv_bundle[it].range)))
-                sv_bundle[it]['range'] = reference_range.values
+        sv_data = sv_obj.data
 
-    return [channel] + sv_bundle
+    # Received power and calibration parameters (to recalibrate without the raw file)
+    power_bundle = process_power(raw_data, reference_range, sv_obj, sv_data) if store_power else None
 
-def process_raw_file(raw_fname, main_frequency, reference_range = None):
+    return [sv_obj, sv_data, pulse_length, angle_alongship, angle_athwartship, power_bundle]
+
+def process_raw_file(raw_fname, main_frequency, reference_range = None, raw_view = None, raw_index_dir = None, carry = None, navigation = None, depth_grid = False, store_power = False, reference_depth = None):
     # Read input raw
     print("\n\nNow processing file: " + raw_fname)
     raw_obj = None
     try:
-        raw_obj = ek_read(raw_fname)
+        raw_obj = ek_read(raw_fname, raw_view, raw_index_dir)
     except:
         e = sys.exc_info()[0]
         print("ERROR: Something went wrong when reading the RAW file: " + str(raw_fname) + " (" + str(e) + ")")
@@ -503,137 +960,135 @@ def process_raw_file(raw_fname, main_frequency, reference_range = None):
 
     # Getting Sv for the main channel
     raw_data_main = raw_obj.raw_data[main_channel[0]][0]
-    sv_bundle = process_data_to_xr(raw_data_main, raw_obj, get_positions=True)
+    sv_bundle = process_data(raw_data_main, raw_obj, get_positions=True)
 
     # Bail out if there is a problem in processing the main channel
     if sv_bundle is None:
         return None
 
     # Get (interpolated) position, speed, and distance
-    positions = sv_bundle[5]['position'][1]
-    speed = sv_bundle[5]['speed'][1]
-    distance = sv_bundle[5]['distance'][1]
+    positions = sv_bundle[4]['position'][1]
+    speed = sv_bundle[4]['speed'][1]
+    distance = sv_bundle[4]['distance'][1]
 
     # Check whether we need to set a reference range using this file's range or max_range
+    main_range = sv_bundle[0].range
     if type(reference_range) == type(None):
-        reference_range = sv_bundle[0].range
-    else:
-        # If we need to use the target range
-        if isinstance(reference_range, (int, float, complex)) and not isinstance(reference_range, bool):
-            range_intervals = list(a[0]-a[1] for a in zip(sv_bundle[0].range[1:].values, sv_bundle[0].range[:-1].values))
-            unique_range_intervals = np.unique(range_intervals)
-            if len(unique_range_intervals) > 1:
-                print("ERROR: Interval is not unique!!!")
-            reference_range = expand_range(sv_bundle[0].range, reference_range, unique_range_intervals)
-
-        # Check if we also need to regrid this main channel
-        if(compare_range(reference_range, sv_bundle[0].range) == False):
-            sv_bundle[0] = regrid_sv(sv_bundle[0], reference_range)
-            # Regridding means emptying the angles (TODO)
-            sv_bundle[3] = sv_bundle[0].copy(data = np.full(sv_bundle[0].shape, np.nan))
-            sv_bundle[4] = sv_bundle[0].copy(data = np.full(sv_bundle[0].shape, np.nan))
-        else:
-            # Ordinary padding (sv and angles)
-            if(len(reference_range) != len(sv_bundle[0].range)):
-                for it in [0, 3, 4]:
-                    sv_bundle[it] = sv_bundle[it].pad(range =(0, len(reference_range) - len(sv_bundle[it].range)))
-                    sv_bundle[it]['range'] = reference_range.values
-
-    # Prepare placeholder for combined data
-    channel_ids = main_channel
-    sv_list = [sv_bundle[0]]
-    trdraft_list = [sv_bundle[1]]
-    plength_list = [sv_bundle[2]]
-    angles_alongship_list = [sv_bundle[3]]
-    angles_athwartship_list = [sv_bundle[4]]
+        reference_range = main_range
+    # If we need to use the target range
+    elif isinstance(reference_range, (int, float, complex)) and not isinstance(reference_range, bool):
+        range_intervals = list(a[0]-a[1] for a in zip(main_range[1:], main_range[:-1]))
+        unique_range_intervals = np.unique(range_intervals)
+        if len(unique_range_intervals) > 1:
+            print("ERROR: Interval is not unique!!!")
+        reference_range = expand_range(main_range, reference_range, unique_range_intervals)
+    reference_range = np.asarray(reference_range)
+
+    # The output ping axis is the main channel's pings, plus the pings of the other
+    # channels that don't match any of them
+    channel_ids = main_channel + other_channels
+    ping_time = raw_data_main.ping_time
+    unmatched = []
+    for chan in other_channels:
+        chan_ping_time = raw_obj.raw_data[chan][0].ping_time
+        if not np.array_equal(chan_ping_time, ping_time):
+            unmatched.append(chan_ping_time[align_index(ping_time, chan_ping_time, "nearest", ping_match_tolerance) < 0])
+    if sum(len(x) for x in unmatched) > 0:
+        ping_time = np.unique(np.concatenate([ping_time] + unmatched))
+
+    # Allocate the output once and write each channel into it
+    n_chan = len(channel_ids)
+    dtype = sv_bundle[0].data.dtype
+    buffers = {
+        "sv": np.full((n_chan, len(ping_time), len(reference_range)), np.nan, dtype = dtype),
+        "angle_alongship": np.full((n_chan, len(ping_time), len(reference_range)), np.nan, dtype = dtype),
+        "angle_athwartship": np.full((n_chan, len(ping_time), len(reference_range)), np.nan, dtype = dtype),
+        "transducer_draft": np.full((n_chan, len(ping_time)), np.nan)
+    }
+    if store_power:
+        buffers["power"] = np.full((n_chan, len(ping_time), len(reference_range)), np.nan, dtype = dtype)
+        for name in power_variables:
+            buffers[name] = np.full((n_chan, len(ping_time)), np.nan)
+
+    # Main channel (regridded if needed)
+    sv_bundle = grid_channel(raw_data_main, sv_bundle, reference_range, store_power)
+    results = [(0, sv_bundle)]
+    del sv_bundle
 
     # Process Sv for all other channels in parallel (if any)
     if len(other_channels) > 0:
-        # Scatter raw_data_main
-        raw_data_main_i = dask.delayed(raw_data_main)
-        worker_data = []
-        for chan in other_channels:
-            # Getting raw data for a frequency
-            result = dask.delayed(process_channel)(raw_obj.raw_data[chan][0], chan, raw_data_main_i, reference_range)
-            worker_data.append(result)
-
-        ready = dask.delayed(zip)(*worker_data)
-        channel_id, sv, trdraft, plength, angles_alongship, angles_athwartship = ready.compute()
-
-        # Don't forget to filter out None from the broken Sv calculation
-        channel_ids = channel_ids + [x for x in channel_id if x is not None]
-        sv_list.extend([x for x in sv if x is not None])
-        trdraft_list.extend([x for x in trdraft if x is not None])
-        plength_list.extend([x for x in plength if x is not None])
-        angles_alongship_list.extend([x for x in angles_alongship if x is not None])
-        angles_athwartship_list.extend([x for x in angles_athwartship if x is not None])
-
-    # Combine different frequencies
-    da_sv = xr.concat(sv_list, dim='frequency')
-    da_trdraft = xr.concat(trdraft_list, dim='frequency')
-    da_angles_alongship = xr.concat(angles_alongship_list, dim='frequency')
-    da_angles_athwartship = xr.concat(angles_athwartship_list, dim='frequency')
-
-    # Getting motion data, apply extra treatment for duplicate frequencies with different times
-    if(len(da_sv.ping_time) == len(raw_obj.motion_data.heave)):
-        obj_heave = raw_obj.motion_data.heave
-        obj_pitch = raw_obj.motion_data.pitch
-        obj_roll = raw_obj.motion_data.roll
-        obj_heading = raw_obj.motion_data.heading
-    else:
-        # Find nearest time for motion
-        pidx = np.searchsorted(raw_obj.motion_data.times, da_sv.ping_time.data, side='right') - 1
-        obj_heave = raw_obj.motion_data.heave[pidx]
-        obj_pitch = raw_obj.motion_data.pitch[pidx]
-        obj_roll = raw_obj.motion_data.roll[pidx]
-        obj_heading = raw_obj.motion_data.heading[pidx]
-
-        # (TODO: re-check if below is still necessary)
-        # Find nearest time for positions
-        #print(len(distance['trip_distance_nmi']))
-        #pidx = np.searchsorted(positions['ping_time'], da_sv.ping_time.data, side='right') - 1
-        #positions['latitude'] = positions['latitude'][pidx]
-        #positions['longitude'] = positions['longitude'][pidx]
-        #speed['spd_over_grnd_kts'] = speed['spd_over_grnd_kts'][pidx]
-        #distance['trip_distance_nmi'] = distance['trip_distance_nmi'][pidx]
-
-    # Get position speed distance in a dataset to ease alignments (if needed, as below)
-    da_pos = xr.Dataset(
-                data_vars=dict(
-                    distance=(["ping_time"], distance['trip_distance_nmi']),
-                    speed=(["ping_time"], speed['spd_over_grnd_kts']),
-                    latitude=(["ping_time"], positions['latitude']),
-                    longitude=(["ping_time"], positions['longitude'])
-                ),
-                coords=dict(
-                    ping_time = positions['ping_time']
-                )
-            )
-
-    # Handles condition where we have missing time in position data
-    if len(positions['ping_time']) != len(da_sv.ping_time.data):
-        diff = np.setdiff1d(da_sv.ping_time.data, positions['ping_time'])
-        da_pos = da_pos.reindex({"ping_time": da_sv.ping_time.data})
+        worker_data = [dask.delayed(process_channel)(raw_obj.raw_data[chan][0], reference_range, store_power) for chan in other_channels]
+        results = itertools.chain(results, ((i + 1, result) for i, result in compute_as_completed(worker_data)))
+
+    # Write the results into the buffers as they come, each one is released once stored.
+    # Don't forget to filter out None from the broken Sv calculation.
+    valid = np.zeros(n_chan, dtype=bool)
+    frequency = [None] * n_chan
+    plength_list = [None] * n_chan
+    for i, result in results:
+        if result is None:
+            continue
+        sv_obj, sv_data, pulse_length, angle_alongship, angle_athwartship, power_bundle = result
+        del result
+        store_channel(buffers, i, ping_time, sv_obj, sv_data, sv_obj.transducer_offset, angle_alongship, angle_athwartship, power_bundle)
+        frequency[i] = sv_obj.frequency
+        plength_list[i] = pulse_length
+        valid[i] = True
+        del sv_obj, sv_data, angle_alongship, angle_athwartship, power_bundle
+
+    # Move the broken channels out (in place, keeping the channel order)
+    valid_idx = np.flatnonzero(valid)
+    if len(valid_idx) < n_chan:
+        for var in buffers:
+            for j, i in enumerate(valid_idx):
+                if i != j:
+                    buffers[var][j] = buffers[var][i]
+    channel_ids = [channel_ids[i] for i in valid_idx]
+    frequency = [frequency[i] for i in valid_idx]
+    plength_list = [plength_list[i] for i in valid_idx]
+
+    for var in buffers:
+        buffers[var] = buffers[var][:len(valid_idx)]
+
+    # Align motion (previous record) and navigation (linear) onto the pings, from the
+    # cruise-wide track (if given and it has the variable) or from this raw file
+    file_streams = {
+        "heave": (raw_obj.motion_data.times, raw_obj.motion_data.heave),
+        "pitch": (raw_obj.motion_data.times, raw_obj.motion_data.pitch),
+        "roll": (raw_obj.motion_data.times, raw_obj.motion_data.roll),
+        "heading": (raw_obj.motion_data.times, raw_obj.motion_data.heading),
+        "latitude": (positions['ping_time'], positions['latitude']),
+        "longitude": (positions['ping_time'], positions['longitude']),
+        "speed": (positions['ping_time'], speed['spd_over_grnd_kts']),
+        "distance": (positions['ping_time'], distance['trip_distance_nmi'])
+    }
+    aligned = {}
+    for var, (times, values) in file_streams.items():
+        method = "previous" if var in ["heave", "pitch", "roll", "heading"] else "linear"
+        if navigation is not None and len(navigation[var][0]) > 0:
+            aligned[var] = align_to_pings(navigation[var][0], navigation[var][1], ping_time, method, stream_tolerance)
+        else:
+            aligned[var] = align_stream(times, values, ping_time, method, carry, var)
 
     # Crate a dataset
     ds = xr.Dataset(
         data_vars=dict(
-            sv=(["frequency", "ping_time", "range"], da_sv.data),
-            angle_alongship = (["frequency", "ping_time", "range"], da_angles_alongship.data),
-            angle_athwartship = (["frequency", "ping_time", "range"], da_angles_athwartship.data),
-            transducer_draft=(["frequency", "ping_time"], da_trdraft.data),
-            heave=(["ping_time"], obj_heave),
-            pitch=(["ping_time"], obj_pitch),
-            roll=(["ping_time"], obj_roll),
-            heading=(["ping_time"], obj_heading),
-            speed=(["ping_time"], da_pos.speed.data),
-            distance=(["ping_time"], da_pos.distance.data),
+            sv=(["frequency", "ping_time", "range"], buffers["sv"]),
+            angle_alongship = (["frequency", "ping_time", "range"], buffers["angle_alongship"]),
+            angle_athwartship = (["frequency", "ping_time", "range"], buffers["angle_athwartship"]),
+            transducer_draft=(["frequency", "ping_time"], buffers["transducer_draft"]),
+            heave=(["ping_time"], aligned["heave"]),
+            pitch=(["ping_time"], aligned["pitch"]),
+            roll=(["ping_time"], aligned["roll"]),
+            heading=(["ping_time"], aligned["heading"]),
+            speed=(["ping_time"], aligned["speed"]),
+            distance=(["ping_time"], aligned["distance"]),
             pulse_length=(["frequency"], plength_list)
             ),
         coords=dict(
-            frequency = da_sv.frequency,
-            ping_time = da_sv.ping_time,
-            range = da_sv.range,
+            frequency = frequency,
+            ping_time = ping_time,
+            range = reference_range,
             )
     )
 
@@ -641,15 +1096,181 @@ def process_raw_file(raw_fname, main_frequency, reference_range = None):
     ds.coords["channel_id"] = ("frequency", channel_ids)
 
     # Add positions
-    ds.coords["latitude"] = ("ping_time", da_pos.latitude.data)
-    ds.coords["longitude"] = ("ping_time", da_pos.longitude.data)
+    ds.coords["latitude"] = ("ping_time", aligned["latitude"])
+    ds.coords["longitude"] = ("ping_time", aligned["longitude"])
+
+    # Add ping_time to file mapping as a file index and a file table (see decode_raw_file)
+    ds.coords["file_index"] = ("ping_time", np.zeros(len(ds.ping_time), dtype='int32'))
+    ds.attrs["file_table"] = json.dumps([{"name": ntpath.basename(raw_fname), "hash": raw_index_hash(raw_fname, raw_index_dir),
+                                          "ping_start": 0, "ping_stop": len(ds.ping_time)}])
+
+    # Optional power, calibration parameters and the terms with which sv_from_power gives
+    # back pyEcholab's sv (the zarr output stores them instead of sv)
+    if store_power:
+        ds["power"] = (["frequency", "ping_time", "range"], buffers["power"])
+        for name in power_variables:
+            ds[name] = (["frequency", "ping_time"], buffers[name])
+
+    # Optional depth referenced sv, on the depth axis of the previous raw files when given
+    if depth_grid == True:
+        if reference_depth is None:
+            reference_depth = depth_axis(reference_range, buffers["transducer_draft"], aligned["heave"])
+        reference_depth = np.asarray(reference_depth)
+        ds["sv_depth"] = (["frequency", "ping_time", "depth"], depth_grid_sv(buffers["sv"], reference_range, buffers["transducer_draft"], aligned["heave"], reference_depth))
+        ds.coords["depth"] = ("depth", reference_depth)
+
+    return ds
+
+def get_file_table(ds):
+    # The file table is a list in zarr attributes and a JSON string in NetCDF attributes
+    file_table = ds.attrs.get("file_table", [])
+    if isinstance(file_table, str):
+        file_table = json.loads(file_table)
+    return file_table
+
+def decode_raw_file(ds):
+    """
+    Add the per-ping raw_file coordinate back from the file_index coordinate and
+    the file table, for code expecting the raw file name of every ping.
+    """
+    if "raw_file" in ds.coords or "file_index" not in ds.coords:
+        return ds
+    names = np.array([entry["name"] for entry in get_file_table(ds)])
+    return ds.assign_coords(raw_file = ("ping_time", names[ds.file_index.values]))
 
-    # Add ping_time to file mapping as coordinates
-    ds.coords["raw_file"] = ("ping_time", [ntpath.basename(raw_fname)] * len(ds.ping_time))
+def reset_peak_rss():
+    # Reset the peak resident set size of this process (Linux), so that it can be reported per file
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
 
+def report_peak_rss(fn):
+    # Peak resident set size since the last reset (includes the output writer threads)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    print("Peak RSS while processing " + str(fn) + ": " + "%.0f" % (int(line.split()[1]) / 1024) + " MB")
+    except OSError:
+        pass
+
+# Content hashes of the files hashed in this run, by path, size and mtime
+content_hashes = {}
+
+def file_content_hash(fname, block_size = 16 * 1024 * 1024):
+    # SHA-256 of the file content (decompressed for compressed raw files), read only once
+    # per run while the file is unchanged
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)
+    if key not in content_hashes:
+        sha = hashlib.sha256()
+        with EK80Splitter.open_raw(fname) as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        content_hashes[key] = sha.hexdigest()
+    return content_hashes[key]
+
+def raw_index_hash(raw_fname, raw_index_dir = None):
+    # SHA-256 of the datagram index of a raw file (types, times, lengths and sample counts),
+    # identifying its content from the datagram headers only (the sidecar in raw_index_dir
+    # is used if given)
+    if raw_index_dir is not None:
+        index, _ = EK80Splitter.load_raw_index(raw_fname, raw_index_dir)
+    else:
+        index, _ = EK80Splitter.build_raw_index(raw_fname)
+    sha = hashlib.sha256()
+    for field in ['dg_type', 'ping_time', 'length', 'count']:
+        sha.update(np.ascontiguousarray(index[field]).tobytes())
+    return sha.hexdigest()
+
+def _axis_hash(values):
+    if values is None or isinstance(values, (int, float)):
+        return str(values)
+    return hashlib.sha256(np.asarray(values, dtype='float64').tobytes()).hexdigest()
+
+def cache_key(raw_fname, main_frequency, reference_range = None, raw_view = None, navigation = False, depth_grid = False, store_power = False, carry = None, reference_depth = None):
+    # The processed dataset depends on the raw content, the preprocessor version, the config
+    # and the records carried over from the previous raw file (its first pings are aligned with them)
+    key = dict(
+        raw = file_content_hash(raw_fname),
+        version = str(os.getenv('VERSION_NUMBER', __version__)),
+        main_frequency = main_frequency,
+        reference_range = _axis_hash(reference_range),
+        raw_view = raw_view,
+        layout = "file_index",
+        navigation = "track" if navigation else "raw",
+        depth_grid = _axis_hash(reference_depth) if depth_grid else False,
+        store_power = bool(store_power),
+        carry = carry.state_hash() if carry is not None else None
+    )
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+def cache_load(cache_dir, key, carry = None):
+    # The cached dataset, and the records it carries over to the next raw file into carry
+    cache_fname = cache_dir + "/" + key + ".zarr"
+    if not os.path.isdir(cache_fname):
+        return None
+    try:
+        with xr.open_zarr(cache_fname) as ds:
+            ds = ds.load()
+        # Written to the outputs with their own encodings, not the cache's
+        for var in ds.variables:
+            ds[var].encoding = {}
+        state = ds.attrs.pop("carry_over", None)
+        if carry is not None and state is not None:
+            carry.set_state(state)
+    except Exception:
+        e = sys.exc_info()[0]
+        print("ERROR: Unable to read the cached dataset " + cache_fname + " (" + str(e) + ")")
+        return None
+    # Mark as recently used for the eviction
+    os.utime(cache_fname)
+    print("Using cached dataset " + cache_fname)
     return ds
 
-def raw_to_grid_single(raw_fname, main_frequency = 38000, write_output = False, out_fname = "", output_type = "zarr", overwrite = False):
+def cache_evict(cache_dir, max_size):
+    # Remove the least recently used datasets until the cache fits in max_size bytes
+    entries = [(os.path.getmtime(x), _dir_size(x), x) for x in glob.glob(cache_dir + "/*.zarr")]
+    total_size = sum([x[1] for x in entries])
+    for _, size, cache_fname in sorted(entries):
+        if total_size <= max_size:
+            break
+        print("Evicting cached dataset " + cache_fname)
+        shutil.rmtree(cache_fname, ignore_errors=True)
+        total_size -= size
+
+def cache_store(cache_dir, key, ds, max_size = None, carry = None):
+    cache_fname = cache_dir + "/" + key + ".zarr"
+    tmp_fname = cache_fname + ".tmp"
+    compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+    encoding = {var: {"compressor" : compressor} for var in ds.data_vars}
+    try:
+        ds.to_zarr(tmp_fname, mode="w", encoding=encoding)
+        if carry is not None:
+            group = zr.open_group(tmp_fname)
+            group.attrs["carry_over"] = carry.get_state()
+            zr.consolidate_metadata(tmp_fname)
+        if os.path.isdir(cache_fname):
+            shutil.rmtree(cache_fname)
+        os.rename(tmp_fname, cache_fname)
+    except Exception:
+        e = sys.exc_info()[0]
+        print("ERROR: Unable to cache the dataset as " + cache_fname + " (" + str(e) + ")")
+        shutil.rmtree(tmp_fname, ignore_errors=True)
+        return
+    if max_size is not None:
+        cache_evict(cache_dir, max_size)
+
+def raw_to_grid_single(raw_fname, main_frequency = 38000, write_output = False, out_fname = "", output_type = "zarr", overwrite = False, raw_view = None, raw_index_dir = None):
 
     # Prepare for writing output
     target_fname = ""
@@ -677,7 +1298,7 @@ def raw_to_grid_single(raw_fname, main_frequency = 38000, write_output = False,
         do_write = False
 
     # Process single file
-    ds = process_raw_file(raw_fname, main_frequency)
+    ds = process_raw_file(raw_fname, main_frequency, raw_view = raw_view, raw_index_dir = raw_index_dir)
     
     print("Created dataset:")
     print(ds)
@@ -740,33 +1361,85 @@ def prepare_resume_singlefile(target_type, target_file, filename_list):
 
     return  reference_range
 
-def get_max_range_from_files(dir_loc, raw_fname, main_frequency):
+def get_reference_depth(target_type, target_file):
+    # Depth axis of the sv_depth of an output being resumed (None without sv_depth)
+    if target_type == "zarr":
+        with xr.open_zarr(target_file) as tmp_src:
+            return tmp_src.depth.values if "sv_depth" in tmp_src else None
+    elif target_type == "netcdf4":
+        with xr.open_dataset(target_file) as tmp_src:
+            return tmp_src.depth.values if "sv_depth" in tmp_src else None
+    return None
+
+def get_max_count_from_index(index, channels, main_frequency, raw_view = None):
+    # Sample datagrams of the channels in the view
+    samples = index[index['count'] > 0]
+    if raw_view in ('CW', 'FM'):
+        mode = EK80Splitter.index_modes.index(raw_view)
+        view_channels = np.unique(index['channel'][(index['dg_type'] == b'XML0') & (index['mode'] == mode)])
+        samples = samples[np.isin(samples['channel'], view_channels)]
+    elif raw_view is not None:
+        samples = samples[np.isin(samples['channel'], [i for i, chan in enumerate(channels) if chan == raw_view])]
+
+    if len(samples) == 0:
+        return 0
+
+    main_samples = samples[samples['frequency'] == main_frequency]
+    if len(main_samples) == 0:
+        # Fall back into using the first available channel.
+        main_samples = samples[samples['channel'] == samples['channel'][0]]
+    return int(main_samples['count'].max())
+
+def get_max_count_from_file(fname, main_frequency, raw_view = None, raw_index_dir = None):
+    # Number of samples of the main channel, reading the whole file
+    raw_obj = ek_read(fname, raw_view, raw_index_dir)
+    try:
+        main_raw_data = raw_obj.get_channel_data(main_frequency)[main_frequency][0]
+    except KeyError as error:
+        # Fall back into using the first available channel.
+        main_raw_data = raw_obj.raw_data[list(raw_obj.raw_data.keys())[0]][0]
+    if main_raw_data.data_type == 'power/angle':
+        return main_raw_data.power.shape[1]
+    elif main_raw_data.data_type == 'complex-FM' or main_raw_data.data_type == 'complex-CW':
+        return main_raw_data.complex.shape[1]
+    return 0
+
+def get_max_range_from_files(dir_loc, raw_fname, main_frequency, raw_view = None, raw_index_dir = None):
     print("Now trying to find the maximum range from the list of raw files...")
     ref_file = ''
     ref_range = 0
 
     for fn in raw_fname:
-        # Read input raw
-        raw_obj = ek_read(dir_loc + "/" + fn)
+        # Get the sample counts from the datagram index instead of reading the whole file
         try:
-            main_raw_data = raw_obj.get_channel_data(main_frequency)[main_frequency][0]
-        except KeyError as error:
-            # Fall back into using the first available channel.
-            main_raw_data = raw_obj.raw_data[list(raw_obj.raw_data.keys())[0]][0]
-        if main_raw_data.data_type == 'power/angle':
-            ref_data = main_raw_data.power
-        elif main_raw_data.data_type == 'complex-FM' or main_raw_data.data_type == 'complex-CW':
-            ref_data = main_raw_data.complex
-        else:
-            ref_data = np.zeros((0,0))
-
-        range_len = ref_data.shape[1]
+            index, channels = EK80Splitter.load_raw_index(dir_loc + "/" + fn, raw_index_dir)
+        except Exception as e:
+            print("ERROR: Unable to index " + str(fn) + " (" + str(e) + ")")
+            continue
+        range_len = get_max_count_from_index(index, channels, main_frequency, raw_view)
         if range_len > ref_range:
             ref_range = range_len
             ref_file = fn
 
+    if ref_range == 0:
+        # No sample counts in the indexes, read the files
+        print("No sample counts in the datagram indexes, reading the raw files")
+        for fn in raw_fname:
+            try:
+                range_len = get_max_count_from_file(dir_loc + "/" + fn, main_frequency, raw_view, raw_index_dir)
+            except Exception as e:
+                print("ERROR: Unable to read " + str(fn) + " (" + str(e) + ")")
+                continue
+            if range_len > ref_range:
+                ref_range = range_len
+                ref_file = fn
+
+    if ref_file == '':
+        print("Unable to find the maximum range, using the main channel's range of the first file")
+        return None
+
     # Now get the maximum range
-    raw_obj = ek_read(dir_loc + "/" + ref_file)
+    raw_obj = ek_read(dir_loc + "/" + ref_file, raw_view, raw_index_dir)
     try:
         main_raw_data = raw_obj.get_channel_data(main_frequency)[main_frequency][0]
     except KeyError as error:
@@ -783,13 +1456,1466 @@ def get_max_range_from_files(dir_loc, raw_fname, main_frequency):
     print(new_range)
     return new_range
 
-def raw_to_grid_multiple(dir_loc,  work_dir_loc, single_raw_file = 'nofile', main_frequency = 38000, write_output = False, out_fname = "", output_type = "zarr", overwrite = False, resume = False, max_reference_range = None):
+def list_raw_files(dir_loc):
+    raw_files = []
+    for pattern in ["/*.raw"] + ["/*.raw" + suffix for suffix in EK80Splitter.compressed_suffixes]:
+        raw_files.extend(glob.glob(dir_loc + pattern))
+    return sorted([ntpath.basename(a) for a in raw_files])
+
+def _json_list(values):
+    # NaN is not valid JSON, store missing values as None
+    return [None if (isinstance(x, float) and math.isnan(x)) else x for x in np.asarray(values).tolist()]
 
-    # Misc. conditionals
-    write_first_loop = True
+def _json_array(values):
+    return np.array([np.nan if x is None else x for x in values], dtype='float64')
 
-    # List files
-    raw_fname = [ntpath.basename(a) for a in sorted(glob.glob(dir_loc + "/*.raw"))] 
+def valid_range_extent(ds):
+    # Range of the last valid (non-NaN) sv sample per frequency and ping
+    valid = ~np.isnan(ds.sv.values)
+    last = valid.shape[2] - 1 - np.argmax(valid[:, :, ::-1], axis=2)
+    extent = ds.range.values[last]
+    extent[~valid.any(axis=2)] = np.nan
+    return extent
+
+def update_chunk_index(chunk_index, ping_start, ping_time, latitude, longitude, range_extent):
+    """
+    Merge the bounds of the pings [ping_start, ping_start + len(ping_time)) into the
+    per-chunk index (time span, lat/lon bounding box and valid range extent per
+    frequency of every ping_time chunk).
+    """
+    chunk_size = chunk_index["chunk_size"]
+    chunk_ids = (ping_start + np.arange(len(ping_time))) // chunk_size
+    starts = np.flatnonzero(np.diff(chunk_ids, prepend=-1))
+    first_chunk = int(chunk_ids[0])
+
+    times = ping_time.astype('datetime64[ns]').astype('int64')
+    bounds = {
+        "time_min": np.minimum.reduceat(times, starts).astype('float64'),
+        "time_max": np.maximum.reduceat(times, starts).astype('float64'),
+        "lat_min": np.fmin.reduceat(latitude, starts),
+        "lat_max": np.fmax.reduceat(latitude, starts),
+        "lon_min": np.fmin.reduceat(longitude, starts),
+        "lon_max": np.fmax.reduceat(longitude, starts),
+    }
+    extent = np.fmax.reduceat(range_extent, starts, axis=1).T
+
+    for key, values in bounds.items():
+        stored = _json_array(chunk_index[key])
+        stored = np.append(stored, np.full(first_chunk + len(values) - len(stored), np.nan))
+        reduce = np.fmin if key.endswith("_min") else np.fmax
+        stored[first_chunk:] = reduce(stored[first_chunk:], values)
+        if key.startswith("time"):
+            chunk_index[key] = [int(x) for x in stored]
+        else:
+            chunk_index[key] = _json_list(stored)
+
+    stored = [_json_array(x) for x in chunk_index["range_max"]]
+    for i, values in enumerate(extent):
+        if first_chunk + i < len(stored):
+            stored[first_chunk + i] = np.fmax(stored[first_chunk + i], values)
+        else:
+            stored.append(values)
+    chunk_index["range_max"] = [_json_list(x) for x in stored]
+    return chunk_index
+
+def build_chunk_index(target_fname):
+    """
+    (Re)build the chunk index of a zarr output from its coordinates, e.g. after
+    rechunking. The valid range extent is taken from the file table (the maximum
+    of the raw files in each chunk) or set to the full range if it is missing.
+    """
+    group = zr.open_group(target_fname, mode='r')
+    attrs = group.attrs.asdict()
+    chunk_size = _sv_array(group).chunks[1]
+    n_freq = _sv_array(group).shape[0]
+    chunk_index = {"chunk_size": chunk_size, "time_min": [], "time_max": [], "lat_min": [], "lat_max": [],
+                   "lon_min": [], "lon_max": [], "range_max": []}
+    with xr.open_zarr(target_fname) as ds:
+        range_extent = np.full((n_freq, len(ds.ping_time)), float(ds.range.values[-1]))
+        if "file_table" in attrs:
+            range_extent[:] = np.nan
+            for entry in attrs["file_table"]:
+                range_extent[:, entry["ping_start"]:entry["ping_stop"]] = _json_array(entry["range_max"])[:, None]
+        update_chunk_index(chunk_index, 0, ds.ping_time.values, ds.latitude.values, ds.longitude.values, range_extent)
+    return chunk_index
+
+def select(target_fname, time = None, bbox = None, frequency = None, depth = None):
+    """
+    Lazily select a subset of a zarr output. Only the ping_time chunks that
+    intersect the query according to the chunk index are opened. time and depth
+    (range) are (start, stop) tuples, bbox is (lon_min, lat_min, lon_max, lat_max)
+    and frequency a value or a list of values.
+    """
+    attrs = zr.open_group(target_fname, mode='r').attrs.asdict()
+    ds = open_zarr_output(target_fname)
+    chunk_index = attrs.get("chunk_index")
+    if chunk_index is None:
+        print("No chunk index in " + str(target_fname) + ", selecting from all chunks")
+        ping_idx = np.arange(len(ds.ping_time))
+    else:
+        n_chunks = len(chunk_index["time_min"])
+        keep = np.ones(n_chunks, dtype=bool)
+        if time is not None:
+            start = np.datetime64(time[0], 'ns').astype('int64')
+            stop = np.datetime64(time[1], 'ns').astype('int64')
+            keep &= (np.array(chunk_index["time_max"]) >= start) & (np.array(chunk_index["time_min"]) <= stop)
+        if bbox is not None:
+            with np.errstate(invalid='ignore'):
+                keep &= ((_json_array(chunk_index["lon_max"]) >= bbox[0]) & (_json_array(chunk_index["lat_max"]) >= bbox[1])
+                         & (_json_array(chunk_index["lon_min"]) <= bbox[2]) & (_json_array(chunk_index["lat_min"]) <= bbox[3]))
+        if depth is not None:
+            range_max = np.array([_json_array(x) for x in chunk_index["range_max"]])
+            if frequency is not None:
+                range_max = range_max[:, np.isin(ds.frequency.values, np.atleast_1d(frequency))]
+            with np.errstate(invalid='ignore'):
+                keep &= (range_max >= depth[0]).any(axis=1)
+        chunk_size = chunk_index["chunk_size"]
+        ping_idx = np.concatenate([np.arange(i * chunk_size, min((i + 1) * chunk_size, len(ds.ping_time)))
+                                   for i in np.flatnonzero(keep)] + [np.arange(0)])
+    subset = ds.isel(ping_time = ping_idx)
+
+    # Exact selection within the chunks
+    if time is not None:
+        subset = subset.sel(ping_time = slice(np.datetime64(time[0]), np.datetime64(time[1])))
+    if bbox is not None:
+        lon = subset.longitude.values
+        lat = subset.latitude.values
+        subset = subset.isel(ping_time = np.flatnonzero((lon >= bbox[0]) & (lat >= bbox[1]) & (lon <= bbox[2]) & (lat <= bbox[3])))
+    if frequency is not None:
+        subset = subset.sel(frequency = np.atleast_1d(frequency))
+    if depth is not None:
+        subset = subset.sel(range = slice(depth[0], depth[1]))
+    return subset
+
+# Coarsening factors (in ping_time and range) of the overview levels of the zarr
+# output, and the number of pings read at a time when (re)building them
+pyramid_factors = [2, 8, 32, 128]
+pyramid_slab = 128 * 64
+
+def coarsen_sv(sv, factor):
+    # Average sv (frequency, ping_time, range, in dB) over factor x factor blocks in
+    # the linear domain, the partial blocks at the ends average the samples they have
+    n_freq, n_ping, n_range = sv.shape
+    n_p = -(-n_ping // factor)
+    n_r = -(-n_range // factor)
+    out = np.empty((n_freq, n_p, n_r), dtype='f4')
+    linear = np.full((n_p * factor, n_r * factor), np.nan, dtype='f4')
+    for i in range(n_freq):
+        linear[:n_ping, :n_range] = np.power(10, sv[i] / 10)
+        blocks = linear.reshape(n_p, factor, n_r, factor)
+        count = np.sum(~np.isnan(blocks), axis=(1, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[i] = 10 * np.log10(np.nansum(blocks, axis=(1, 3)) / count)
+    return out
+
+def update_levels(group, n_done, sv, factors):
+    # Append the pings [n_done, n_done + len) of sv to the overview levels,
+    # recomputing the partial block left at the end of each level
+    pyramid = group["pyramid"]
+    compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+    n_stop = n_done + sv.shape[1]
+    for f in factors:
+        name = str(f)
+        if name not in pyramid:
+            level = pyramid.create_group(name)
+            n_r = -(-_sv_array(group).shape[2] // f)
+            for coord in ["frequency", "range"]:
+                values = group[coord][:] if coord == "frequency" else group[coord][::f]
+                level.array(coord, values, fill_value = group[coord].fill_value, compressor = compressor)
+                level[coord].attrs.update(group[coord].attrs.asdict())
+            level.create_dataset("ping_time", shape = (0,), chunks = (4096,), dtype = group["ping_time"].dtype, fill_value = group["ping_time"].fill_value, compressor = compressor)
+            level["ping_time"].attrs.update(group["ping_time"].attrs.asdict())
+            level.create_dataset("sv", shape = (sv.shape[0], 0, n_r), chunks = (1, 4096, n_r), dtype = 'f4', fill_value = np.nan, compressor = compressor)
+            level["sv"].attrs.update({"_ARRAY_DIMENSIONS": ["frequency", "ping_time", "range"]})
+        level = pyramid[name]
+        start = (n_done // f) * f
+        block = np.concatenate([read_sv(group, start, n_done), sv], axis = 1) if start < n_done else sv
+        coarse = coarsen_sv(block, f)
+        n_level = start // f + coarse.shape[1]
+        level["sv"].resize(sv.shape[0], n_level, coarse.shape[2])
+        level["sv"][:, start // f:, :] = coarse
+        level["ping_time"].resize(n_level)
+        level["ping_time"][start // f:] = group["ping_time"][start:n_stop:f]
+    pyramid.attrs["n_pings"] = n_stop
+
+def update_pyramid(store, sv = None, factors = pyramid_factors):
+    """
+    Bring the overview levels of a zarr output (the groups pyramid/<factor>, read
+    with open_overview) up to date with the pings appended to sv. sv holds the
+    newly appended pings when they are still in memory, otherwise (and when the
+    levels are behind) the pings are read back from the store.
+    """
+    group = zr.open_group(store)
+    n_total = _sv_array(group).shape[1]
+    n_new = 0 if sv is None else sv.shape[1]
+    pyramid = group.require_group("pyramid")
+    pyramid.attrs["factors"] = factors
+    n_done = pyramid.attrs.get("n_pings", 0)
+    if n_done > n_total - n_new:
+        # Out of step with the store, rebuild
+        for name in list(pyramid.group_keys()):
+            del pyramid[name]
+        n_done = 0
+    while n_done < n_total - n_new:
+        n_stop = min(n_done + pyramid_slab, n_total - n_new)
+        update_levels(group, n_done, read_sv(group, n_done, n_stop), factors)
+        n_done = n_stop
+    if sv is not None:
+        update_levels(group, n_done, sv, factors)
+
+def open_overview(store, time_res = 800, range_res = 600):
+    # Open the coarsest overview level that still has time_res pings and range_res
+    # range samples, or the full resolution data when no level has
+    group = zr.open_group(store, mode='r')
+    n_ping, n_range = _sv_array(group).shape[1:]
+    if "pyramid" in group and group["pyramid"].attrs.get("n_pings") == n_ping:
+        for f in sorted(group["pyramid"].attrs["factors"], reverse = True):
+            if n_ping // f >= time_res and n_range // f >= range_res:
+                return xr.open_zarr(store, group = "pyramid/" + str(f))
+    return open_zarr_output(store, chunks = {'ping_time': 'auto'})
+
+class OutputSink:
+    """
+    Base class for the outputs of raw_to_grid_multiple. Each sink writes the
+    processed datasets in its own thread and keeps its own resume state, so
+    that several outputs can be fed from a single pass over the raw files.
+    """
+    output_type = None
+    extension = ""
+
+    def __init__(self, out_fname, queue_size = 2):
+        self.out_fname = out_fname
+        self.target_fname = out_fname + self.extension
+        self.write_first_loop = True
+        self.alternative_counter = 1
+        # Raw files still to be written (None means all)
+        self.pending = None
+        self.reference_range = None
+        self.reference_depth = None
+        self.queue = queue.Queue(maxsize = queue_size)
+        self.thread = None
+        # Raw files that could not be written
+        self.failed = []
+
+    def exists(self):
+        return os.path.isfile(self.target_fname) or os.path.isdir(self.target_fname)
+
+    def remove(self):
+        if os.path.isfile(self.target_fname):
+            os.remove(self.target_fname)
+        if os.path.isdir(self.target_fname):
+            shutil.rmtree(self.target_fname)
+
+    def resume(self, raw_fname, single_raw_file):
+        # Updating file list and using the reference range
+        if single_raw_file != 'nofile':
+            self.reference_range = prepare_resume_singlefile(self.output_type, self.target_fname, raw_fname)
+        else:
+            new_raw_fname, self.reference_range = prepare_resume(self.output_type, self.target_fname, raw_fname)
+            self.pending = set(new_raw_fname)
+        self.reference_depth = get_reference_depth(self.output_type, self.target_fname)
+
+    def prepare(self, raw_fname, single_raw_file, overwrite, resume):
+        # Returns whether this sink has anything to write
+        if not self.exists():
+            return True
+        if overwrite == True:
+            # Delete existing files
+            self.remove()
+            return True
+        elif resume == True:
+            # Resuming
+            self.write_first_loop = False
+            print("Trying to resume batch processing of " + self.target_fname)
+            self.resume(raw_fname, single_raw_file)
+            print("Reference range:")
+            print(self.reference_range)
+            return True
+        else:
+            # All failed
+            print("Output data " + self.target_fname + " exists. Not overwriting nor resuming.")
+            return False
+
+    def wants(self, fn):
+        return self.pending is None or fn in self.pending
+
+    def start(self):
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def submit(self, ds, fn):
+        # Blocks when the writer is behind, to bound the number of datasets in memory
+        self.queue.put((ds, fn))
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.failed:
+            print("ERROR: " + str(len(self.failed)) + " raw file(s) not written to " + self.target_fname + ": " + ", ".join(str(fn) for fn in self.failed))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            ds, fn = item
+            start_time = time.perf_counter()
+            try:
+                self.write(ds, fn)
+            except Exception as e:
+                self.failed.append(fn)
+                print("ERROR: Unable to write data from " + str(fn) + " to " + self.target_fname + " (" + type(e).__name__ + ": " + str(e) + ")")
+            else:
+                print("Wrote " + str(fn) + " to " + self.target_fname + " in " + "%.1f" % (time.perf_counter() - start_time) + " s")
+                self.write_first_loop = False
+
+    def write(self, ds, fn):
+        raise NotImplementedError
+
+class ZarrSink(OutputSink):
+    """
+    Appends to a zarr store and maintains, in the store attributes, a file table
+    (ping range and valid range extent per raw file) and the per-chunk index used
+    by select().
+    """
+    output_type = "zarr"
+    extension = ".zarr"
+
+    def __init__(self, out_fname, queue_size = 2):
+        OutputSink.__init__(self, out_fname, queue_size)
+        self.reset_index()
+
+    def reset_index(self):
+        self.file_table = []
+        self.chunk_index = None
+        self.n_pings = 0
+
+    def resume(self, raw_fname, single_raw_file):
+        OutputSink.resume(self, raw_fname, single_raw_file)
+        group = zr.open_group(self.target_fname, mode='r')
+        attrs = group.attrs.asdict()
+        self.file_table = attrs.get("file_table", [])
+        self.n_pings = _sv_array(group).shape[1]
+        if "chunk_index" in attrs:
+            self.chunk_index = attrs["chunk_index"]
+        else:
+            self.chunk_index = build_chunk_index(self.target_fname)
+
+    def assign_file_index(self, ds):
+        # Number the raw files in the order they are appended to this store
+        ds = ds.assign_coords(file_index = ds.file_index + len(self.file_table))
+        entry = get_file_table(ds)[0]
+        del ds.attrs["file_table"]
+        return ds, entry
+
+    def update_index(self, ds, entry):
+        if self.chunk_index is None:
+            chunk_size = _sv_array(zr.open_group(self.target_fname, mode='r')).chunks[1]
+            self.chunk_index = {"chunk_size": chunk_size, "time_min": [], "time_max": [], "lat_min": [], "lat_max": [],
+                                "lon_min": [], "lon_max": [], "range_max": []}
+        range_extent = valid_range_extent(ds)
+        n_new = len(ds.ping_time)
+        self.file_table.append(dict(entry, ping_start = self.n_pings, ping_stop = self.n_pings + n_new,
+                                    range_max = _json_list(np.nanmax(range_extent, axis=1, initial=-np.inf))))
+        update_chunk_index(self.chunk_index, self.n_pings, ds.ping_time.values, ds.latitude.values, ds.longitude.values, range_extent)
+        self.n_pings = self.n_pings + n_new
+        # xarray replaces the store attributes on append, put ours back
+        group = zr.open_group(self.target_fname)
+        group.attrs.update({"file_table": self.file_table, "chunk_index": self.chunk_index})
+        # Keep the annotation masks on the ping axis (the new pings are rasterized later)
+        for name in annotation_arrays:
+            if name in group:
+                group[name].resize(self.n_pings, group[name].shape[1])
+        update_pyramid(self.target_fname, ds.sv.values)
+        zr.consolidate_metadata(self.target_fname)
+
+    def write(self, ds, fn):
+        ds_mem = ds
+        # With the power stored, sv is computed from it when read (see open_zarr_output)
+        ds_out = ds.drop_vars("sv") if "power" in ds else ds
+        # Encode zarr output
+        compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+        encoding = {var: {"compressor" : compressor} for var in ds_out.data_vars}
+        if self.write_first_loop == False:
+            try:
+                ds, entry = self.assign_file_index(ds_out)
+                # Re-chunk so that we have a full range in a chunk (zarr only)
+                ds = ds.chunk({"frequency": 1, "range": ds.range.shape[0], "ping_time": 'auto'})
+                ds.to_zarr(self.target_fname, append_dim="ping_time")
+            except ValueError:
+                print("ERROR: Unable to append data from " + str(fn) + " to the existing Zarr file. A new output will be created. Please check for channel mismatches!")
+                self.target_fname = self.out_fname + "_" + str(self.alternative_counter) + ".zarr"
+                self.alternative_counter = self.alternative_counter + 1
+                self.reset_index()
+                ds, entry = self.assign_file_index(ds_out)
+                ds = ds.chunk({"frequency": 1, "range": ds.range.shape[0], "ping_time": 'auto'})
+                ds.to_zarr(self.target_fname, mode="w", encoding=encoding)
+        else:
+            self.reset_index()
+            ds, entry = self.assign_file_index(ds_out)
+            ds = ds.chunk({"frequency": 1, "range": ds.range.shape[0], "ping_time": 'auto'})
+            ds.to_zarr(self.target_fname, mode="w", encoding=encoding)
+        self.update_index(ds_mem, entry)
+
+# The HDF5 library is not thread-safe, NetCDF sinks take turns writing
+netcdf_lock = threading.Lock()
+
+class NetCDFSink(OutputSink):
+    output_type = "netcdf4"
+    extension = ".nc"
+
+    def write(self, ds, fn):
+        with netcdf_lock:
+            self.write_netcdf(ds, fn)
+
+    def write_netcdf(self, ds, fn):
+        compressor = dict(zlib=True, complevel=5)
+        encoding = {var: compressor for var in ds.data_vars}
+        if self.write_first_loop == False:
+            try:
+                self.append_netcdf(ds)
+            except ValueError:
+                print("ERROR: Unable to append data from " + str(fn) + " to the existing NetCDF4 file. A new output will be created. Please check for channel mismatches!")
+                self.target_fname = self.out_fname + "_" + str(self.alternative_counter) + ".nc"
+                self.alternative_counter = self.alternative_counter + 1
+                ds.to_netcdf(self.target_fname, mode="w", unlimited_dims=['ping_time'], encoding=encoding)
+        else:
+            ds.to_netcdf(self.target_fname, mode="w", unlimited_dims=['ping_time'], encoding=encoding)
+
+    def append_netcdf(self, ds):
+        # Number the raw file after the ones in the file and extend the file table
+        with netCDF4.Dataset(self.target_fname, mode='r') as nc:
+            file_table = json.loads(nc.file_table) if "file_table" in nc.ncattrs() else []
+            n_pings = len(nc["ping_time"])
+        entry = dict(get_file_table(ds)[0], ping_start = n_pings, ping_stop = n_pings + len(ds.ping_time))
+        ds = ds.assign_coords(file_index = ds.file_index + len(file_table))
+        append_to_netcdf(self.target_fname, ds, unlimited_dims='ping_time')
+        with netCDF4.Dataset(self.target_fname, mode='a') as nc:
+            nc.file_table = json.dumps(file_table + [entry])
+
+class PerFileNetCDFSink(OutputSink):
+    # One NetCDF4 file per raw file in the <out_fname>_nc directory
+    output_type = "netcdf4_perfile"
+    extension = "_nc"
+
+    def file_name(self, fn):
+        base_fname, _ = os.path.splitext(EK80Splitter.raw_basename(fn))
+        return self.target_fname + "/" + base_fname + ".nc"
+
+    def resume(self, raw_fname, single_raw_file):
+        # Resume from the files not written yet
+        self.pending = set([fn for fn in raw_fname if not os.path.isfile(self.file_name(fn))])
+
+    def prepare(self, raw_fname, single_raw_file, overwrite, resume):
+        do_write = OutputSink.prepare(self, raw_fname, single_raw_file, overwrite, resume)
+        if do_write:
+            os.makedirs(self.target_fname, exist_ok=True)
+        return do_write
+
+    def write(self, ds, fn):
+        compressor = dict(zlib=True, complevel=5)
+        encoding = {var: compressor for var in ds.data_vars}
+        with netcdf_lock:
+            ds.to_netcdf(self.file_name(fn) + ".tmp", mode="w", encoding=encoding)
+        os.replace(self.file_name(fn) + ".tmp", self.file_name(fn))
+
+class PingTableSink(OutputSink):
+    """
+    Per-ping navigation and motion table (<out_fname>_pings/pings) and per-ping,
+    per-channel transducer draft table (<out_fname>_pings/draft) as Parquet
+    datasets partitioned by day, one file per raw file and day.
+    """
+    output_type = "ping_table"
+    extension = "_pings"
+    ping_variables = ["heave", "pitch", "roll", "heading", "speed", "distance", "latitude", "longitude"]
+
+    def file_names(self, fn):
+        base_fname, _ = os.path.splitext(EK80Splitter.raw_basename(fn))
+        return glob.glob(self.target_fname + "/pings/date=*/" + base_fname + ".parquet")
+
+    def resume(self, raw_fname, single_raw_file):
+        # Resume from the files not written yet
+        self.pending = set([fn for fn in raw_fname if len(self.file_names(fn)) == 0])
+
+    def prepare(self, raw_fname, single_raw_file, overwrite, resume):
+        do_write = OutputSink.prepare(self, raw_fname, single_raw_file, overwrite, resume)
+        if do_write:
+            os.makedirs(self.target_fname, exist_ok=True)
+        return do_write
+
+    def write_partitioned(self, table_name, table, base_fname):
+        # Write one file per day, the ping table last as it marks the raw file as done
+        days = table.column("ping_time").to_numpy().astype('datetime64[D]')
+        for day in np.unique(days):
+            part_dir = self.target_fname + "/" + table_name + "/date=" + str(day)
+            os.makedirs(part_dir, exist_ok=True)
+            part_fname = part_dir + "/" + base_fname + ".parquet"
+            pq.write_table(table.filter(pa.array(days == day)), part_fname + ".tmp")
+            os.replace(part_fname + ".tmp", part_fname)
+
+    def write(self, ds, fn):
+        base_fname, _ = os.path.splitext(EK80Splitter.raw_basename(fn))
+        ping_time = ds.ping_time.values
+
+        # Per-channel transducer draft, one row per ping and channel
+        n_freq = len(ds.frequency)
+        draft = pa.table({
+            "ping_time": np.tile(ping_time, n_freq),
+            "frequency": np.repeat(ds.frequency.values, len(ping_time)),
+            "channel_id": np.repeat(ds.channel_id.values.astype("str"), len(ping_time)),
+            "transducer_draft": ds.transducer_draft.values.ravel()
+        })
+        self.write_partitioned("draft", draft, base_fname)
+
+        # Navigation and motion, one row per ping
+        columns = {"ping_time": ping_time}
+        for var in self.ping_variables:
+            columns[var] = ds[var].values
+        columns["raw_file"] = np.full(len(ping_time), ntpath.basename(fn))
+        self.write_partitioned("pings", pa.table(columns), base_fname)
+
+def read_ping_table(out_fname, start_time = None, end_time = None, bbox = None, polygon = None, columns = None, table_name = "pings"):
+    """
+    Query the per-ping table written by PingTableSink. Time limits are
+    numpy.datetime64 (or strings), bbox is (lon_min, lat_min, lon_max, lat_max) and
+    polygon a list of (lon, lat) vertices. Day partitions and row groups outside
+    the query are skipped by pyarrow.
+    """
+    dataset = pds.dataset(out_fname + "_pings/" + table_name, format="parquet", partitioning="hive")
+    filters = []
+    if start_time is not None:
+        start_time = np.datetime64(start_time, 'ns')
+        filters.append(pds.field("date") >= str(start_time.astype('datetime64[D]')))
+        filters.append(pds.field("ping_time") >= pa.scalar(start_time))
+    if end_time is not None:
+        end_time = np.datetime64(end_time, 'ns')
+        filters.append(pds.field("date") <= str(end_time.astype('datetime64[D]')))
+        filters.append(pds.field("ping_time") <= pa.scalar(end_time))
+    if polygon is not None:
+        vertices = np.asarray(polygon)
+        bbox = (vertices[:, 0].min(), vertices[:, 1].min(), vertices[:, 0].max(), vertices[:, 1].max())
+    if bbox is not None:
+        filters.append(pds.field("longitude") >= bbox[0])
+        filters.append(pds.field("latitude") >= bbox[1])
+        filters.append(pds.field("longitude") <= bbox[2])
+        filters.append(pds.field("latitude") <= bbox[3])
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    table = dataset.to_table(columns = columns, filter = expression)
+    if polygon is not None:
+        points = np.column_stack([table.column("longitude").to_numpy(), table.column("latitude").to_numpy()])
+        table = table.filter(pa.array(Path(vertices).contains_points(points)))
+    return table
+
+class NASCSink(OutputSink):
+    """
+    Echo integration of sv on (sailed distance, depth) cells, in a small zarr store
+    (<out_fname>_nasc.zarr). For each frequency and cell the store keeps the sum over
+    the pings of the depth-integrated sv (sa) and the number of pings, so that a
+    cell split between raw files is completed by the next file. read_nasc computes
+    NASC from these.
+    """
+    output_type = "nasc"
+    extension = "_nasc.zarr"
+    # Cell size, sailed distance (nmi) and depth (m)
+    distance_step = 0.1
+    depth_step = 10.0
+    nat = np.iinfo('int64').min
+
+    def resume(self, raw_fname, single_raw_file):
+        # Resume from the raw files not integrated yet
+        attrs = zr.open_group(self.target_fname, mode='r').attrs.asdict()
+        self.pending = set([fn for fn in raw_fname if ntpath.basename(fn) not in attrs.get("raw_files", [])])
+
+    def create(self, ds, cell0):
+        group = zr.open_group(self.target_fname, mode='w')
+        group.attrs.update({"distance_step": self.distance_step, "depth_step": self.depth_step, "cell0": int(cell0), "raw_files": []})
+        group.array("frequency", ds.frequency.values, fill_value = None)
+        group["frequency"].attrs["_ARRAY_DIMENSIONS"] = ["frequency"]
+        group.create_dataset("distance", shape = (0,), chunks = (4096,), dtype = 'f8', fill_value = None)
+        group["distance"].attrs.update({"_ARRAY_DIMENSIONS": ["distance"], "units": "nmi", "description": "Start of the distance cell"})
+        group.create_dataset("depth", shape = (0,), chunks = (4096,), dtype = 'f8', fill_value = None)
+        group["depth"].attrs.update({"_ARRAY_DIMENSIONS": ["depth"], "units": "m", "description": "Top of the depth cell"})
+        group.create_dataset("ping_time", shape = (0,), chunks = (4096,), dtype = 'i8', fill_value = self.nat)
+        group["ping_time"].attrs.update({"_ARRAY_DIMENSIONS": ["distance"], "units": "nanoseconds since 1970-01-01", "calendar": "proleptic_gregorian",
+                                         "description": "First ping of the distance cell"})
+        group.create_dataset("sa_sum", shape = (len(ds.frequency), 0, 0), chunks = (1, 1024, 256), dtype = 'f8', fill_value = 0.0)
+        group["sa_sum"].attrs.update({"_ARRAY_DIMENSIONS": ["frequency", "distance", "depth"], "units": "m2 m-2",
+                                      "description": "Sum over the pings of the sv integrated over the depth cell"})
+        group.create_dataset("ping_count", shape = (len(ds.frequency), 0), chunks = (1, 4096), dtype = 'i8', fill_value = 0)
+        group["ping_count"].attrs["_ARRAY_DIMENSIONS"] = ["frequency", "distance"]
+        return group
+
+    def write(self, ds, fn):
+        distance = ds.distance.values.copy()
+        valid = np.isfinite(distance)
+        if not valid.any():
+            print("WARNING: No sailed distance in " + str(fn) + ", not integrated")
+            return
+        # Continuing the distance integrated so far, so that a log reset or a distance restarting
+        # in this raw file does not add to the cells of the previous raw files
+        group = zr.open_group(self.target_fname) if self.exists() else None
+        if group is not None:
+            self.distance_step = group.attrs["distance_step"]
+            self.depth_step = group.attrs["depth_step"]
+            distance[valid], offset = continue_distance(distance[valid], group.attrs.get("last_distance"), group.attrs.get("distance_offset", 0.0))
+        else:
+            distance[valid], offset = continue_distance(distance[valid])
+        cell = np.zeros(len(distance), dtype='int64')
+        cell[valid] = np.floor(distance[valid] / self.distance_step)
+        if group is None:
+            group = self.create(ds, cell[valid].min())
+        cell0 = group.attrs["cell0"]
+        if (cell[valid] < cell0).any():
+            print("WARNING: Pings of " + str(fn) + " before the start of the integration (distance reset?) are not integrated")
+            valid &= cell >= cell0
+
+        # Grow the store to the cells of this file
+        range_values = ds.range.values
+        dr = float(np.median(np.diff(range_values)))
+        max_depth = range_values[-1] + np.nanmax(np.append(ds.transducer_draft.values, 0))
+        c_lo = int(cell[valid].min())
+        c_hi = int(cell[valid].max())
+        n_cells = c_hi - c_lo + 1
+        n_depth = max(group["depth"].shape[0], int(max_depth // self.depth_step) + 1)
+        n_dist = max(group["distance"].shape[0], c_hi - cell0 + 1)
+        group["distance"].resize(n_dist)
+        group["distance"][:] = (cell0 + np.arange(n_dist)) * self.distance_step
+        group["depth"].resize(n_depth)
+        group["depth"][:] = np.arange(n_depth) * self.depth_step
+        group["ping_time"].resize(n_dist)
+        group["sa_sum"].resize(group["sa_sum"].shape[0], n_dist, n_depth)
+        group["ping_count"].resize(group["ping_count"].shape[0], n_dist)
+
+        # First ping of the cells new in this file
+        a = c_lo - cell0
+        b = c_hi - cell0 + 1
+        first_ping = group["ping_time"][a:b]
+        cells, first = np.unique(cell[valid] - c_lo, return_index = True)
+        new = first_ping[cells] == self.nat
+        first_ping[cells[new]] = ds.ping_time.values[valid][first[new]].astype('int64')
+        group["ping_time"][a:b] = first_ping
+
+        # Integrate each channel and add to the accumulators of the store
+        frequencies = list(group["frequency"][:])
+        for i, frequency in enumerate(ds.frequency.values):
+            if frequency not in frequencies:
+                print("WARNING: Frequency " + str(frequency) + " of " + str(fn) + " is not in " + self.target_fname + ", not integrated")
+                continue
+            j = frequencies.index(frequency)
+            sv = ds.sv.values[i]
+            pings = valid & np.isfinite(sv).any(axis = 1)
+            draft = np.nan_to_num(ds.transducer_draft.values[i])
+            depth_bin = np.floor((range_values[None, :] + draft[:, None]) / self.depth_step).astype('int64')
+            linear = np.where(np.isfinite(sv), np.power(10, sv / 10.0), 0) * dr
+            mask = pings[:, None] & (depth_bin >= 0)
+            index = ((cell - c_lo)[:, None] * n_depth + depth_bin)[mask]
+            sa = np.bincount(index, linear[mask], minlength = n_cells * n_depth).reshape(n_cells, n_depth)
+            group["sa_sum"][j, a:b, :] = group["sa_sum"][j, a:b, :] + sa
+            group["ping_count"][j, a:b] = group["ping_count"][j, a:b] + np.bincount(cell[pings] - c_lo, minlength = n_cells)
+
+        # Mark the raw file as integrated, with the distance for the next raw file
+        group.attrs.update({"raw_files": group.attrs["raw_files"] + [ntpath.basename(fn)],
+                            "last_distance": float(distance[valid][-1]), "distance_offset": offset})
+        zr.consolidate_metadata(self.target_fname)
+
+class RegularSink(OutputSink):
+    """
+    sv resampled onto a regular ping_time (step in seconds) or sailed distance
+    (step in nmi) axis, in <out_fname>_regular.zarr. Each regular bin is the mean in
+    the linear domain of the pings overlapping it, weighted by the overlap (each ping
+    covers half the interval to its neighbours, gaps longer than gap_factor times the
+    median ping interval are not covered). The accumulators of the last bin of each
+    raw file are kept in the store (carry group), so that a bin split between raw
+    files is completed by the next file.
+    """
+    output_type = "regular"
+    extension = "_regular.zarr"
+    axis = "ping_time"
+    step = 1.0
+    gap_factor = 3.0
+
+    def resume(self, raw_fname, single_raw_file):
+        # Resume from the raw files not resampled yet
+        attrs = zr.open_group(self.target_fname, mode='r').attrs.asdict()
+        self.pending = set([fn for fn in raw_fname if ntpath.basename(fn) not in attrs.get("raw_files", [])])
+
+    def create(self, ds, k0):
+        group = zr.open_group(self.target_fname, mode='w')
+        group.attrs.update({"axis": self.axis, "step": self.step, "k0": int(k0), "raw_files": []})
+        for coord in ["frequency", "range"]:
+            group.array(coord, ds[coord].values, fill_value = None)
+            group[coord].attrs["_ARRAY_DIMENSIONS"] = [coord]
+        if self.axis == "ping_time":
+            group.create_dataset("ping_time", shape = (0,), chunks = (4096,), dtype = 'i8', fill_value = None)
+            group["ping_time"].attrs.update({"units": "nanoseconds since 1970-01-01", "calendar": "proleptic_gregorian"})
+        else:
+            group.create_dataset("distance", shape = (0,), chunks = (4096,), dtype = 'f8', fill_value = None)
+            group["distance"].attrs["units"] = "nmi"
+        group[self.axis].attrs.update({"_ARRAY_DIMENSIONS": [self.axis], "description": "Start of the bin"})
+        compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+        group.create_dataset("sv", shape = (len(ds.frequency), 0, len(ds.range)), chunks = (1, 1024, len(ds.range)), dtype = 'f4', fill_value = np.nan, compressor = compressor)
+        group["sv"].attrs["_ARRAY_DIMENSIONS"] = ["frequency", self.axis, "range"]
+        return group
+
+    def source_bins(self, x):
+        # Edges of the ping bins along x, with an empty bin inserted at each gap.
+        # Returns the edges and the position of each ping's bin
+        interval = np.diff(x)
+        half = np.median(interval) / 2 if len(interval) > 0 else self.step / 2
+        gap = interval > self.gap_factor * 2 * half
+        middle = (x[:-1] + x[1:]) / 2
+        left = np.append(x[0] - half, np.where(gap, x[1:] - half, middle))
+        right = np.append(np.where(gap, x[:-1] + half, middle), x[-1] + half)
+        pos = np.arange(len(x)) + np.append(0, np.cumsum(gap))
+        edges = np.empty(pos[-1] + 2)
+        edges[pos] = left
+        edges[pos + 1] = right
+        return edges, pos
+
+    def write(self, ds, fn):
+        group = zr.open_group(self.target_fname) if self.exists() else None
+        if group is not None:
+            self.axis = group.attrs["axis"]
+            self.step = group.attrs["step"]
+        if self.axis == "ping_time":
+            x = ds.ping_time.values.astype('int64') / 1e9
+        else:
+            x = ds.distance.values.copy()
+        valid = np.isfinite(x)
+        offset = 0.0
+        if self.axis == "distance":
+            # Continuing the distance resampled so far over a log reset or a distance restarting in this raw file
+            last = group.attrs.get("last") if group is not None else None
+            x[valid], offset = continue_distance(x[valid], last, group.attrs.get("distance_offset", 0.0) if group is not None else 0.0)
+        # Only increasing positions, after those resampled so far, can be resampled (so that the
+        # bins of the previous raw files are not overwritten)
+        valid[valid] = np.append(True, np.diff(np.maximum.accumulate(x[valid])) > 0)
+        if group is not None and "last" in group.attrs:
+            valid[valid] = x[valid] > group.attrs["last"]
+        if not valid.any():
+            print("WARNING: No " + self.axis + " in " + str(fn) + " after that resampled so far, not resampled")
+            return
+        x = x[valid]
+        edges, pos = self.source_bins(x)
+        # The first ping's bin starts where the previous raw file's last ended
+        if group is not None and "end" in group.attrs:
+            edges[0] = min(max(edges[0], group.attrs["end"]), edges[1])
+        end = edges[-1]
+        k_lo = int(np.floor(edges[0] / self.step))
+        k_hi = int(np.ceil(edges[-1] / self.step))
+        # Target bins, with empty source bins so that the source spans them
+        target = np.arange(k_lo, k_hi + 1) * self.step
+        edges = np.concatenate([[min(target[0], edges[0])], edges, [max(target[-1], edges[-1])]])
+        pos = pos + 1
+
+        if group is None:
+            group = self.create(ds, k_lo)
+        k0 = group.attrs["k0"]
+        if k_lo < k0 or len(ds.range) != group["range"].shape[0]:
+            print("WARNING: " + str(fn) + " is before the start or on another range axis than " + self.target_fname + ", not resampled")
+            return
+        carry = group["carry"] if "carry" in group else None
+
+        # Grow the regular axis to the bins of this file
+        n_bins = k_hi - k0
+        a = k_lo - k0
+        group[self.axis].resize(n_bins)
+        bins = np.arange(k0, k_hi) * self.step
+        group[self.axis][:] = np.round(bins * 1e9).astype('int64') if self.axis == "ping_time" else bins
+        group["sv"].resize(group["sv"].shape[0], n_bins, group["sv"].shape[2])
+
+        frequencies = list(group["frequency"][:])
+        carry_integral = np.zeros((len(frequencies), len(ds.range)))
+        carry_coverage = np.zeros((len(frequencies), len(ds.range)))
+        for i, frequency in enumerate(ds.frequency.values):
+            if frequency not in frequencies:
+                print("WARNING: Frequency " + str(frequency) + " of " + str(fn) + " is not in " + self.target_fname + ", not resampled")
+                continue
+            j = frequencies.index(frequency)
+            sv = ds.sv.values[i][valid]
+            finite = np.isfinite(sv)
+            values = np.zeros((len(ds.range), len(edges) - 1))
+            coverage = np.zeros((len(ds.range), len(edges) - 1))
+            values[:, pos] = np.where(finite, np.power(10, sv / 10.0), 0).T
+            coverage[:, pos] = finite.T
+            width = np.diff(target)
+            integral = _resampleCumulative(values, edges, target) * width
+            covered = _resampleCumulative(coverage, edges, target) * width
+            # Complete the first bin with the end of the previous raw file
+            if carry is not None and carry.attrs["k"] == k_lo:
+                integral[:, 0] += carry["integral"][j]
+                covered[:, 0] += carry["coverage"][j]
+            carry_integral[j] = integral[:, -1]
+            carry_coverage[j] = covered[:, -1]
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                mean = 10 * np.log10(integral / covered)
+            mean[covered <= 0] = np.nan
+            group["sv"][j, a:, :] = mean.T.astype('f4')
+
+        # Keep the accumulators of the last bin for the next raw file
+        carry = group.require_group("carry")
+        carry.array("integral", carry_integral, overwrite = True)
+        carry.array("coverage", carry_coverage, overwrite = True)
+        carry.attrs["k"] = k_hi - 1
+
+        # Mark the raw file as resampled, with where it ended for the next raw file
+        group.attrs.update({"raw_files": group.attrs["raw_files"] + [ntpath.basename(fn)],
+                            "last": float(x[-1]), "end": float(end), "distance_offset": offset})
+        zr.consolidate_metadata(self.target_fname)
+
+def read_nasc(out_fname):
+    # Nautical area scattering coefficient (m2 nmi-2) per frequency and
+    # (distance, depth) cell, from the accumulators written by NASCSink
+    ds = xr.open_zarr(out_fname + NASCSink.extension)
+    # The empty accumulators are read as missing (zarr fill value)
+    ds["sa_sum"] = ds.sa_sum.fillna(0)
+    ds["ping_count"] = ds.ping_count.fillna(0).astype('int64')
+    ds["nasc"] = 4 * np.pi * 1852 ** 2 * ds.sa_sum / ds.ping_count.where(ds.ping_count > 0)
+    return ds
+
+def list_work_files(dir_loc, work_dir_loc, raw_fname):
+    # The .work files of the raw files that have a matching .idx, as (work, idx) pairs
+    pairs = []
+    for fn in raw_fname:
+        base_fname, _ = os.path.splitext(EK80Splitter.raw_basename(fn))
+        work_fname = work_dir_loc + "/" + base_fname + ".work"
+        idx_fname = dir_loc + "/" + base_fname + ".idx"
+        if os.path.isfile(work_fname) and os.path.isfile(idx_fname):
+            pairs.append((work_fname, idx_fname))
+    return pairs
+
+def read_work_file(work_fname, idx_fname):
+    # Parse a .work/.idx pair into an annotation table (runs in the annotation process pool)
+    ann_obj = None
+    try:
+        work = readers.work_reader(work_fname)
+        ann_obj = readers.work_to_annotation(work, idx_fname)
+    except:
+        e = sys.exc_info()[0]
+        print("ERROR: Something went wrong when reading the WORK file: " + str(work_fname)  + " (" + str(e) + ")")
+    if ann_obj is None or ann_obj.df_ is None:
+        return None
+    # Layers schools and gaps
+    df = ann_obj.df_.assign(work_file = ntpath.basename(work_fname))
+    return pa.Table.from_pandas(df, schema=annotation_schema, preserve_index=False)
+
+def write_annotation_partition(pq_dir, day, table):
+    # Sorted so that the row group statistics prune on acoustic_category and ping_time
+    part_dir = pq_dir + "/date=" + str(day)
+    os.makedirs(part_dir, exist_ok=True)
+    part_fname = part_dir + "/part-0.parquet"
+    table = table.sort_by([("acoustic_category", "ascending"), ("ping_time", "ascending")])
+    pq.write_table(table, part_fname + ".tmp", row_group_size=annotation_row_group_size, write_statistics=True)
+    os.replace(part_fname + ".tmp", part_fname)
+
+def work_pair_hash(work_fname, idx_fname):
+    return hashlib.sha256((file_content_hash(work_fname) + file_content_hash(idx_fname)).encode()).hexdigest()
+
+def process_annotations(dir_loc, work_dir_loc, raw_fname, out_fname, n_processes = None):
+    """
+    Annotation stage. The .work/.idx pairs of the raw files are parsed in a process
+    pool and written to <out_fname>_work.parquet as a Parquet dataset partitioned by
+    day (date=YYYY-MM-DD), see read_annotations. The content hash and the days of
+    each pair are kept in _manifest.json, so that on later runs only the changed
+    pairs are parsed and only their days are rewritten.
+    """
+    pq_dir = out_fname + "_work.parquet"
+    manifest_fname = pq_dir + "/_manifest.json"
+    manifest = {}
+    if os.path.isfile(manifest_fname):
+        with open(manifest_fname) as f:
+            manifest = json.load(f)
+    else:
+        # First run (or an output without a manifest), start from scratch
+        if os.path.isfile(pq_dir):
+            os.remove(pq_dir)
+        elif os.path.isdir(pq_dir):
+            shutil.rmtree(pq_dir)
+    os.makedirs(pq_dir, exist_ok=True)
+
+    # Find the new and changed pairs, and the work files that are gone
+    changed = []
+    for work_fname, idx_fname in list_work_files(dir_loc, work_dir_loc, raw_fname):
+        pair_hash = work_pair_hash(work_fname, idx_fname)
+        entry = manifest.get(ntpath.basename(work_fname))
+        if entry is None or entry["hash"] != pair_hash:
+            changed.append((work_fname, idx_fname, pair_hash))
+    removed = [name for name in manifest if not os.path.isfile(work_dir_loc + "/" + name)]
+    if len(changed) == 0 and len(removed) == 0:
+        print("Annotations are up to date")
+        return pq_dir
+    print("Processing " + str(len(changed)) + " new or changed work files, removing " + str(len(removed)))
+
+    # Parse in a process pool (spawn, as forking next to the dask threads is not
+    # safe), a single file is parsed here as starting the pool costs more
+    executor = None
+    if len(changed) > 1:
+        executor = ProcessPoolExecutor(max_workers = n_processes, mp_context = multiprocessing.get_context("spawn"))
+        results = executor.map(read_work_file, [x[0] for x in changed], [x[1] for x in changed])
+    else:
+        results = map(read_work_file, [x[0] for x in changed], [x[1] for x in changed])
+    tables = []
+    replaced = set(removed)
+    new_entries = {}
+    for (work_fname, idx_fname, pair_hash), table in zip(changed, results):
+        name = ntpath.basename(work_fname)
+        if table is None:
+            # Keep the previous annotations of a file that can't be read
+            continue
+        days = table.column("ping_time").to_numpy().astype('datetime64[D]')
+        new_entries[name] = {"hash": pair_hash, "days": [str(day) for day in np.unique(days)]}
+        replaced.add(name)
+        tables.append(table)
+    if executor is not None:
+        executor.shutdown()
+
+    # Rewrite the days of the replaced files (old and new)
+    annotations = pa.concat_tables(tables) if len(tables) > 0 else annotation_schema.empty_table()
+    new_days = annotations.column("ping_time").to_numpy().astype('datetime64[D]')
+    affected = set(str(day) for day in np.unique(new_days))
+    for name in replaced:
+        affected.update(manifest.get(name, {}).get("days", []))
+    for day in sorted(affected):
+        part_fname = pq_dir + "/date=" + day + "/part-0.parquet"
+        parts = [annotations.filter(pa.array(new_days == np.datetime64(day)))]
+        if os.path.isfile(part_fname):
+            old = pq.read_table(part_fname, schema=annotation_schema)
+            parts.append(old.filter(pa.array(~np.isin(old.column("work_file").to_numpy(zero_copy_only=False), list(replaced)))))
+        table = pa.concat_tables(parts)
+        if table.num_rows > 0:
+            write_annotation_partition(pq_dir, day, table)
+        elif os.path.isfile(part_fname):
+            # No annotations left on this day, drop the partition
+            os.remove(part_fname)
+            if len(os.listdir(os.path.dirname(part_fname))) == 0:
+                os.rmdir(os.path.dirname(part_fname))
+
+    # Update the manifest last, an interrupted run is redone from the old one
+    for name in removed:
+        del manifest[name]
+    manifest.update(new_entries)
+    with open(manifest_fname + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_fname + ".tmp", manifest_fname)
+    return pq_dir
+
+def rasterize_chunk(ping_idx, range_start, range_stop, values, n_ping, n_range, fill):
+    # Paint the annotation rectangles (one range interval per row and ping) onto a
+    # chunk, later rows win where they overlap
+    out = np.full((n_ping, n_range), fill, dtype=values.dtype)
+    lengths = range_stop - range_start
+    rows = np.repeat(np.arange(len(ping_idx)), lengths)
+    if len(rows) == 0:
+        return out
+    cells = ping_idx[rows] * n_range + range_start[rows] + (np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    winner = np.full(n_ping * n_range, -1)
+    np.maximum.at(winner, cells, rows)
+    painted = winner >= 0
+    out.ravel()[painted] = values[winner[painted]]
+    return out
+
+def rasterize_annotations(out_fname, proportion = True):
+    """
+    Rasterize the annotations (<out_fname>_work.parquet) onto the (ping_time, range)
+    grid of the zarr output, as an int16 "annotation" array of category codes (0 is
+    no annotation, read as NaN by xarray, code n is the n-th of the categories listed
+    in its attributes) and optionally an
+    "annotation_proportion" array, chunked like sv. Where masks overlap the one with
+    the lowest priority value wins (priority 1 is the highest, as in the work files,
+    e.g. schools over layers). Depths are converted to range with the transducer
+    draft of the first channel and the heave, like sv_depth. A hash of the rows of
+    each ping chunk (and of the arrays written) is kept, so that only the chunks
+    whose annotations changed are rewritten.
+    """
+    store = out_fname + ".zarr"
+    if not os.path.isdir(store) or not os.path.isdir(out_fname + "_work.parquet"):
+        return None
+    group = zr.open_group(store)
+    sv = _sv_array(group)
+    n_ping = sv.shape[1]
+    n_range = sv.shape[2]
+    chunk_size = sv.chunks[1]
+    with xr.open_zarr(store) as ds:
+        ping_time = ds.ping_time.values
+        range_values = ds.range.values
+
+    # Create (or fit to the store's ping axis and chunks) the label arrays
+    compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+    names = annotation_arrays if proportion else annotation_arrays[:1]
+    if not proportion and annotation_arrays[1] in group:
+        # Not kept up to date from now on
+        del group[annotation_arrays[1]]
+    for name, dtype, fill in zip(names, ['i2', 'f4'], [0, 0.0]):
+        if name in group and group[name].chunks != (chunk_size, n_range):
+            del group[name]
+        if name not in group:
+            array = group.create_dataset(name, shape=(n_ping, n_range), chunks=(chunk_size, n_range), dtype=dtype, fill_value=fill, compressor=compressor)
+            array.attrs["_ARRAY_DIMENSIONS"] = ["ping_time", "range"]
+        elif group[name].shape[0] != n_ping:
+            group[name].resize(n_ping, n_range)
+    labels = group["annotation"]
+    categories = labels.attrs.get("categories", [])
+    chunk_hashes = labels.attrs.get("chunk_hashes", {})
+
+    # Annotations over the time span of the store, mapped onto the grid (later rows win, so the
+    # lowest priority value comes last)
+    annotations = read_annotations(out_fname, start_time = ping_time[0] - stream_tolerance, end_time = ping_time[-1] + stream_tolerance)
+    annotations = annotations.sort_by([("priority", "descending"), ("ping_time", "ascending")])
+    ann_time = annotations.column("ping_time").to_numpy()
+    ping_idx = align_index(ping_time, ann_time, "nearest", ping_match_tolerance)
+    keep = ping_idx >= 0
+    ping_idx = ping_idx[keep]
+    category = annotations.column("acoustic_category").to_numpy(zero_copy_only=False)[keep].astype(str)
+    # New categories are appended, so that the existing codes stay valid
+    unique_category, inverse = np.unique(category, return_inverse=True)
+    for cat in unique_category:
+        if cat not in categories:
+            categories.append(str(cat))
+    codes = np.array([categories.index(cat) + 1 for cat in unique_category], dtype='i2')[inverse]
+    fractions = annotations.column("proportion").to_numpy(zero_copy_only=False)[keep].astype('f4')
+    upper = annotations.column("mask_depth_upper").to_numpy(zero_copy_only=False)[keep]
+    lower = annotations.column("mask_depth_lower").to_numpy(zero_copy_only=False)[keep]
+    shift = np.nan_to_num(group["transducer_draft"][0, :])
+    if "heave" in group:
+        shift = shift + np.nan_to_num(group["heave"][:])
+    shift = shift[ping_idx]
+    range_start = np.searchsorted(range_values, upper - shift, side='left')
+    range_stop = np.maximum(np.searchsorted(range_values, lower - shift, side='right'), range_start)
+
+    # Rewrite the chunks whose rows changed (rows are in priority order, kept stable by the sort)
+    chunk_of = ping_idx // chunk_size
+    n_chunks = (n_ping + chunk_size - 1) // chunk_size
+    n_written = 0
+    for c in range(n_chunks):
+        rows = np.flatnonzero(chunk_of == c)
+        if len(rows) == 0 and str(c) not in chunk_hashes:
+            # Never annotated, still the fill value
+            continue
+        p0 = c * chunk_size
+        p1 = min(p0 + chunk_size, n_ping)
+        chunk_hash = hashlib.sha256(b"".join([",".join(names).encode()] + [x.tobytes() for x in [ping_idx[rows], range_start[rows], range_stop[rows], codes[rows], fractions[rows]]])).hexdigest()
+        if chunk_hashes.get(str(c)) == chunk_hash:
+            continue
+        labels[p0:p1, :] = rasterize_chunk(ping_idx[rows] - p0, range_start[rows], range_stop[rows], codes[rows], p1 - p0, n_range, 0)
+        if proportion:
+            group["annotation_proportion"][p0:p1, :] = rasterize_chunk(ping_idx[rows] - p0, range_start[rows], range_stop[rows], fractions[rows], p1 - p0, n_range, 0.0)
+        chunk_hashes[str(c)] = chunk_hash
+        n_written = n_written + 1
+
+    labels.attrs.update({"categories": categories, "chunk_hashes": chunk_hashes,
+                         "description": "Annotation category code per sample, 0 is none, n is categories[n - 1]"})
+    zr.consolidate_metadata(store)
+    print("Rasterized the annotations into " + str(n_written) + " of " + str(n_chunks) + " chunks")
+    return store
+
+def read_annotations(out_fname, start_time = None, end_time = None, acoustic_category = None, columns = None):
+    """
+    Query the annotations written by process_annotations. Time limits are
+    numpy.datetime64 (or strings) and acoustic_category a value or a list of values.
+    Day partitions and row groups outside the query are skipped by pyarrow.
+    """
+    dataset = pds.dataset(out_fname + "_work.parquet", format="parquet", partitioning="hive")
+    filters = []
+    if start_time is not None:
+        start_time = np.datetime64(start_time, 'ns')
+        filters.append(pds.field("date") >= str(start_time.astype('datetime64[D]')))
+        filters.append(pds.field("ping_time") >= pa.scalar(start_time))
+    if end_time is not None:
+        end_time = np.datetime64(end_time, 'ns')
+        filters.append(pds.field("date") <= str(end_time.astype('datetime64[D]')))
+        filters.append(pds.field("ping_time") <= pa.scalar(end_time))
+    if acoustic_category is not None:
+        filters.append(pds.field("acoustic_category").isin([str(x) for x in np.atleast_1d(acoustic_category)]))
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    return dataset.to_table(columns = columns, filter = expression)
+
+def add_npy(tar, name, array):
+    # Add an array to a tar file as a .npy member
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    info = tarfile.TarInfo(name)
+    info.size = buffer.tell()
+    info.mtime = 0
+    buffer.seek(0)
+    tar.addfile(info, buffer)
+
+def export_chunk(store, shard_fname, p0, p1, ping_time, patch_size, max_per_category = None, seed = 0):
+    """
+    Tile the pings [p0, p1) of the zarr output (one sv chunk, read once for all the
+    frequencies) into patches and write them to a tar shard, as <key>.sv.npy (with
+    <key>.annotation.npy when the store has annotation masks) and <key>.json.
+    Returns the shard's manifest entry.
+    """
+    group = zr.open_group(store, mode='r')
+    sv = read_sv(group, p0, p1)
+    labels = group["annotation"][p0:p1, :] if "annotation" in group else None
+    n_ping, n_range = patch_size
+    starts = [(i, j) for i in range(0, p1 - p0 - n_ping + 1, n_ping) for j in range(0, sv.shape[2] - n_range + 1, n_range)]
+
+    # Dominant annotation category of each patch (0 when not annotated)
+    dominant = np.zeros(len(starts), dtype=int)
+    if labels is not None:
+        for k, (i, j) in enumerate(starts):
+            counts = np.bincount(labels[i:i + n_ping, j:j + n_range].ravel())
+            counts[0] = 0
+            dominant[k] = counts.argmax() if counts.sum() > 0 else 0
+
+    # Stratify: keep at most max_per_category patches of each category
+    keep = np.arange(len(starts))
+    if max_per_category is not None:
+        rng = np.random.default_rng(seed)
+        keep = np.sort(np.concatenate([rng.permutation(np.flatnonzero(dominant == c))[:max_per_category] for c in np.unique(dominant)] + [np.zeros(0, dtype=int)]))
+
+    with tarfile.open(shard_fname + ".tmp", "w") as tar:
+        for k in keep:
+            i, j = starts[k]
+            key = "%09d_%05d" % (p0 + i, j)
+            add_npy(tar, key + ".sv.npy", sv[:, i:i + n_ping, j:j + n_range])
+            if labels is not None:
+                add_npy(tar, key + ".annotation.npy", labels[i:i + n_ping, j:j + n_range])
+            meta = json.dumps({"ping_start": int(p0 + i), "range_start": int(j), "ping_time": str(ping_time[i]),
+                               "category": int(dominant[k])}).encode()
+            info = tarfile.TarInfo(key + ".json")
+            info.size = len(meta)
+            tar.addfile(info, io.BytesIO(meta))
+    os.replace(shard_fname + ".tmp", shard_fname)
+    categories, counts = np.unique(dominant[keep], return_counts=True)
+    return {"name": os.path.basename(shard_fname), "ping_start": int(p0), "ping_stop": int(p1), "n_patches": int(len(keep)),
+            "categories": {str(c): int(n) for c, n in zip(categories, counts)}}
+
+def export_patches(out_fname, patch_size = (256, 256), max_per_category = None):
+    """
+    Export fixed-size (frequency x ping x range) patches of the zarr output into
+    tar shards (<out_fname>_patches/shard-NNNNN.tar, one per ping chunk of sv) for
+    streaming training loaders, with a manifest.json listing the shards. Patches are
+    tiled inside each chunk so every chunk is read only once, in parallel. With
+    max_per_category, at most that many patches per dominant annotation category
+    are sampled from each chunk.
+    """
+    store = out_fname + ".zarr"
+    if not os.path.isdir(store):
+        return None
+    export_dir = out_fname + "_patches"
+    if os.path.exists(export_dir):
+        shutil.rmtree(export_dir)
+    os.makedirs(export_dir)
+    group = zr.open_group(store, mode='r')
+    n_total = _sv_array(group).shape[1]
+    chunk_size = _sv_array(group).chunks[1]
+    patch_size = tuple(int(x) for x in patch_size)
+    if patch_size[0] > chunk_size:
+        print("WARNING: patches longer than a chunk (" + str(chunk_size) + " pings) can not be exported")
+        return None
+    with xr.open_zarr(store) as ds:
+        frequencies = ds.frequency.values.tolist()
+        ping_time = ds.ping_time.values
+    tasks = []
+    for c, p0 in enumerate(range(0, n_total, chunk_size)):
+        p1 = min(p0 + chunk_size, n_total)
+        shard_fname = export_dir + "/shard-%05d.tar" % c
+        tasks.append(dask.delayed(export_chunk)(store, shard_fname, p0, p1, ping_time[p0:p1], patch_size, max_per_category, c))
+    shards = [None] * len(tasks)
+    for i, entry in compute_as_completed(tasks):
+        shards[i] = entry
+    attrs = group["annotation"].attrs.asdict() if "annotation" in group else {}
+    manifest = {"patch_size": [len(frequencies)] + list(patch_size), "frequency": frequencies,
+                "categories": attrs.get("categories", []), "n_patches": sum(x["n_patches"] for x in shards), "shards": shards}
+    with open(export_dir + "/manifest.json", "w") as f:
+        json.dump(manifest, f, indent=1)
+    print("Exported " + str(manifest["n_patches"]) + " patches into " + str(len(shards)) + " shards")
+    return export_dir
+
+def read_calibration(calibration_fname):
+    # New calibration parameters, a JSON object keyed by frequency or channel ID, e.g.
+    # {"38000": {"gain": 26.5, "sa_correction": -0.65}}
+    with open(calibration_fname) as f:
+        return json.load(f)
+
+def recalibrate(out_fname, calibration):
+    """
+    Apply new calibration parameters (see read_calibration) to a zarr output written
+    with STORE_POWER, without reading the raw files. sv is not stored but computed
+    from the power and the calibration parameters when it is read, so only the
+    parameters of the channels (per ping) and the overview levels are rewritten.
+    """
+    store = out_fname + ".zarr"
+    if not os.path.isdir(store):
+        return None
+    group = zr.open_group(store)
+    if "power" not in group:
+        print("WARNING: " + store + " has no stored power (STORE_POWER), can not recalibrate")
+        return None
+    with xr.open_zarr(store) as ds:
+        frequency = ds.frequency.values
+        channel_id = ds.channel_id.values if "channel_id" in ds else [None] * len(frequency)
+    changed = []
+    for i, f in enumerate(frequency):
+        update = calibration.get(str(channel_id[i]), calibration.get("%g" % f, calibration.get(str(f))))
+        if not update:
+            continue
+        for name, value in update.items():
+            if name not in calibration_variables:
+                print("WARNING: unknown calibration parameter " + str(name) + ", ignored")
+                continue
+            group[name][i, :] = float(value)
+        changed.append(i)
+    if len(changed) == 0:
+        print("Nothing to recalibrate")
+        return None
+    # The overview levels are rebuilt from the new sv
+    if "pyramid" in group:
+        del group["pyramid"]
+        update_pyramid(store)
+    history = group.attrs.get("calibration_history", [])
+    history.append({"time": datetime.datetime.utcnow().isoformat(), "calibration": calibration})
+    group.attrs["calibration_history"] = history
+    zr.consolidate_metadata(store)
+    print("Recalibrated " + str(len(changed)) + " channel(s). Outputs derived from sv (e.g. nasc, regular, sv_depth) are not updated")
+    return store
+
+# Processing stages run on each processed raw file before it is written (see register_plugin)
+plugins = {}
+
+def register_plugin(name, function):
+    """
+    Register a processing stage under name. function(ds, context) receives the
+    dataset of each raw file after process_raw_file (or the cache) and before the
+    outputs, and returns it with any added variables. Side outputs are written by
+    the plugin itself. context is the plugin's PluginContext.
+    """
+    plugins[name] = function
+
+class PluginContext:
+    """
+    What a processing stage gets to know about the run: out_fname, main_frequency,
+    the raw file being processed, and state, a dict kept for the plugin across the
+    raw files (e.g. to carry partial windows over to the next file). outputs holds
+    the variables the plugin added (see run_plugins). seeding is True when the
+    plugin runs on a raw file only to rebuild its state (see reprocess_raw_files),
+    side outputs need not be written then.
+    """
+    def __init__(self, out_fname, main_frequency):
+        self.out_fname = out_fname
+        self.main_frequency = main_frequency
+        self.raw_fname = None
+        self.state = {}
+        self.outputs = None
+        self.seeding = False
+
+def _missing_value(dtype):
+    # Fill value of the variables of a failed plugin
+    if dtype.kind in "fc":
+        return np.nan
+    if dtype.kind in "mM":
+        return np.array("NaT", dtype = dtype)
+    return np.zeros((), dtype = dtype)
+
+def load_plugins(names):
+    # Resolve the plugin names, "module:function" entries are imported and registered
+    for name in names:
+        if name not in plugins and ":" in name:
+            module_name, function_name = name.split(":")
+            register_plugin(name, getattr(importlib.import_module(module_name), function_name))
+        if name not in plugins:
+            raise ValueError("Unknown plugin: " + str(name))
+    return names
+
+def run_plugins(ds, names, contexts):
+    """
+    Run the plugins in turn on the dataset of a raw file, returns it with the time
+    spent in each plugin. Each plugin gets a shallow copy of the dataset, so the
+    variables a failing plugin added before raising are dropped. When a plugin
+    fails, the variables it added to the previous raw files are added filled with
+    NaN (NaT, or 0 for integers), so that all the raw files have the same
+    variables. A plugin failing before it has succeeded once raises, and the raw
+    file is not written.
+    """
+    timing = {}
+    for name in names:
+        context = contexts[name]
+        start_time = time.perf_counter()
+        before = set(ds.variables)
+        try:
+            out = plugins[name](ds.copy(), context)
+            context.outputs = {var: (out[var].dims, out[var].dtype, {dim: out.sizes[dim] for dim in out[var].dims},
+                                     out[var].values if var in out.dims else None)
+                               for var in out.variables if var not in before}
+            ds = out
+        except Exception as e:
+            if context.outputs is None:
+                raise
+            print("ERROR: Plugin " + name + " failed on " + str(context.raw_fname) + " (" + str(e) + "), its variables are filled with NaN")
+            ds = ds.copy()
+            for var, (dims, dtype, sizes, values) in context.outputs.items():
+                if values is not None:
+                    ds = ds.assign_coords({var: (dims, values)})
+                else:
+                    shape = [ds.sizes.get(dim, sizes[dim]) for dim in dims]
+                    ds[var] = (dims, np.full(shape, _missing_value(dtype), dtype = dtype))
+        timing[name] = time.perf_counter() - start_time
+    return ds, timing
+
+def detect_bottom(sv, range_values, start, stop, threshold = -31.0, backstep = 20.0, peak_window = 1.0):
+    """
+    Threshold and backstep bottom detection, vectorized over the pings of sv
+    (ping_time, range, in dB). In each ping the first sample above threshold
+    between the range indices start and stop is taken, the peak within
+    peak_window (m) below it found, and the bottom is the shallowest sample of the
+    run of samples above the peak minus backstep (dB) leading to the peak.
+    Returns the range index of the bottom, -1 where none is found.
+    """
+    n_ping, n_range = sv.shape
+    index = np.arange(n_range)[None, :]
+    inside = (index >= start[:, None]) & (index < stop[:, None])
+    with np.errstate(invalid = 'ignore'):
+        above = inside & (sv >= threshold)
+    found = above.any(axis = 1)
+    first = np.argmax(above, axis = 1)
+
+    # Peak below the first sample over the threshold
+    step = np.median(np.diff(range_values))
+    window = np.minimum(first[:, None] + np.arange(max(1, int(round(peak_window / step))))[None, :], n_range - 1)
+    rows = np.arange(n_ping)[:, None]
+    peak = window[np.arange(n_ping), np.argmax(np.nan_to_num(sv[rows, window], nan = -np.inf), axis = 1)]
+    peak_sv = sv[np.arange(n_ping), peak]
+
+    # Step back towards the transducer while above peak - backstep
+    with np.errstate(invalid = 'ignore'):
+        below = ~(sv >= (peak_sv - backstep)[:, None]) & (index < peak[:, None])
+    last_below = n_range - 1 - np.argmax(below[:, ::-1], axis = 1)
+    bottom = np.where(below.any(axis = 1), last_below + 1, 0)
+    bottom = np.maximum(bottom, start)
+    return np.where(found, bottom, -1)
+
+def bottom_detection(ds, context, min_range = 10.0, margin = 5.0):
+    """
+    Processing stage adding bottom_depth (frequency, ping_time), depth below the
+    surface (range + transducer draft + heave) of the bottom. The bottom is
+    detected on the main channel below min_range (m), and on the other channels
+    within margin (m) of the main channel's bottom.
+    """
+    sv = ds.sv.values
+    range_values = ds.range.values
+    n_freq, n_ping, n_range = sv.shape
+    main = int(np.argmin(np.abs(ds.frequency.values - context.main_frequency)))
+    start = np.full(n_ping, np.searchsorted(range_values, min_range))
+    bottom = np.full((n_freq, n_ping), -1)
+    bottom[main] = detect_bottom(sv[main], range_values, start, np.full(n_ping, n_range))
+    step = np.median(np.diff(range_values))
+    found = bottom[main] >= 0
+    half = int(round(margin / step))
+    for i in range(n_freq):
+        if i != main:
+            bottom[i] = detect_bottom(sv[i], range_values, np.where(found, bottom[main] - half, n_range), np.where(found, bottom[main] + half, n_range))
+    shift = np.nan_to_num(ds.transducer_draft.values) + np.nan_to_num(ds.heave.values)[None, :]
+    depth = np.where(bottom >= 0, range_values[np.maximum(bottom, 0)] + shift, np.nan)
+    ds["bottom_depth"] = (["frequency", "ping_time"], depth)
+    ds["bottom_depth"].attrs = {"units": "m", "description": "Bottom depth below the surface, threshold and backstep detection"}
+    return ds
+
+register_plugin("bottom", bottom_detection)
+
+# Typical absorption in sea water (dB/m) for the TVG compensation of the noise estimation
+absorption_table = {18000: 0.0028, 38000: 0.0098, 70000: 0.022, 120000: 0.037, 200000: 0.052, 333000: 0.075}
+
+def absorption_coefficient(frequency):
+    # Absorption (dB/m), interpolated in log frequency from absorption_table
+    table_frequency = sorted(absorption_table)
+    return np.interp(np.log(frequency), np.log(table_frequency), [absorption_table[f] for f in table_frequency])
+
+def noise_estimation(ds, context, ping_window = 20, range_block = 5.0, snr_min = 3.0):
+    """
+    Processing stage estimating the background noise of each channel and adding
+    noise_level (frequency, ping_time), the noise in dB with the TVG removed (the
+    Sv it would have at 1 m), and sv_denoised, sv with the noise removed (NaN below
+    snr_min dB over the noise). The noise of a ping is the minimum, over the last
+    ping_window pings (carried over from the previous raw file), of the smallest
+    mean of the TVG compensated sv over range blocks of range_block (m).
+    """
+    sv = ds.sv.values
+    range_values = ds.range.values
+    n_freq, n_ping, n_range = sv.shape
+    step = np.median(np.diff(range_values))
+    alpha = absorption_coefficient(ds.frequency.values)
+    tvg = 20 * np.log10(np.maximum(range_values, step))[None, :] + 2 * alpha[:, None] * range_values[None, :]
+    tvg_linear = np.power(10, tvg / 10.0).astype('float32')
+    block = max(1, int(round(range_block / step)))
+    snr_linear = np.float32(10 ** (snr_min / 10.0))
+    tails = context.state.setdefault("tail", {})
+
+    # One channel at a time in float32, reusing the same buffers for the linear sv and the noise.
+    # Whole-array passes only (no masked writes, which are several times slower)
+    linear = np.empty((n_ping, n_range), dtype = 'float32')
+    work = np.empty((n_ping, n_range), dtype = 'float32')
+    denoised = np.empty(sv.shape, dtype = 'float32')
+    noise = np.full((n_freq, n_ping), np.nan)
+    starts = np.arange(0, n_range, block)
+    sizes = np.diff(np.append(starts, n_range))
+    for i, f in enumerate(ds.frequency.values):
+        np.multiply(sv[i], np.float32(np.log(10) / 10), out = linear, casting = 'unsafe')
+        np.exp(linear, out = linear)
+
+        # Smallest range block mean of the TVG compensated sv (linear domain) of each ping
+        np.multiply(linear, 1 / tvg_linear[i], out = work)
+        block_sum = np.add.reduceat(work, starts, axis = 1)
+        count = sizes[None, :]
+        if np.isnan(block_sum).any():
+            count = count - np.add.reduceat(np.isnan(work), starts, axis = 1, dtype = np.int32)
+            np.fmax(work, 0, out = work)
+            block_sum = np.add.reduceat(work, starts, axis = 1)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category = RuntimeWarning)
+            ping_min = np.nanmin(block_sum / count, axis = 1)
+
+            # Rolling minimum over the pings, continuing the window of the previous raw file
+            extended = np.concatenate([tails.get(float(f), np.full(ping_window - 1, np.nan)), ping_min])
+            noise[i] = np.nanmin(np.lib.stride_tricks.sliding_window_view(extended, ping_window), axis = 1)
+        tails[float(f)] = extended[len(extended) - (ping_window - 1):]
+
+        # Remove the noise, keeping the samples snr_min over it: linear - noise, plus 0 times
+        # the square root of its margin over (snr - 1) noise, which is NaN below the threshold
+        np.multiply(noise[i][:, None], tvg_linear[i][None, :], out = work, casting = 'unsafe')
+        np.subtract(linear, work, out = linear)
+        work *= snr_linear - 1
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            np.subtract(linear, work, out = work)
+            np.sqrt(work, out = work)
+            work *= 0
+            linear += work
+            out = denoised[i]
+            np.log10(linear, out = out)
+        out *= 10
+        no_noise = np.isnan(noise[i])
+        if no_noise.any():
+            out[no_noise] = sv[i][no_noise]
+    denoised = denoised.astype(sv.dtype, copy = False)
+    ds["sv_denoised"] = (["frequency", "ping_time", "range"], denoised)
+    with np.errstate(divide = 'ignore'):
+        ds["noise_level"] = (["frequency", "ping_time"], 10 * np.log10(noise))
+    ds["noise_level"].attrs = {"units": "dB", "description": "Background noise with the TVG removed (Sv of the noise at 1 m)"}
+    return ds
+
+register_plugin("noise", noise_estimation)
+
+output_sinks = {
+    "zarr": ZarrSink,
+    "netcdf4": NetCDFSink,
+    "netcdf4_perfile": PerFileNetCDFSink,
+    "ping_table": PingTableSink,
+    "nasc": NASCSink,
+    "regular": RegularSink
+}
+
+def raw_to_grid_multiple(dir_loc,  work_dir_loc, single_raw_file = 'nofile', main_frequency = 38000, write_output = False, out_fname = "", output_type = "zarr", overwrite = False, resume = False, max_reference_range = None, raw_view = None, raw_index_dir = None, cache_dir = None, cache_max_size = None, nav_dir = None, depth_grid = False, plugin_names = None, store_power = False):
+
+    # List files (plain or compressed)
+    raw_fname = list_raw_files(dir_loc)
     
     if single_raw_file != 'nofile':
         raw_fname=[]
@@ -802,7 +2928,7 @@ def raw_to_grid_multiple(dir_loc,  work_dir_loc, single_raw_file = 'nofile', mai
         reference_range = None
     elif max_reference_range == "auto":
         # Do a pass on all files and use a suitable range
-        reference_range = get_max_range_from_files(dir_loc, raw_fname, main_frequency)
+        reference_range = get_max_range_from_files(dir_loc, raw_fname, main_frequency, raw_view, raw_index_dir)
     elif isinstance(max_reference_range, (int, float, complex)) and not isinstance(max_reference_range, bool):
         print("Using " + str(max_reference_range) + " as the maximum range.")
         reference_range = max_reference_range
@@ -810,156 +2936,292 @@ def raw_to_grid_multiple(dir_loc,  work_dir_loc, single_raw_file = 'nofile', mai
         print("Invalid max_reference_range! Using the main_frequency channel's range on the first read file.")
         reference_range = None
 
-    # Prepare for writing output
-    target_fname = ""
-    if write_output == True:
-        # Construct target_fname
-        if out_fname == "":
-            out_fname = "out"
-        if output_type == "netcdf4":
-            target_fname = out_fname + ".nc"
-        elif output_type == "zarr":
-            target_fname = out_fname + ".zarr"
-        else:
-            print("Output type is not supported")
-            return None
-
-        # Check logic to proceed with write
-        is_exists = (os.path.isfile(target_fname) or os.path.isdir(target_fname))
+    if write_output == False:
+        # Nothing to do here
+        return None
 
-        # For overwriting
-        if is_exists == True: 
-            if overwrite == True:
-                # Delete existing files
-                if os.path.isfile(target_fname):
-                    os.remove(target_fname)
-                if os.path.isdir(target_fname):
-                    shutil.rmtree(target_fname)
-                do_write = True
-            elif resume == True:
-                # Resuming
-                write_first_loop = False
-                print("Trying to resume batch processing")
-                # Updating file list and using the reference range
-                if single_raw_file != 'nofile':
-                    reference_range = prepare_resume_singlefile(output_type, target_fname, raw_fname)
-                else:
-                    raw_fname, reference_range = prepare_resume(output_type, target_fname, raw_fname)
-                print("New list of files:")
-                print(raw_fname)
-                print("Reference range:")
-                print(reference_range)
-                do_write = True
-            else:
-                # All failed
-                print("Output data exists. Not overwriting nor resuming.")
-                do_write = False
-        else:
-            do_write = True
-            
-    else:
-        do_write = False
+    # Navigation and motion from the cruise-wide track (of all the raw files), if enabled
+    navigation = None
+    if nav_dir is not None:
+        build_navigation(dir_loc, list_raw_files(dir_loc), nav_dir, raw_index_dir)
+        navigation = load_navigation(nav_dir)
+
+    # Prepare the outputs, several output types can be given (a list or comma separated)
+    if out_fname == "":
+        out_fname = "out"
+
+    # Annotations of the .work files (if any), as their own stage
+    if os.path.isdir(work_dir_loc):
+        process_annotations(dir_loc, work_dir_loc, raw_fname, out_fname)
+
+    if isinstance(output_type, str):
+        output_type = [x.strip() for x in output_type.split(",")]
+    sinks = []
+    for otype in output_type:
+        if otype not in output_sinks:
+            print("Output type is not supported: " + str(otype))
+            return None
+        sink = output_sinks[otype](out_fname)
+        if sink.prepare(raw_fname, single_raw_file, overwrite, resume):
+            sinks.append(sink)
 
-    if do_write == False:
+    if len(sinks) == 0:
         # Nothing to do here
         return None
 
-    # Prepare parquet file path for work file data
-    pq_writer = None
-    pq_filepath = out_fname + "_work.parquet"
+    # Using the reference range (and depth axis) of a resumed output
+    reference_depth = None
+    for sink in sinks:
+        if sink.reference_range is not None:
+            reference_range = sink.reference_range
+            reference_depth = sink.reference_depth
+            break
 
-    # For handling new files
-    alternative_counter = 1
-    for fn in raw_fname:
-        # Get base name
-        base_fname, _ = os.path.splitext(fn)
+    # Only process the files that are still missing in one of the outputs
+    if any([sink.pending is not None for sink in sinks]):
+        raw_fname = [fn for fn in raw_fname if any([sink.wants(fn) for sink in sinks])]
+        print("New list of files:")
+        print(raw_fname)
 
-        # Process single file
-        ds = process_raw_file(dir_loc + "/" + fn, main_frequency, reference_range)
+    for sink in sinks:
+        sink.start()
 
-        # Continue on invalid data
-        if ds is None:
-            continue
+    # Motion and navigation records carried over to the next raw file
+    carry = CarryOver()
 
-        # Append version attributes
-        ds.attrs = dict(
-            name = "CRIMAC-preprocessor",
-            description="Multi-frequency sv values from EK.",
-            time = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
-            version = os.getenv('VERSION_NUMBER', __version__),
-            commit_sha = os.getenv('COMMIT_SHA', 'XXXXXXXX'),
-            pyecholab = get_pyecholab_rev()
-        )
-
-        # Process work file (if any)
-        work_fname = work_dir_loc + "/" + base_fname + ".work"
-        is_exists_work = os.path.isfile(work_fname)
-        if is_exists_work:
-            idx_fname = dir_loc + "/" + base_fname + ".idx"
-            is_exists_idx = os.path.isfile(idx_fname)
-            if is_exists_idx:
-                # Process work file
-                ann_obj = None
+    # Processing stages, each with its own context (and state carried across the raw files)
+    plugin_names = load_plugins(plugin_names if plugin_names is not None else [])
+    plugin_contexts = {name: PluginContext(out_fname, main_frequency) for name in plugin_names}
+    plugin_timing = {}
+
+    try:
+        for fn in raw_fname:
+            # Process single file (or reuse the processed dataset from the cache)
+            ds = None
+            if cache_dir is not None:
+                key = cache_key(dir_loc + "/" + fn, main_frequency, reference_range, raw_view, navigation is not None, depth_grid, store_power, carry, reference_depth)
+                ds = cache_load(cache_dir, key, carry)
+            if ds is None:
+                reset_peak_rss()
+                ds = process_raw_file(dir_loc + "/" + fn, main_frequency, reference_range, raw_view, raw_index_dir, carry, navigation, depth_grid, store_power, reference_depth)
+                report_peak_rss(fn)
+                if ds is not None and cache_dir is not None:
+                    cache_store(cache_dir, key, ds, cache_max_size, carry)
+
+            # Continue on invalid data
+            if ds is None:
+                continue
+
+            # Append version attributes
+            ds.attrs = dict(
+                name = "CRIMAC-preprocessor",
+                description="Multi-frequency sv values from EK.",
+                time = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+                version = os.getenv('VERSION_NUMBER', __version__),
+                commit_sha = os.getenv('COMMIT_SHA', 'XXXXXXXX'),
+                pyecholab = get_pyecholab_rev(),
+                file_table = ds.attrs["file_table"]
+            )
+
+            # Run the processing stages on the dataset in memory, like process_raw_file
+            # (plugins may use dask themselves)
+            if len(plugin_names) > 0:
+                for name in plugin_names:
+                    plugin_contexts[name].raw_fname = fn
                 try:
-                    work = readers.work_reader(work_fname)
-                    ann_obj = readers.work_to_annotation(work, idx_fname)
-                except:
-                    e = sys.exc_info()[0]
-                    print("ERROR: Something went wrong when reading the WORK file: " + str(work_fname)  + " (" + str(e) + ")")
-                    print(str(e))
-                if ann_obj is not None and ann_obj.df_ is not None:
-                    # Exclude layers for now (only schools and gaps)
-                    # df = ann_obj.df_[ann_obj.df_.priority != 3]
-                    
-                    # Layers schools and gaps
-                    df = ann_obj.df_
-                    pq_writer = append_to_parquet(df, pq_filepath, pq_writer)
-
-        if do_write == True:
-            if output_type == "netcdf4":
-                compressor = dict(zlib=True, complevel=5)
-                encoding = {var: compressor for var in ds.data_vars}
-                if write_first_loop == False:
-                    try:
-                        append_to_netcdf(target_fname, ds, unlimited_dims='ping_time')
-                    except ValueError:
-                        print("ERROR: Unable to append data from " + str(fn) + " to the existing NetCDF4 file. A new output will be created. Please check for channel mismatches!")
-                        target_fname = out_fname + "_" + str(alternative_counter) + ".nc"
-                        alternative_counter = alternative_counter + 1
-                        ds.to_netcdf(target_fname, mode="w", unlimited_dims=['ping_time'], encoding=encoding)
-                else:
-                    ds.to_netcdf(target_fname, mode="w", unlimited_dims=['ping_time'], encoding=encoding)
-                    # Propagate range to the rest of the files
-                    reference_range = ds.range
-            elif output_type == "zarr":
-                # Re-chunk so that we have a full range in a chunk (zarr only)
-                ds = ds.chunk({"frequency": 1, "range": ds.range.shape[0], "ping_time": 'auto'})
-                # Encode zarr output
-                compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
-                encoding = {var: {"compressor" : compressor} for var in ds.data_vars}
-                if write_first_loop == False:
-                    try:
-                        ds.to_zarr(target_fname, append_dim="ping_time")
-                    except ValueError:
-                        print("ERROR: Unable to append data from " + str(fn) + " to the existing Zarr file. A new output will be created. Please check for channel mismatches!")
-                        target_fname = out_fname + "_" + str(alternative_counter) + ".zarr"
-                        alternative_counter = alternative_counter + 1
-                        ds.to_zarr(target_fname, mode="w", encoding=encoding)
-                else:
-                    ds.to_zarr(target_fname, mode="w", encoding=encoding)
-                    # Propagate range to the rest of the files
-                    reference_range = ds.range
-            else:
-                print("Output type is not supported")
-
-            write_first_loop = False
-        #gc memory
-        print("gc.collect memory")
-        print(gc.get_count())
-        print(gc.collect())
-        print(gc.get_count())
+                    ds, timing = run_plugins(ds, plugin_names, plugin_contexts)
+                except Exception as e:
+                    print("ERROR: Plugin failed on " + str(fn) + " (" + str(e) + "), the raw file is not written")
+                    continue
+                print("Plugins on " + str(fn) + ": " + ", ".join([name + " %.2f s" % timing[name] for name in plugin_names]))
+                for name in plugin_names:
+                    plugin_timing[name] = plugin_timing.get(name, 0.0) + timing[name]
+
+            # Hand the dataset to the writers of the outputs still missing this file
+            for sink in sinks:
+                if sink.wants(fn):
+                    sink.submit(ds, fn)
+
+            # Propagate range (and depth axis) to the rest of the files
+            reference_range = ds.range
+            if "depth" in ds.coords:
+                reference_depth = ds.depth.values
+
+            #gc memory
+            del ds
+            print("gc.collect memory")
+            print(gc.get_count())
+            print(gc.collect())
+            print(gc.get_count())
+    finally:
+        for sink in sinks:
+            sink.close()
+    for name in plugin_names:
+        print("Plugin " + name + " took " + "%.1f" % plugin_timing.get(name, 0.0) + " s in total")
     return True
 
+def shift_pings(group, start, shift):
+    """
+    Move the pings [start, end) of every ping_time array of a zarr store by shift
+    pings (resizing the arrays), one chunk at a time so that only the chunks from
+    start on are rewritten.
+    """
+    for name, array in group.arrays():
+        dims = array.attrs.get("_ARRAY_DIMENSIONS", [])
+        if "ping_time" not in dims:
+            continue
+        axis = dims.index("ping_time")
+        n = array.shape[axis]
+        step = array.chunks[axis]
+        index = lambda a, b: tuple(slice(a, b) if i == axis else slice(None) for i in range(array.ndim))
+        shape = list(array.shape)
+        shape[axis] = n + shift
+        if shift > 0:
+            # Grow first and move from the end backwards
+            array.resize(*shape)
+            for b in range(n, start, -step):
+                a = max(b - step, start)
+                array[index(a + shift, b + shift)] = array[index(a, b)]
+        elif shift < 0:
+            for a in range(start, n, step):
+                b = min(a + step, n)
+                array[index(a + shift, b + shift)] = array[index(a, b)]
+            array.resize(*shape)
+
+def seed_state(dir_loc, fn, main_frequency, reference_range, raw_view, raw_index_dir, carry, navigation, depth_grid, store_power, plugin_names, contexts, reference_depth = None):
+    # Process the raw file before a reprocessed one without writing it, to fill the carry-over and plugin state
+    print("Processing " + str(fn) + " to seed the carry-over and plugin state")
+    ds = None
+    if os.path.isfile(dir_loc + "/" + fn):
+        ds = process_raw_file(dir_loc + "/" + fn, main_frequency, reference_range, raw_view, raw_index_dir, carry, navigation, depth_grid, store_power, reference_depth)
+    if ds is None:
+        print("WARNING: Unable to process " + str(fn) + ", the next raw file is reprocessed without its carry-over and plugin state")
+        return
+    if len(plugin_names) > 0:
+        for name in plugin_names:
+            contexts[name].raw_fname = fn
+            contexts[name].seeding = True
+        try:
+            run_plugins(ds, plugin_names, contexts)
+        except Exception as e:
+            print("WARNING: Plugin failed on " + str(fn) + " (" + str(e) + "), the next raw file is reprocessed without its plugin state")
+        for name in plugin_names:
+            contexts[name].seeding = False
+
+def reprocess_raw_files(dir_loc, raw_files, out_fname, main_frequency = 38000, raw_view = None, raw_index_dir = None, nav_dir = None, depth_grid = False, plugin_names = None, store_power = False):
+    """
+    Reprocess raw files that are already in the zarr output (e.g. a bad or replaced
+    file) and write them back into their ping slices (from the file table) with
+    region writes. When the number of pings of a file changed, the pings after it
+    are moved, so only the chunks from that file on are rewritten. The file table,
+    chunk index, overview levels and annotation masks are brought up to date, the
+    other output types are not. The motion and navigation carry-over and the plugin
+    state are seeded by processing the preceding raw file of the cruise (not
+    written), or taken over from it when it was reprocessed too; plugin state
+    spanning more than one raw file is only rebuilt from the preceding one.
+    """
+    store = out_fname + ".zarr"
+    if not os.path.isdir(store):
+        print("No zarr output " + store + " to reprocess")
+        return None
+    group = zr.open_group(store)
+    file_table = group.attrs.get("file_table", [])
+    names = [entry["name"] for entry in file_table]
+    with xr.open_zarr(store) as ds_store:
+        reference_range = ds_store.range.load()
+        reference_depth = ds_store.depth.values if "sv_depth" in ds_store else None
+        store_vars = set(v for v in ds_store.variables if "ping_time" in ds_store[v].dims)
+
+    navigation = None
+    if nav_dir is not None:
+        build_navigation(dir_loc, list_raw_files(dir_loc), nav_dir, raw_index_dir)
+        navigation = load_navigation(nav_dir)
+    plugin_names = load_plugins(plugin_names if plugin_names is not None else [])
+
+    first_ping = None
+    n_done = 0
+    previous = None
+    for fn in sorted(raw_files, key = lambda x: names.index(x) if x in names else -1):
+        if fn not in names:
+            print(str(fn) + " is not in " + store + ", not reprocessed")
+            continue
+        k = names.index(fn)
+        if previous != k - 1:
+            carry = CarryOver()
+            contexts = {name: PluginContext(out_fname, main_frequency) for name in plugin_names}
+            if k > 0:
+                seed_state(dir_loc, names[k - 1], main_frequency, reference_range, raw_view, raw_index_dir, carry, navigation, depth_grid, store_power, plugin_names, contexts, reference_depth)
+        previous = None
+        ds = process_raw_file(dir_loc + "/" + fn, main_frequency, reference_range, raw_view, raw_index_dir, carry, navigation, depth_grid, store_power, reference_depth)
+        if ds is None:
+            print("Unable to reprocess " + str(fn) + ", the store is unchanged for this file")
+            continue
+        if len(plugin_names) > 0:
+            for name in plugin_names:
+                contexts[name].raw_fname = fn
+            try:
+                ds = run_plugins(ds, plugin_names, contexts)[0]
+            except Exception as e:
+                print("ERROR: Plugin failed on " + str(fn) + " (" + str(e) + "), the store is unchanged for this file")
+                continue
+        previous = k
+        # (sv is not stored with the power)
+        ping_vars = set(v for v in ds.variables if "ping_time" in ds[v].dims and not (v == "sv" and "power" in ds))
+        if ping_vars != store_vars:
+            print("WARNING: variables of " + str(fn) + " differ from the store, not written: " + str(sorted(ping_vars - store_vars)) + ", left as they were: " + str(sorted(store_vars - ping_vars)))
+
+        entry = file_table[k]
+        a = entry["ping_start"]
+        b = entry["ping_stop"]
+        n_new = len(ds.ping_time)
+        if n_new != b - a:
+            print("Number of pings of " + str(fn) + " changed from " + str(b - a) + " to " + str(n_new) + ", moving the pings after it")
+            shift_pings(group, b, n_new - (b - a))
+            for other in file_table:
+                if other["ping_start"] >= b:
+                    other["ping_start"] = other["ping_start"] + n_new - (b - a)
+                    other["ping_stop"] = other["ping_stop"] + n_new - (b - a)
+            # xarray reads the array shapes from the consolidated metadata
+            zr.consolidate_metadata(store)
+
+        # Variables without a ping_time dimension (e.g. channel_id) are already in the store
+        region = ds.assign_coords(file_index = ds.file_index + k)
+        region = region.drop_vars([v for v in region.variables if v not in (ping_vars & store_vars)])
+        region.attrs = {}
+        region.to_zarr(store, region = {"ping_time": slice(a, a + n_new)})
+        # xarray does not write index coordinates in region writes, encode ping_time like the store
+        ping_time = group["ping_time"]
+        values, _, _ = xr.coding.times.encode_cf_datetime(ds.ping_time.values, ping_time.attrs["units"], ping_time.attrs.get("calendar"))
+        ping_time[a:a + n_new] = values
+
+        range_extent = valid_range_extent(ds)
+        file_table[k] = dict(get_file_table(ds)[0], ping_start = a, ping_stop = a + n_new,
+                             range_max = _json_list(np.nanmax(range_extent, axis=1, initial=-np.inf)))
+        first_ping = a if first_ping is None else min(first_ping, a)
+        n_done = n_done + 1
+        print("Reprocessed " + str(fn) + " into pings " + str(a) + " to " + str(a + n_new))
+        del ds, region
+
+    if first_ping is None:
+        return None
+    group.attrs["file_table"] = file_table
+    group.attrs["chunk_index"] = build_chunk_index(store)
+    # Overview levels from the first changed ping on
+    if "pyramid" in group:
+        group["pyramid"].attrs["n_pings"] = min(first_ping, group["pyramid"].attrs.get("n_pings", 0))
+        update_pyramid(store)
+    # Annotation masks of the changed chunks (their hashes are dropped so that they are rewritten)
+    chunk_size = _sv_array(group).chunks[1]
+    if "annotation" in group:
+        chunk_hashes = group["annotation"].attrs.get("chunk_hashes", {})
+        n_chunks = (_sv_array(group).shape[1] + chunk_size - 1) // chunk_size
+        chunk_hashes.update({str(c): None for c in range(first_ping // chunk_size, n_chunks)})
+        group["annotation"].attrs["chunk_hashes"] = chunk_hashes
+        rasterize_annotations(out_fname)
+    zr.consolidate_metadata(store)
+    print("Reprocessed " + str(n_done) + " raw file(s) in " + store + ", chunks from " + str(first_ping // chunk_size) + " on were rewritten. Other outputs (e.g. netcdf4, nasc, regular) are not updated")
+    return store
+
 def get_pyecholab_rev():
     reqs = subprocess.check_output([sys.executable, '-m', 'pip', 'freeze'])
     for line in reqs.decode().split("\n"):
@@ -979,6 +3241,18 @@ def rechunk_output(output, output_dir):
     # Open the files
     alldata = [xr.open_zarr(x) for x in outputs]
 
+    # Merge the file tables, offsetting the ping ranges and file indices of the later outputs
+    file_table = []
+    ping_offset = 0
+    for i, x in enumerate(alldata):
+        if "file_table" not in x.attrs:
+            file_table = None
+            break
+        alldata[i] = x.assign_coords(file_index = x.file_index + len(file_table))
+        file_table = file_table + [dict(entry, ping_start = entry["ping_start"] + ping_offset,
+                                        ping_stop = entry["ping_stop"] + ping_offset) for entry in x.attrs["file_table"]]
+        ping_offset = ping_offset + len(x.ping_time)
+
     # Combine if more than one
     if len(outputs) > 1:
         combined = xr.combine_nested(alldata, concat_dim=['ping_time'], combine_attrs = "override")
@@ -986,7 +3260,7 @@ def rechunk_output(output, output_dir):
         combined = alldata[0]
 
     # Get the optimal chunk size
-    tmp = combined.sv.chunk({'frequency' : 1, 'ping_time': 'auto', 'range' : -1})
+    tmp = combined["sv" if "sv" in combined else "power"].chunk({'frequency' : 1, 'ping_time': 'auto', 'range' : -1})
     chunk_size = {}
     for i in [0, 1, 2]:
         chunk_size[tmp.coords.dims[i]] = tmp.chunks[i][0]
@@ -997,10 +3271,11 @@ def rechunk_output(output, output_dir):
     # Prepare encoding and chunks parameters for rechunking
     compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
     encoding = {var: {"compressor" : compressor} for var in combined.data_vars}
-    newchunks = {var: {xi: chunk_size[xi] for xi in combined[var].coords.dims} for var in combined.data_vars}
+    # (dimensions other than those of sv, e.g. depth, are kept in a single chunk)
+    newchunks = {var: {xi: chunk_size.get(xi, combined.sizes[xi]) for xi in combined[var].coords.dims} for var in combined.data_vars}
 
     # Need to unify chunk first
-    combined2 = combined.chunk(newchunks['sv'])
+    combined2 = combined.chunk(newchunks["sv" if "sv" in combined else "power"])
 
     # Needed because a bug in rechunk-xarray
     for var in combined2.variables:
@@ -1018,9 +3293,21 @@ def rechunk_output(output, output_dir):
     # Cleaning up things
     shutil.move(output + ".zarr", output + "_0.zarr")
     shutil.move(combined_file, output + ".zarr")
+    if len(outputs) == 1 and os.path.isdir(output + "_0.zarr/pyramid"):
+        shutil.move(output + "_0.zarr/pyramid", output + ".zarr/pyramid")
     shutil.rmtree(tmp_file)
     [shutil.rmtree(fil) for fil in glob.glob(output + "_*.zarr")]
 
+    # The chunks have changed, rebuild the chunk index
+    group = zr.open_group(output + ".zarr")
+    if file_table is not None:
+        group.attrs["file_table"] = file_table
+    group.attrs["chunk_index"] = build_chunk_index(output + ".zarr")
+    # The overview levels of the other outputs are not combined, rebuild them
+    if len(outputs) > 1:
+        update_pyramid(output + ".zarr")
+    zr.consolidate_metadata(output + ".zarr")
+
 if __name__ == '__main__':
     # Default input raw dir
     raw_dir = os.path.expanduser("/datain")
@@ -1028,8 +3315,20 @@ if __name__ == '__main__':
     # Default input work dir
     work_dir = os.path.expanduser("/workin")
 
-    # Get the output type
+    # Get the output type(s), comma separated (e.g. zarr,netcdf4)
     out_type = os.getenv('OUTPUT_TYPE', 'zarr')
+    out_types = [x.strip() for x in out_type.split(",")]
+
+    # Echo integration cell size for the nasc output, sailed distance (nmi) and depth (m)
+    nasc_cell = os.getenv('NASC_CELL', None)
+    if nasc_cell is not None:
+        NASCSink.distance_step, NASCSink.depth_step = [float(x) for x in nasc_cell.split(",")]
+
+    # Regular axis for the regular output, ping_time (step in seconds) or distance (step in nmi)
+    regular_grid = os.getenv('REGULAR_GRID', None)
+    if regular_grid is not None:
+        RegularSink.axis, step = regular_grid.split(",")
+        RegularSink.step = float(step)
     
     # raw_file for processing single files
     raw_file = os.getenv('RAW_FILE', 'nofile')
@@ -1037,6 +3336,23 @@ if __name__ == '__main__':
     # Get the output name
     out_name = os.path.expanduser("/dataout") + '/' + os.getenv('OUTPUT_NAME', 'out')
 
+    # Processing mode, "all" (raw data and annotations), "annotation" (only bring
+    # the annotations up to date with the .work files), "recalibrate" (apply the
+    # CALIBRATION_FILE to a zarr output written with STORE_POWER) or "reprocess"
+    # (rewrite the RAW_FILES in place in the zarr output)
+    processing_mode = os.getenv('PROCESSING_MODE', 'all')
+    if processing_mode == "annotation":
+        raw_fname = list_raw_files(raw_dir) if raw_file == 'nofile' else [raw_file]
+        process_annotations(raw_dir, work_dir, raw_fname, out_name)
+        rasterize_annotations(out_name)
+        sys.exit(0)
+    if processing_mode == "recalibrate":
+        # Apply the calibration in CALIBRATION_FILE to the sv of the zarr output
+        client = Client(processes=False)
+        recalibrate(out_name, read_calibration(os.getenv('CALIBRATION_FILE')))
+        client.close()
+        sys.exit(0)
+
     # Get the range determination type (numeric, 'auto', or None)
     # A numeric type will force the range steps to be equal to the specified number
     # 'auto' will force the range steps to be equal to the maximum range steps of all the processed files
@@ -1066,6 +3382,38 @@ if __name__ == '__main__':
     else:
         do_plot = False
 
+    # Select a virtual split of EK80 files (CW, FM or a channel ID), e.g. to
+    # only process the CW channels of mixed CW/FM files
+    raw_view = os.getenv('RAW_VIEW', 'None')
+    if raw_view == 'None' or raw_view == '':
+        raw_view = None
+
+    # Where to keep the datagram index sidecars (.rawidx), default is next to the raw files
+    raw_index_dir = os.getenv('RAW_INDEX_DIR', None)
+    if raw_index_dir is not None:
+        os.makedirs(raw_index_dir, exist_ok=True)
+
+    # Optional cache of the processed datasets per raw file, with its maximum size in GB
+    cache_dir = os.getenv('CACHE_DIR', None)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    cache_max_size = os.getenv('CACHE_MAX_SIZE', None)
+    if cache_max_size is not None:
+        cache_max_size = float(cache_max_size) * 1e9
+
+    # Optional cruise-wide navigation track (positions, speed, distance and motion)
+    nav_dir = os.getenv('NAV_DIR', None)
+
+    # Optional depth referenced sv (sv_depth), shifted by the transducer draft and heave
+    depth_grid = os.getenv('DEPTH_GRID', '0') == '1'
+
+    # Store the received power and calibration terms, to recalibrate sv without the raw files
+    store_power = os.getenv('STORE_POWER', '0') == '1'
+
+    # Processing stages run on each raw file before writing, comma separated
+    # (registered names or "module:function")
+    plugin_names = [x.strip() for x in os.getenv('PLUGINS', '').split(",") if x.strip() != '']
+
     # If number of workers is specified
     n_workers = int(os.getenv('N_WORKERS', '2'))
 
@@ -1084,6 +3432,21 @@ if __name__ == '__main__':
                 memory_limit=str(mem_use))
     print(client)
 
+    # Reprocess the raw files in RAW_FILES (comma separated) in place in the zarr output
+    if processing_mode == "reprocess":
+        reprocess_raw_files(raw_dir, [x.strip() for x in os.getenv('RAW_FILES', raw_file).split(",") if x.strip() != ''], out_name,
+                            main_frequency = main_freq,
+                            raw_view = raw_view,
+                            raw_index_dir = raw_index_dir,
+                            nav_dir = nav_dir,
+                            depth_grid = depth_grid,
+                            plugin_names = plugin_names,
+                            store_power = store_power)
+        client.close()
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        sys.exit(0)
+
     # Do process
     status = raw_to_grid_multiple(raw_dir,
                             work_dir_loc = work_dir,
@@ -1094,7 +3457,15 @@ if __name__ == '__main__':
                             output_type = out_type,
                             overwrite = False,
                             resume = True,
-                            max_reference_range = max_ref_ran)
+                            max_reference_range = max_ref_ran,
+                            raw_view = raw_view,
+                            raw_index_dir = raw_index_dir,
+                            cache_dir = cache_dir,
+                            cache_max_size = cache_max_size,
+                            nav_dir = nav_dir,
+                            depth_grid = depth_grid,
+                            plugin_names = plugin_names,
+                            store_power = store_power)
 
     # Cleaning up Dask
     client.close()
@@ -1104,18 +3475,28 @@ if __name__ == '__main__':
     # Do post-processing #
 
     # Post processing: rechunk Zarr files
-    if status is True and out_type == "zarr":
+    if status is True and "zarr" in out_types:
         rechunk_output(out_name, os.path.expanduser("./dataout"))
 
+    # Post processing: rasterize the annotations onto the Zarr grid
+    if status is True and "zarr" in out_types:
+        rasterize_annotations(out_name)
+
+    # Post processing: export training patches, e.g. PATCH_SIZE=256,256 (pings, range samples)
+    patch_size = os.getenv('PATCH_SIZE', None)
+    if status is True and "zarr" in out_types and patch_size is not None:
+        max_per_category = os.getenv('PATCH_MAX_PER_CATEGORY', None)
+        export_patches(out_name, [int(x) for x in patch_size.split(",")], None if max_per_category is None else int(max_per_category))
+
     # Post-processing: appending a unique ID and pyecholab rev
     if status is True:
-        if out_type == "netcdf4":
+        if "netcdf4" in out_types:
             ds = xr.open_dataset(out_name + ".nc")
             ds_id = dask.base.tokenize(ds)
             ds.close()
             with netCDF4.Dataset(out_name + ".nc", mode='a') as nc:
                 nc.id = ds_id
-        else:
+        if "zarr" in out_types:
             ds = xr.open_zarr(out_name + ".zarr")
             ds_id = dask.base.tokenize(ds)
             ds.close()
@@ -1124,10 +3505,11 @@ if __name__ == '__main__':
             print(zro_attrs)
             zro_attrs["id"] = ds_id
             zro.attrs.put(zro_attrs)
+            zr.consolidate_metadata(out_name + ".zarr")
 
     if status == True and do_plot == True:
-        if out_type == "netcdf4":
-            ds = xr.open_dataset(out_name + ".nc")
+        if "zarr" in out_types:
+            ds = open_overview(out_name + ".zarr")
         else:
-            ds = xr.open_zarr(out_name + ".zarr", chunks={'ping_time':'auto'})
+            ds = xr.open_dataset(out_name + ".nc")
         plot_all(ds, out_name)
@@ -25,15 +25,57 @@ __version__ = 0.9
 
 
 from io import BufferedWriter
+import bz2
+import gzip
 import logging
 import os
+import shutil
 import sys
+import tempfile
 import struct as struct
 import traceback
 from collections import namedtuple
 from xml.dom.minidom import parseString
 
 from numpy import byte
+import numpy as np
+
+try:
+    import pyzstd
+except ImportError:
+    pyzstd = None
+
+#Compressed .raw files that can be read directly (streaming decompression)
+compressed_suffixes = ('.gz', '.bz2', '.zst')
+
+def is_compressed(filename):
+    return filename.endswith(compressed_suffixes)
+
+#Returns the file name without the compression suffix
+def raw_basename(filename):
+    for suffix in compressed_suffixes:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return filename
+
+#Opens a (possibly compressed) .raw file as a binary stream. Seeking in gzip and
+#bz2 streams decompresses up to the target, zstd files written in the seekable
+#format (multiple frames and a seek table) can be seeked cheaply. buffering is the
+#buffer size of uncompressed files.
+def open_raw(filename, buffering=-1):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    elif filename.endswith('.bz2'):
+        return bz2.open(filename, 'rb')
+    elif filename.endswith('.zst'):
+        if pyzstd is None:
+            raise ImportError("pyzstd is needed to read " + str(filename))
+        try:
+            return pyzstd.SeekableZstdFile(filename, 'r')
+        except pyzstd.SeekableFormatError:
+            return pyzstd.ZstdFile(filename, 'rb')
+    else:
+        return open(filename, 'rb', buffering=buffering)
     
 # Return full datagram as tuple (head,data) or None
 def get_dg(inp_fp):
@@ -53,13 +95,20 @@ def get_dg(inp_fp):
 
 # Used to iterate over datagrams for convenience 
 # Could speed up by using em_read_head instead of get_dg
-def get_dgs_generator(inp_fp, match_types = None):
+# If noskip_types is given, only these datagram types are fully read and the
+# payload of the others is skipped (the tuple then only holds the 8 header bytes)
+def get_dgs_generator(inp_fp, match_types = None, noskip_types = None):
     if not inp_fp:
         return 
     
     while True:
         try:
-            dg = get_dg(inp_fp)
+            if noskip_types is None:
+                dg = get_dg(inp_fp)
+            else:
+                dg = ek_read_head(inp_fp, noskip_types = noskip_types)
+                if not dg:
+                    dg = None
         except Exception as e:
             logging.exception(e)
             dg = None
@@ -84,7 +133,8 @@ def ek_read_head(stream, noskip_types=[], force_full_read=False):
     remaining_bytes = Head.DgLength - struct.calcsize(ekDatagram.headDesc)
     data = b''
     if not force_full_read and (Head.DgType not in noskip_types) and stream.seekable():
-        stream.seek(remaining_bytes, 1)
+        # Skip the rest of the payload and the trailing length field
+        stream.seek(remaining_bytes + 8, 1)
     else:
         data = stream.read(remaining_bytes + 8)
         if len(data) != remaining_bytes + 8:
@@ -104,9 +154,9 @@ def ek_read_dg(stream, skip=False):
     
 #Adjust the initial parameters to remove unwanted channels.
 #Reads the header, parses the xml, finds the undesired channels and returns the new datagram.
-def adjustInitialParameters(dg, mode, channelsRemoved):
+def adjustInitialParameters(dg, mode, channelsRemoved, dump_xml=True):
     #subtract header
-    data = struct.unpack_from('llll', dg)
+    data = struct.unpack_from('=llll', dg)
     length = data[0]
     xml = dg[16:-4]
     
@@ -133,11 +183,12 @@ def adjustInitialParameters(dg, mode, channelsRemoved):
         newInitial = bytearray(encodedString)
         newLength = 12+len(newInitial)  #padding bytes?
         #create datagram (take care of length)
-        header = struct.pack('llll',newLength, data[1], data[2], data[3])
-        footer = struct.pack('l',newLength)
+        header = struct.pack('=llll',newLength, data[1], data[2], data[3])
+        footer = struct.pack('=l',newLength)
         newDg = header + newInitial + footer
-        last = open("lastinitial.xml", "w")
-        last.write(str(newDg));
+        if dump_xml:
+            last = open("lastinitial.xml", "w")
+            last.write(str(newDg));
         return bytearray(newDg)       
     except Exception as e:
         print("could not parse initalParameters for channels, inspect inital.xml for clues")
@@ -150,9 +201,9 @@ def adjustInitialParameters(dg, mode, channelsRemoved):
 
 #Adjust the configuration parameters to remove unwanted channels.
 #Reads the header, parses the xml, finds the undesired channels and returns the new datagram.
-def adjustConfig(dg, channelIdsToRemove, postfix):
+def adjustConfig(dg, channelIdsToRemove, postfix, dump_xml=True):
     #subtract header
-    data = struct.unpack_from('llll', dg)
+    data = struct.unpack_from('=llll', dg)
     xml = dg[16:-4]
     
     #open xml
@@ -176,11 +227,12 @@ def adjustConfig(dg, channelIdsToRemove, postfix):
         newInitial = bytearray(encodedString)
         newLength = 12+len(newInitial)  #padding bytes?
         #create datagram (take care of length)
-        header = struct.pack('llll',newLength, data[1], data[2], data[3])
-        footer = struct.pack('l',newLength)
+        header = struct.pack('=llll',newLength, data[1], data[2], data[3])
+        footer = struct.pack('=l',newLength)
         newDg = header + newInitial + footer
-        last = open("lastConfig" + postfix+ ".xml", "w")
-        last.write(str(newDg));
+        if dump_xml:
+            last = open("lastConfig" + postfix+ ".xml", "w")
+            last.write(str(newDg));
         return bytearray(newDg)        
     except Exception as e:
         print("could not parse config for channels, inspect config.xml for clues")
@@ -241,7 +293,7 @@ def extract_channel(dg):
         print(str(dg))
         config.write(dgStr);
         config.close()
-        exit()
+        raise ValueError("could not parse the channel of the parameter datagram") from e
     return channel
 
 
@@ -266,7 +318,7 @@ def extract_filter_channel(dg):
         print(str(dg))
         config.write(dgStr);
         config.close()
-        exit()
+        raise ValueError("could not parse the channel of the filter datagram") from e
     return ""
 
 #Parses the XML and descides what type of xml this is, config, init, environment etc.
@@ -377,88 +429,281 @@ class ekDatagram:
             print("Called in a depricated way.")
 
 
-# Set initial starting values
-size = 1000000
-sizeMultiplier = 1000000
-
-splitOnChannel = False
-splitOnSize = False
-splitOnMode = False
-
-
-#Validate arguments
-if(len(sys.argv) > 2):
-    splittype = sys.argv[2]
-    if(splittype == '-h'):
-        print("Usage EK80Splitter.py [raw file] [mode] [param]")
-        print("eg py EK80Splitter.py input.raw size 100")
-        print("eg py EK80Splitter.py input.raw mode")
-        print("available split modes is size [inputsize in MB], mode or channel")
-        exit()
-    if(splittype == "channel"):
-        splitOnChannel = True
-    elif(splittype == "size"):
-        splitOnSize = True
-        if(len(sys.argv) > 3):
-            size = int(sys.argv[3]) * sizeMultiplier
-            print("split size " + str(size))
-    elif(splittype == "mode"):
-            splitOnMode = True     
-else:
-    print("Usage EK80Splitter.py [raw file] [mode] [param]")
-    print("eg py EK80Splitter.py input.raw size 100")
-    print("eg py EK80Splitter.py input.raw mode")
-    print("available split modes is size [inputsize in MB], mode or channel")
-    
-#TODO, create argument library or split to separate file.
-filename = sys.argv[1];
-baseName = os.path.splitext(filename)[0]
-print('Splitting ' + str(filename))
-            
-if(splitOnChannel):
-    print("Splitting on channel");
+#Datagram index of a .raw file, stored as a sidecar (.rawidx) next to the raw file.
+#One record per datagram: type, channel (index into the channel table, -1 for
+#datagrams not belonging to a channel), XML0 kind (see index_modes), frequency,
+#ping time, byte offset and length (including the length fields) and sample count.
+index_dtype = np.dtype([('dg_type', 'S4'),
+                        ('channel', 'i2'),
+                        ('mode', 'i1'),
+                        ('frequency', 'f4'),
+                        ('ping_time', 'M8[ns]'),
+                        ('offset', 'i8'),
+                        ('length', 'i4'),
+                        ('count', 'i4')])
+index_modes = ['', 'CW', 'FM', 'Config', 'Initial', 'Environment', 'Sensor', 'Ping']
+index_suffix = '.rawidx'
+#Bumped when the index content changes, older sidecars are rebuilt
+index_version = 2
+
+#Bytes (after the length field) needed to index each datagram type
+index_peek = {b'RAW3': 148, b'RAW4': 148, b'RAW0': 80, b'FIL1': 140}
+#Read buffer of the header scan, small so that the skipped datagrams are not read
+index_buffering = 256
+
+#NT time (100 ns since 1601) to datetime64[ns]
+def nt_to_datetime64(low, high):
+    ntTime = (high << 32) + low
+    if ntTime < 116444736000000000:
+        return np.datetime64('NaT', 'ns')
+    return np.datetime64((ntTime - 116444736000000000) * 100, 'ns')
+
+#Returns the sidecar index path of a .raw file (in index_dir if given)
+def raw_index_path(filename, index_dir=None):
+    baseName = os.path.basename(filename)
+    if baseName.endswith('.raw'):
+        baseName = baseName[:-4]
+    if index_dir is None:
+        index_dir = os.path.dirname(filename)
+    return os.path.join(index_dir, baseName + index_suffix)
+
+#Scans the datagram headers of a .raw file and returns (index, channels)
+def build_raw_index(filename):
+    records = []
+    channels = []
+    channelFrequency = {}
+    ek60Channels = []
 
-if(splitOnSize):
-    print("Splitting on size")
-    
-if(splitOnMode):
-    print("Splitting on mode")
+    def channel_number(channelId):
+        if channelId not in channels:
+            channels.append(channelId)
+        return channels.index(channelId)
 
-#Handle the input .raw file, given the arguments.
-with open(filename, 'rb') as dg_file:
-        filecounter = 0
+    with open_raw(filename, index_buffering) as dg_file:
+        offset = 0
+        while True:
+            buff = dg_file.read(8)
+            if len(buff) < 8:
+                break
+            dgLength, dgType = struct.unpack('<l4s', buff)
+            if dgType in index_peek:
+                peek = dg_file.read(min(index_peek[dgType], dgLength - 4))
+            elif dgType in (b'XML0', b'CON0'):
+                peek = dg_file.read(dgLength - 4)
+            else:
+                peek = dg_file.read(8)
+            if len(peek) < 8:
+                break
+            dg_file.seek(dgLength - 4 - len(peek) + 4, 1)
+
+            low, high = struct.unpack_from('<LL', peek, 0)
+            channel = -1
+            mode = 0
+            frequency = np.nan
+            count = 0
+            if dgType == b'XML0':
+                separator = extract_separator(buff + peek)
+                if separator[1] in index_modes:
+                    mode = index_modes.index(separator[1])
+                if separator[1] in ('CW', 'FM'):
+                    channelId = extract_channel(buff + peek)
+                    channel = channel_number(channelId)
+                    frequency = float(separator[0])
+                    channelFrequency[channel] = frequency
+            elif dgType == b'RAW3' or dgType == b'RAW4':
+                channel = channel_number(peek[8:136].rstrip(b'\x00').decode('latin-1'))
+                frequency = channelFrequency.get(channel, np.nan)
+                count = struct.unpack_from('<l', peek, 144)[0]
+            elif dgType == b'RAW0':
+                number, = struct.unpack_from('<h', peek, 8)
+                if 0 < number <= len(ek60Channels):
+                    channelId = ek60Channels[number - 1]
+                else:
+                    channelId = str(number)
+                channel = channel_number(channelId)
+                frequency = struct.unpack_from('<f', peek, 16)[0]
+                count = struct.unpack_from('<l', peek, 76)[0]
+            elif dgType == b'FIL1':
+                channel = channel_number(peek[12:140].rstrip(b'\x00').decode('latin-1'))
+            elif dgType == b'CON0':
+                transceiverCount, = struct.unpack_from('<l', peek, 520)
+                for i in range(transceiverCount):
+                    start = 524 + i * 320
+                    ek60Channels.append(peek[start:start + 128].rstrip(b'\x00').decode('latin-1'))
+
+            records.append((dgType, channel, mode, frequency, nt_to_datetime64(low, high), offset, dgLength + 8, count))
+            offset = offset + dgLength + 8
+
+    return np.array(records, dtype=index_dtype), channels
+
+#Writes the index sidecar together with the size and mtime of the raw file
+def save_raw_index(filename, index, channels, index_dir=None):
+    stat = os.stat(filename)
+    path = raw_index_path(filename, index_dir)
+    try:
+        with open(path + '.tmp', 'wb') as out:
+            np.savez(out, index=index, channels=np.array(channels, dtype=str),
+                     source=np.array([stat.st_size, stat.st_mtime_ns, index_version], dtype='i8'))
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print("Could not write the datagram index " + path + " (" + str(e) + ")")
+
+#Returns (index, channels) of a .raw file, using the sidecar if it is up to date with
+#the raw file's size and mtime (and the index version) and (re)building it otherwise
+def load_raw_index(filename, index_dir=None):
+    path = raw_index_path(filename, index_dir)
+    stat = os.stat(filename)
+    if os.path.isfile(path):
+        try:
+            with np.load(path) as sidecar:
+                if sidecar['source'].tolist() == [stat.st_size, stat.st_mtime_ns, index_version]:
+                    return sidecar['index'], sidecar['channels'].tolist()
+        except Exception as e:
+            print("Could not read the datagram index " + path + " (" + str(e) + ")")
+    index, channels = build_raw_index(filename)
+    save_raw_index(filename, index, channels, index_dir)
+    return index, channels
+
+#Yields (Head, data) tuples like get_dgs_generator, but seeks to the datagrams using
+#the index. Only the datagram types in noskip_types are read, the others only
+#give the header bytes.
+def get_indexed_dgs_generator(inp_fp, index, noskip_types):
+    for record in index:
+        inp_fp.seek(int(record['offset']))
+        if record['dg_type'] in noskip_types:
+            data = inp_fp.read(int(record['length']))
+        else:
+            data = inp_fp.read(8)
+        yield (ekDatagram.head._make(struct.unpack_from(ekDatagram.headDesc, data)), data)
+
+#Navigation and motion fields read by read_navigation
+nav_fields = ['latitude', 'longitude', 'speed', 'log_distance', 'heading', 'heave', 'pitch', 'roll']
+
+#NMEA ddmm.mmmm (or dddmm.mmmm) and hemisphere to decimal degrees
+def nmea_coordinate(value, hemisphere):
+    degrees = int(float(value) / 100)
+    coordinate = degrees + (float(value) - degrees * 100) / 60
+    return -coordinate if hemisphere in ('S', 'W') else coordinate
+
+#Returns the navigation fields (see nav_fields) carried by an NMEA sentence. Only the
+#sentence type is used, any talker ID is accepted; invalid fixes give no position.
+def parse_nmea(sentence):
+    fields = sentence.split('*')[0].split(',')
+    kind = fields[0][-3:]
+    values = {}
+    try:
+        if kind == 'GGA' and len(fields) > 6 and fields[2] and fields[4] and fields[6] != '0':
+            values['latitude'] = nmea_coordinate(fields[2], fields[3])
+            values['longitude'] = nmea_coordinate(fields[4], fields[5])
+        elif kind == 'GLL' and len(fields) > 6 and fields[1] and fields[3] and fields[6] == 'A':
+            values['latitude'] = nmea_coordinate(fields[1], fields[2])
+            values['longitude'] = nmea_coordinate(fields[3], fields[4])
+        elif kind == 'RMC' and len(fields) > 7 and fields[2] == 'A' and fields[3] and fields[5]:
+            values['latitude'] = nmea_coordinate(fields[3], fields[4])
+            values['longitude'] = nmea_coordinate(fields[5], fields[6])
+            if fields[7]:
+                values['speed'] = float(fields[7])
+        elif kind == 'VTG' and len(fields) > 5 and fields[5]:
+            values['speed'] = float(fields[5])
+        elif kind == 'VLW' and len(fields) > 3 and fields[3]:
+            values['log_distance'] = float(fields[3])
+        elif kind in ('HDT', 'HDG') and len(fields) > 1 and fields[1]:
+            values['heading'] = float(fields[1])
+    except ValueError:
+        return {}
+    return values
+
+#Reads the navigation and motion records of a .raw file: the NME0 sentences, the MRU0
+#datagrams (EK80) and the heave/roll/pitch of the RAW0 datagrams of the first channel
+#(EK60). Returns a dict of columns (time and nav_fields, NaN where a record has no value)
+#sorted by time. The datagrams are found with the index.
+def read_navigation(filename, index_dir=None):
+    index, channels = load_raw_index(filename, index_dir)
+    ek60Channel = index['channel'][index['dg_type'] == b'RAW0'].min(initial=np.iinfo('i2').max)
+    selected = (np.isin(index['dg_type'], [b'NME0', b'MRU0'])
+                | ((index['dg_type'] == b'RAW0') & (index['channel'] == ek60Channel)))
+    records = index[selected]
+
+    times = []
+    rows = []
+    with open_raw(filename) as dg_file:
+        for record in records:
+            dg_file.seek(int(record['offset']) + 16)
+            payload = dg_file.read(int(record['length']) - 20)
+            if record['dg_type'] == b'NME0':
+                text = payload.split(b'\x00')[0].decode('latin-1')
+                for sentence in text.replace('\r', '\n').split('\n'):
+                    values = parse_nmea(sentence.strip())
+                    if len(values) > 0:
+                        times.append(record['ping_time'])
+                        rows.append(values)
+            elif record['dg_type'] == b'MRU0' and len(payload) >= 16:
+                heave, roll, pitch, heading = struct.unpack_from('<ffff', payload, 0)
+                times.append(record['ping_time'])
+                rows.append({'heave': heave, 'roll': roll, 'pitch': pitch, 'heading': heading})
+            elif record['dg_type'] == b'RAW0' and len(payload) >= 48:
+                heave, roll, pitch = struct.unpack_from('<fff', payload, 36)
+                times.append(record['ping_time'])
+                rows.append({'heave': heave, 'roll': roll, 'pitch': pitch})
+
+    columns = {'time': np.array(times, dtype='M8[ns]')}
+    for field in nav_fields:
+        columns[field] = np.array([row.get(field, np.nan) for row in rows], dtype='f8')
+    order = np.argsort(columns['time'], kind='stable')
+    return {name: column[order] for name, column in columns.items()}
+
+#Returns the file name used for an output target of the splitter
+def split_filename(baseName, splitOn, target):
+    if(splitOn == 'size'):
+        return baseName + '_size' + str(target) + '.raw'
+    elif(splitOn == 'mode'):
+        return baseName + '_' + target + '.raw'
+    else:
+        return baseName + target + '.raw'
+
+#Routes the datagrams of a .raw file to the split outputs.
+#Yields (target, offset, length, data) for every datagram written to a target. The
+#offset is the position of the datagram in the input, or None if the datagram was
+#rewritten (adjusted configuration and initial parameters). With read_payload=False
+#only the XML0 and FIL1 datagrams are read, the others are skipped and given as
+#empty data (use the offset and length to fetch them).
+#If a datagram index is given, the datagrams are read by seeking to their offsets.
+def route_datagrams(dg_file, splitOn, size=1000000, read_payload=True, dump_xml=True, CWfrequencies=None, index=None):
         position = 0
         offset = 0
-        outnum = 0
-        CWfrequencies = {}
-        FMfrequencies = {}
-        xmlcounter = 0
-        isrdldata = 0
+        filecounter = 0
+        if CWfrequencies is None:
+            CWfrequencies = {}
         configuration = bytearray() 
         initialparameter = bytearray() 
         environment = bytearray()  
-        outputfileCW = BufferedWriter
-        outputfileFM = BufferedWriter
-        outputfile = BufferedWriter
-        currentChannelFiles = []
-        currentChannelFile = BufferedWriter
+        configurationOffset = None
+        initialparameterOffset = None
+        environmentOffset = None
+        currentMode = 'CW'
+        channels = []
+        currentChannel = None
         removedChannelIdsCW = []
         removedChannelIdsFM = []
         filterDatagrams = []
-        
-        
-        if(splitOnSize):
-            outputfile = open(baseName + '_size' + str(filecounter) + '.raw', 'wb')
-        if(splitOnMode):
-            outputfileCW = open(baseName + '_CW.raw', 'wb')
-            outputfileFM = open(baseName + '_FM.raw', 'wb')
-            currentMode = 'CW'
-            
-        for dg in get_dgs_generator(dg_file):
-            position = position + len(dg[1])
-            if(splitOnSize):
-                outputfile.write(dg[1]);
-            outnum = outnum + 1
+
+        if read_payload:
+            noskip_types = None
+        else:
+            noskip_types = [b'XML0', b'FIL1']
+
+        if index is None:
+            dgs = get_dgs_generator(dg_file, noskip_types = noskip_types)
+        else:
+            dgs = get_indexed_dgs_generator(dg_file, index, noskip_types)
+
+        for dg in dgs:
+            dgOffset = offset
+            dgLength = dg[0].DgLength + 8
+            offset = offset + dgLength
+            position = position + dgLength
+            if(splitOn == 'size'):
+                yield (filecounter, dgOffset, dgLength, dg[1])
             dgType = dg[0].DgType
             
             separator = {0,'Init'}
@@ -466,7 +711,6 @@ with open(filename, 'rb') as dg_file:
             mode = 'Init'
             
             if(dgType == b'XML0'):
-                xmlcounter = xmlcounter + 1
                 separator = extract_separator(dg[1])
                 frequency = separator[0]
                 mode = separator[1]
@@ -478,167 +722,265 @@ with open(filename, 'rb') as dg_file:
                 if(mode == 'Environment'):
                     print("Enviroment captured")
                     environment = dg[1]
+                    environmentOffset = dgOffset
                 if(mode == 'Initial'):
                     print("Initial Parameter captured")
                     initialparameter = dg[1]
+                    initialparameterOffset = dgOffset
                 if(mode == 'Config'):
                     print("Configuration captured")
                     configuration = dg[1]                 
-                    if(splitOnChannel):
-                        #create filehandles for channels
+                    configurationOffset = dgOffset
+                    if(splitOn == 'channel'):
+                        #create targets for channels
                         print("identifying channels")
-                        channels = extract_channels(dg)
+                        channels = [channel.replace('|','_') for channel in extract_channels(dg)]
                         print("found " + str(len(channels)) + " channels")
-                        for channel in channels:
-                            channelName = channel.replace('|','_')
-                            print("creating channel " + channelName)
-                            filehandle = open(baseName + channelName + '.raw', 'wb')
-                            currentChannelFiles.append(filehandle)
-                        
                     
             #SPLIT on MODE
-            if(splitOnMode):
+            if(splitOn == 'mode'):
                 if(dgType == b'XML0'):            
                     if(currentMode == 'CW'):
-                        outputfileCW.write(dg[1])
+                        yield ('CW', dgOffset, dgLength, dg[1])
                     elif(currentMode == 'FM'):
-                        outputfileFM.write(dg[1])
+                        yield ('FM', dgOffset, dgLength, dg[1])
                     else:
                         if(currentMode == 'Initial'):
-                            cwInitial = adjustInitialParameters(dg[1], 'CW', removedChannelIdsCW)
-                            fmInitial = adjustInitialParameters(dg[1], 'FM', removedChannelIdsFM)
-                            cwConfig = adjustConfig(configuration,removedChannelIdsCW,'CW')
-                            fmConfig = adjustConfig(configuration,removedChannelIdsFM,'FM')
+                            cwInitial = adjustInitialParameters(dg[1], 'CW', removedChannelIdsCW, dump_xml)
+                            fmInitial = adjustInitialParameters(dg[1], 'FM', removedChannelIdsFM, dump_xml)
+                            cwConfig = adjustConfig(configuration,removedChannelIdsCW,'CW', dump_xml)
+                            fmConfig = adjustConfig(configuration,removedChannelIdsFM,'FM', dump_xml)
                             print('writing config to CW')
-                            outputfileCW.write(cwConfig)
+                            yield ('CW', None, len(cwConfig), cwConfig)
                             print('writing config to FM')
-                            outputfileFM.write(fmConfig)                           
+                            yield ('FM', None, len(fmConfig), fmConfig)
                             print('writing initial to CW')
-                            outputfileCW.write(cwInitial)
+                            yield ('CW', None, len(cwInitial), cwInitial)
                             print('writing initial to FM')
-                            outputfileFM.write(fmInitial)
+                            yield ('FM', None, len(fmInitial), fmInitial)
                         elif(currentMode == 'Config'):
                             #delay the writing of config
                             print('delay config write')    
                         else:
-                            outputfileCW.write(dg[1])
-                            outputfileFM.write(dg[1])
-                elif(dgType == b'RAW3'):
+                            yield ('CW', dgOffset, dgLength, dg[1])
+                            yield ('FM', dgOffset, dgLength, dg[1])
+                elif(dgType == b'RAW3' or dgType == b'RAW4'):
                     if(currentMode == 'CW'):
-                        outputfileCW.write(dg[1])
+                        yield ('CW', dgOffset, dgLength, dg[1])
                     else:
-                        outputfileFM.write(dg[1])
-                elif(dgType == b'RAW4'):
-                    if(currentMode == 'CW'):
-                        outputfileCW.write(dg[1])
-                    else:
-                        outputfileFM.write(dg[1])
+                        yield ('FM', dgOffset, dgLength, dg[1])
                 elif(dgType == b'FIL1'):
                     filterchannel = extract_filter_channel(dg[1])
-                    cwRemove = False
-                    fmRemove = False
-                    for channel in removedChannelIdsCW:
-                        if(channel == filterchannel):
-                            cwRemove = True
-                    for channel in removedChannelIdsFM:
-                        if(channel == filterchannel):
-                            fmRemove = True
-                    if(not cwRemove):
+                    if(filterchannel not in removedChannelIdsCW):
                         print("filter file for cw found in " + filterchannel)
-                        outputfileCW.write(dg[1])
-                    if(not fmRemove):
-                        outputfileFM.write(dg[1])
+                        yield ('CW', dgOffset, dgLength, dg[1])
+                    if(filterchannel not in removedChannelIdsFM):
                         print("filter file for FM found in " + filterchannel)
-                        
+                        yield ('FM', dgOffset, dgLength, dg[1])
                 else:
-                    outputfileCW.write(dg[1])
-                    outputfileFM.write(dg[1])
+                    yield ('CW', dgOffset, dgLength, dg[1])
+                    yield ('FM', dgOffset, dgLength, dg[1])
             
-            if(splitOnSize):
-                if(dgType == b'FIL1'):
-                        filterDatagrams.append(dg[1])     
             #SPLIT on SIZE  
-            if(splitOnSize):      
+            if(splitOn == 'size'):      
+                if(dgType == b'FIL1'):
+                    filterDatagrams.append((dgOffset, dgLength, dg[1]))
                 if(dgType == b'RAW3'):
                     #we allways want to split after a raw3 to keep the xml0 and raw3 together
                     if(position > (size + filecounter*size)):
                         print("splitting file due to size")
-                        outputfile.flush()
-                        outputfile.close()
                         filecounter = filecounter + 1
-                        outputfile = open(baseName + '_size' + str(filecounter) + '.raw', 'wb')
-                        outputfile.write(configuration)
-                        outputfile.write(initialparameter)
-                        outputfile.write(environment)
+                        for dgCopy, dgCopyOffset in [(configuration, configurationOffset),
+                                                     (initialparameter, initialparameterOffset),
+                                                     (environment, environmentOffset)]:
+                            if len(dgCopy) > 0:
+                                yield (filecounter, dgCopyOffset, len(dgCopy), dgCopy)
                         #All files need the filters
-                        for filters in filterDatagrams:
-                            outputfile.write(filters)
+                        for filterOffset, filterLength, filters in filterDatagrams:
+                            yield (filecounter, filterOffset, filterLength, filters)
                         
             #SPLIT on Channel
-            if(splitOnChannel):
+            if(splitOn == 'channel'):
                 if(dgType == b'XML0'):
-                    separator = extract_separator(dg[1])
-                                            
-                    if(int(separator[0]) > 0):
-                        #it is a ping
-                        currentChannel = extract_channel(dg[1])
-                        currentChannel = currentChannel.replace('|','_')
-                        #set active file handle
-                        for filehandle in currentChannelFiles:
-                            #print(filehandle)
-                            position = filehandle.name.find(currentChannel)                           
-                            if(position > 0):                                
-                                #set current file to write to, figure out the "if"
-                                currentChannelFile = filehandle                                
-                        currentChannelFile.write(dg[1])
+                    if(float(separator[0]) > 0):
+                        #it is a ping, set the active channel
+                        pingChannel = extract_channel(dg[1]).replace('|','_')
+                        for channel in channels:
+                            if pingChannel and pingChannel in channel:
+                                currentChannel = channel
+                        if currentChannel is not None:
+                            yield (currentChannel, dgOffset, dgLength, dg[1])
                     else:
-                        #NOT a PING, write to all files
-                        for filehandle in currentChannelFiles:
-                            filehandle.write(dg[1]) 
-                elif(dgType == b'RAW3'):
-                    currentChannelFile.write(dg[1])
-                elif(dgType == b'RAW4'):
-                    currentChannelFile.write(dg[1])
+                        #NOT a PING, write to all channels
+                        for channel in channels:
+                            yield (channel, dgOffset, dgLength, dg[1])
+                elif(dgType == b'RAW3' or dgType == b'RAW4'):
+                    if currentChannel is not None:
+                        yield (currentChannel, dgOffset, dgLength, dg[1])
                 elif(dgType == b'FIL1'):
-                    filterchannel = extract_filter_channel(dg[1])
-                    filterchannel = filterchannel.replace('|','_')
-                    #only write to correct file
-                    for filehandle in currentChannelFiles:
-                            #print(filehandle)
-                            position = filehandle.name.find(filterchannel)                           
-                            if(position > 0):                                
-                                #set current file to write to, figure out the "if"
-                                print("writing filter on channel " + filterchannel)
-                                filehandle.write(dg[1])
+                    filterchannel = extract_filter_channel(dg[1]).replace('|','_')
+                    #only write to correct channel
+                    for channel in channels:
+                        if filterchannel and filterchannel in channel:
+                            print("writing filter on channel " + filterchannel)
+                            yield (channel, dgOffset, dgLength, dg[1])
                 else:
-                    for filehandle in currentChannelFiles:
-                        filehandle.write(dg[1]) 
-                    
-        
-        if(splitOnMode):
-            outputfileCW.flush()
-            outputfileFM.flush()
-            outputfileFM.close()
-            outputfileCW.close()
-        
-        if(splitOnSize): 
-            outputfile.flush()
-            outputfile.close()
-            
-        if(splitOnChannel):
-            for filehandle in currentChannelFiles:
-                filehandle.flush()
-                filehandle.close()
-        
-        #END Summary
-        for freq in CWfrequencies:
-            print('Frequency ', end='')
-            print(freq, end='')
-            print(" has ", end='')
-            print(CWfrequencies[freq] , end='')
-            print(" pings ")
-
-        logging.debug('Closing files')
-        
-#TOOD handle file object close more spesifically?
+                    for channel in channels:
+                        yield (channel, dgOffset, dgLength, dg[1])
+
+#Returns the datagrams of a virtual split of a .raw file (view is 'CW', 'FM' or a
+#channel ID) as a list of (offset, length) tuples into the input file, or bytes
+#for the datagrams that are rewritten by the splitter.
+def view_offsets(filename, view, index_dir=None):
+    index, channels = load_raw_index(filename, index_dir)
+
+    def add_entry(dgOffset, dgLength, data=None):
+        if dgOffset is None:
+            entries.append(bytes(data))
+        elif len(entries) > 0 and isinstance(entries[-1], tuple) and sum(entries[-1]) == dgOffset:
+            #coalesce adjacent datagrams into one read
+            entries[-1] = (entries[-1][0], entries[-1][1] + dgLength)
+        else:
+            entries.append((dgOffset, dgLength))
+
+    entries = []
+    if view in ('CW', 'FM'):
+        with open_raw(filename) as dg_file:
+            for dgTarget, dgOffset, dgLength, data in route_datagrams(dg_file, 'mode', read_payload=False, dump_xml=False, index=index):
+                if dgTarget == view:
+                    add_entry(dgOffset, dgLength, data)
+    else:
+        #A channel split is the channel's own datagrams plus all the datagrams not
+        #belonging to a channel, this is selected from the index directly
+        target = [i for i, channel in enumerate(channels) if channel == view or channel.replace('|','_') == view.replace('|','_')]
+        selected = (index['channel'] == -1) | np.isin(index['channel'], target)
+        if len(target) > 0:
+            for record in index[selected]:
+                add_entry(int(record['offset']), int(record['length']))
+    return entries
+
+#Writes the datagrams listed by view_offsets into the writable binary stream out
+#(entries=None copies the whole, possibly compressed, file)
+def write_view(filename, entries, out):
+    with open_raw(filename) as dg_file:
+        if entries is None:
+            shutil.copyfileobj(dg_file, out, 16 * 1024 * 1024)
+            return
+        for entry in entries:
+            if isinstance(entry, tuple):
+                dg_file.seek(entry[0])
+                out.write(dg_file.read(entry[1]))
+            else:
+                out.write(entry)
+
+#Context manager giving a path to an in-memory .raw file holding a virtual split
+#('CW', 'FM' or a channel ID) of filename, or the whole decompressed file for
+#view=None. Nothing is written to disk when the platform supports anonymous
+#memory files (Linux).
+class raw_view:
+    def __init__(self, filename, view, index_dir=None):
+        self.filename = filename
+        self.view = view
+        self.index_dir = index_dir
+        self._file = None
+
+    def __enter__(self):
+        if self.view is None:
+            entries = None
+        else:
+            entries = view_offsets(self.filename, self.view, self.index_dir)
+        if entries is not None and len(entries) == 0:
+            raise ValueError('No datagrams for ' + str(self.view) + ' in ' + str(self.filename))
+        if hasattr(os, 'memfd_create'):
+            self._file = os.fdopen(os.memfd_create('rawview'), 'w+b')
+            path = '/proc/self/fd/' + str(self._file.fileno())
+        else:
+            self._file = tempfile.NamedTemporaryFile(suffix='.raw', delete=False)
+            path = self._file.name
+        write_view(self.filename, entries, self._file)
+        self._file.flush()
+        return path
+
+    def __exit__(self, exc_type, exc_value, tb):
+        name = self._file.name
+        self._file.close()
+        if isinstance(name, str) and os.path.isfile(name):
+            os.remove(name)
+        return False
+
+#Splits a .raw file on disk (size, mode or channel)
+def split_raw_file(filename, splitOn, size=1000000):
+    baseName = os.path.splitext(raw_basename(filename))[0]
+    CWfrequencies = {}
+    outputs = {}
+
+    #Handle the input .raw file, given the arguments.
+    with open_raw(filename) as dg_file:
+        for target, dgOffset, dgLength, data in route_datagrams(dg_file, splitOn, size, CWfrequencies=CWfrequencies):
+            if target not in outputs:
+                if(splitOn == 'channel'):
+                    print("creating channel " + target)
+                outputs[target] = open(split_filename(baseName, splitOn, target), 'wb')
+            outputs[target].write(data)
+
+    for outputfile in outputs.values():
+        outputfile.flush()
+        outputfile.close()
+
+    #END Summary
+    for freq in CWfrequencies:
+        print('Frequency ', end='')
+        print(freq, end='')
+        print(" has ", end='')
+        print(CWfrequencies[freq] , end='')
+        print(" pings ")
+
+    logging.debug('Closing files')
+
+
+def print_usage():
+    print("Usage EK80Splitter.py [raw file] [mode] [param]")
+    print("eg py EK80Splitter.py input.raw size 100")
+    print("eg py EK80Splitter.py input.raw mode")
+    print("available split modes is size [inputsize in MB], mode or channel")
+
+
+if __name__ == '__main__':
+    # Set initial starting values
+    size = 1000000
+    sizeMultiplier = 1000000
+    splitOn = None
+
+    #Validate arguments
+    if(len(sys.argv) > 2):
+        splittype = sys.argv[2]
+        if(splittype == '-h'):
+            print_usage()
+            exit()
+        if(splittype == "channel"):
+            splitOn = 'channel'
+        elif(splittype == "size"):
+            splitOn = 'size'
+            if(len(sys.argv) > 3):
+                size = int(sys.argv[3]) * sizeMultiplier
+                print("split size " + str(size))
+        elif(splittype == "mode"):
+            splitOn = 'mode'
+    else:
+        print_usage()
+
+    #TODO, create argument library or split to separate file.
+    filename = sys.argv[1];
+    print('Splitting ' + str(filename))
+
+    if(splitOn == 'channel'):
+        print("Splitting on channel");
+
+    if(splitOn == 'size'):
+        print("Splitting on size")
+
+    if(splitOn == 'mode'):
+        print("Splitting on mode")
 
+    if splitOn is not None:
+        split_raw_file(filename, splitOn, size)
@@ -0,0 +1,69 @@
+"""
+Benchmark of the noise estimation stage (noise_estimation) against the Sv
+arithmetic of the same samples (power to sv, as in get_sv), on synthetic data.
+
+    python benchmarks/noise_estimation.py [n_ping] [n_range]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import CRIMAC_preprocess
+
+
+def synthetic_sv(n_ping, n_range, frequency = (38000.0, 200000.0), seed = 0):
+    # Background noise (growing with the TVG) and a layer, in float32 like pyEcholab's sv
+    rng = np.random.default_rng(seed)
+    range_values = np.arange(n_range) * 0.1 + 0.05
+    alpha = CRIMAC_preprocess.absorption_coefficient(np.array(frequency))
+    tvg = 20 * np.log10(np.maximum(range_values, 0.1))[None, :] + 2 * alpha[:, None] * range_values[None, :]
+    sv = np.empty((len(frequency), n_ping, n_range), dtype = 'float32')
+    for i in range(len(frequency)):
+        noise = -150.0 + 10 * i + tvg[i][None, :] + 10 * np.log10(rng.exponential(1, (n_ping, n_range)))
+        sv[i] = 10 * np.log10(10 ** (noise / 10) + np.where((range_values > 10) & (range_values < 40), 1e-6, 0)[None, :])
+    sv[1, ::5, n_range // 2:] = np.nan
+    ping_time = np.datetime64('2020-01-01T00:00:00', 'ns') + np.arange(n_ping) * np.timedelta64(1, 's')
+    return xr.Dataset(dict(sv = (["frequency", "ping_time", "range"], sv)),
+                      coords = dict(frequency = list(frequency), ping_time = ping_time, range = range_values))
+
+
+def best_of(function, repeat = 3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    n_ping = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n_range = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    ds = synthetic_sv(n_ping, n_range)
+    sv = ds.sv.values
+    range_values = ds.range.values
+
+    noise_time = best_of(lambda: CRIMAC_preprocess.noise_estimation(ds.copy(), CRIMAC_preprocess.PluginContext("bench", 38000)))
+
+    # The Sv arithmetic of get_sv on the same samples (power, TVG, absorption and constant)
+    def sv_arithmetic():
+        for i in range(sv.shape[0]):
+            tvg = (20 * np.log10(np.maximum(range_values, 1)) + 2 * 0.01 * range_values).astype('float32')
+            sv[i] + tvg[None, :] - np.float32(40.0)
+    arithmetic_time = best_of(sv_arithmetic)
+
+    # And the conversion of all the samples to the linear domain
+    exp_time = best_of(lambda: np.exp(sv * np.float32(np.log(10) / 10)))
+
+    print("%d x %d x %d samples (%.0f MB of float32 sv)" % (sv.shape + (sv.nbytes / 1e6,)))
+    print("noise_estimation %.3f s" % noise_time)
+    print("Sv arithmetic    %.3f s" % arithmetic_time)
+    print("sv to linear     %.3f s" % exp_time)
+
+
+if __name__ == "__main__":
+    main()
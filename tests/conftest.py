@@ -0,0 +1,28 @@
+import os
+import sys
+import types
+
+# The preprocessor modules are flat scripts in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def add_empty_modules(names):
+    # Parents first
+    for name in names:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        parent, _, child = name.rpartition(".")
+        if parent:
+            setattr(sys.modules[parent], child, module)
+
+
+# pyEcholab and annotationtools are only used to read the raw and .work files, the
+# preprocessor is imported with empty modules in their place when they are missing
+try:
+    import echolab2.instruments
+except ImportError:
+    add_empty_modules(["echolab2", "echolab2.instruments", "echolab2.instruments.EK80", "echolab2.instruments.EK60"])
+try:
+    import annotationtools.readers
+except ImportError:
+    add_empty_modules(["annotationtools", "annotationtools.readers"])
@@ -0,0 +1,247 @@
+import bz2
+import gzip
+import os
+import struct
+
+import numpy as np
+import pytest
+
+import EK80Splitter
+
+
+def nt_time(t):
+    # datetime64 to the (low, high) words of an NT time
+    nt = int(np.datetime64(t, 'ns').astype('int64')) // 100 + 116444736000000000
+    return nt & 0xFFFFFFFF, nt >> 32
+
+
+def datagram(dg_type, payload):
+    # Length, type and payload, followed by the trailing length
+    body = dg_type + payload
+    return struct.pack('<l', len(body)) + body + struct.pack('<l', len(body))
+
+
+def raw0(t, channel, frequency, count, heave = 0.0):
+    low, high = nt_time(t)
+    header = struct.pack('<LLhh12fhh2fll', low, high, channel, 3, 5.0, frequency, 2000.0, 0.001, 2425.0,
+                         0.000256, 1500.0, 0.01, heave, 0.0, 0.0, 10.0, 0, 0, 0.0, 0.0, 0, count)
+    return datagram(b'RAW0', header + np.zeros(count, dtype='<i2').tobytes() + np.zeros(count, dtype='<i2').tobytes())
+
+
+def nme0(t, sentence):
+    low, high = nt_time(t)
+    return datagram(b'NME0', struct.pack('<LL', low, high) + sentence)
+
+
+def mru0(t, heave, roll, pitch, heading):
+    low, high = nt_time(t)
+    return datagram(b'MRU0', struct.pack('<LL4f', low, high, heave, roll, pitch, heading))
+
+
+def xml0(t, text):
+    low, high = nt_time(t)
+    return datagram(b'XML0', struct.pack('<LL', low, high) + text.encode())
+
+
+def fil1(t, channel_id):
+    low, high = nt_time(t)
+    return datagram(b'FIL1', struct.pack('<LLh2s128s', low, high, 1, b'', channel_id.encode()) + np.zeros(8, dtype='<f4').tobytes())
+
+
+def raw3(t, channel_id, count):
+    low, high = nt_time(t)
+    return datagram(b'RAW3', struct.pack('<LL128shhll', low, high, channel_id.encode(), 3, 0, 0, count) + np.zeros(count * 2, dtype='<f4').tobytes())
+
+
+ek80_channels = [("WBT 1-1 ES38B", "0", 'Frequency="38000"'), ("WBT 2-1 ES120", "1", 'FrequencyStart="90000" FrequencyEnd="160000"')]
+
+
+def write_ek80(path, n_ping):
+    # A CW and an FM channel, pinging in turn
+    t0 = np.datetime64('2020-01-01T00:00:00')
+    channels = "".join('<Channel ChannelID="%s" />' % channel_id for channel_id, _, _ in ek80_channels)
+    initial = "".join('<Channel ChannelID="%s" PulseForm="%s" />' % (channel_id, form) for channel_id, form, _ in ek80_channels)
+    with open(path, 'wb') as f:
+        f.write(xml0(t0, '<Configuration><Transceivers><Channels>' + channels + '</Channels></Transceivers></Configuration>'))
+        f.write(xml0(t0, '<Environment Depth="100" />'))
+        for channel_id, _, _ in ek80_channels:
+            f.write(fil1(t0, channel_id))
+        f.write(xml0(t0, '<InitialParameter><Channels>' + initial + '</Channels></InitialParameter>'))
+        for i in range(n_ping):
+            t = t0 + np.timedelta64(i, 's')
+            f.write(nme0(t, b'$GPGGA,000000,6000.000,N,00500.000,E,1,08,1.0,0.0,M,,,,*00'))
+            for channel_id, form, frequency in ek80_channels:
+                f.write(xml0(t, '<Parameter><Channel ChannelID="%s" PulseForm="%s" %s /></Parameter>' % (channel_id, form, frequency)))
+                f.write(raw3(t, channel_id, 100 + i))
+
+
+def write_ek60(path, counts):
+    with open(path, 'wb') as f:
+        for i, count in enumerate(counts):
+            t = np.datetime64('2020-01-01T00:00:00') + np.timedelta64(i, 's')
+            f.write(nme0(t, b'$GPGGA,000000,6000.000,N,00500.000,E,1,08,1.0,0.0,M,,,,*00'))
+            f.write(raw0(t, 1, 38000.0, count))
+
+
+def test_build_raw_index_raw0(tmp_path):
+    path = str(tmp_path / "ek60.raw")
+    write_ek60(path, [500, 480, 500])
+    index, channels = EK80Splitter.build_raw_index(path)
+
+    samples = index[index['dg_type'] == b'RAW0']
+    assert samples['count'].tolist() == [500, 480, 500]
+    assert np.all(samples['frequency'] == 38000.0)
+    assert samples['ping_time'][0] == np.datetime64('2020-01-01T00:00:00', 'ns')
+    assert channels == ['1']
+
+    # Offsets and lengths cover the file
+    assert index['offset'][0] == 0
+    assert np.all(index['offset'][1:] == index['offset'][:-1] + index['length'][:-1])
+    assert index['offset'][-1] + index['length'][-1] == os.path.getsize(path)
+
+
+def test_load_raw_index_sidecar(tmp_path):
+    path = str(tmp_path / "ek60.raw")
+    index_dir = tmp_path / "idx"
+    index_dir.mkdir()
+    write_ek60(path, [500])
+    index, channels = EK80Splitter.load_raw_index(path, str(index_dir))
+    assert os.path.isfile(EK80Splitter.raw_index_path(path, str(index_dir)))
+
+    # Reused while the raw file is unchanged
+    cached, cached_channels = EK80Splitter.load_raw_index(path, str(index_dir))
+    assert cached.tobytes() == index.tobytes() and cached_channels == channels
+
+    # Rebuilt when the raw file changes
+    write_ek60(path, [500, 700])
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+    rebuilt, _ = EK80Splitter.load_raw_index(path, str(index_dir))
+    assert rebuilt[rebuilt['dg_type'] == b'RAW0']['count'].tolist() == [500, 700]
+
+
+def test_load_raw_index_old_version(tmp_path):
+    # Sidecars from an older index version are rebuilt
+    path = str(tmp_path / "ek60.raw")
+    write_ek60(path, [500])
+    index, channels = EK80Splitter.build_raw_index(path)
+    index['count'] = 0
+    stat = os.stat(path)
+    with open(EK80Splitter.raw_index_path(path), 'wb') as out:
+        np.savez(out, index=index, channels=np.array(channels, dtype=str),
+                 source=np.array([stat.st_size, stat.st_mtime_ns], dtype='i8'))
+    rebuilt, _ = EK80Splitter.load_raw_index(path)
+    assert rebuilt[rebuilt['dg_type'] == b'RAW0']['count'].tolist() == [500]
+
+
+def test_route_datagrams_index(tmp_path):
+    # Routing from the index, reading only the XML0 and FIL1 payloads, gives the same datagrams
+    path = str(tmp_path / "ek80.raw")
+    write_ek80(path, 3)
+    index, _ = EK80Splitter.build_raw_index(path)
+    for split_on in ['mode', 'channel']:
+        with open(path, 'rb') as f:
+            full = [(target, offset, length) for target, offset, length, _ in EK80Splitter.route_datagrams(f, split_on, dump_xml=False)]
+        with open(path, 'rb') as f:
+            indexed = [(target, offset, length) for target, offset, length, _ in
+                       EK80Splitter.route_datagrams(f, split_on, read_payload=False, dump_xml=False, index=index)]
+        assert indexed == full
+
+
+def test_raw_view(tmp_path, monkeypatch):
+    # The in-memory views hold the same bytes as the split files
+    monkeypatch.chdir(tmp_path)
+    path = str(tmp_path / "ek80.raw")
+    write_ek80(path, 3)
+    EK80Splitter.split_raw_file(path, 'mode')
+    EK80Splitter.split_raw_file(path, 'channel')
+    views = [('CW', 'ek80_CW.raw'), ('FM', 'ek80_FM.raw')] + [(channel_id, 'ek80' + channel_id + '.raw') for channel_id, _, _ in ek80_channels]
+    for view, split_fname in views:
+        with EK80Splitter.raw_view(path, view) as view_path:
+            with open(view_path, 'rb') as f:
+                data = f.read()
+        with open(str(tmp_path / split_fname), 'rb') as f:
+            assert data == f.read()
+
+    # The CW view has the CW channel's pings, with the FM channel removed from the configuration
+    entries = EK80Splitter.view_offsets(path, 'CW')
+    rewritten = [entry for entry in entries if not isinstance(entry, tuple)]
+    assert len(rewritten) == 2 and all(b'ES120' not in entry for entry in rewritten)
+    with EK80Splitter.raw_view(path, 'CW') as view_path:
+        index, channels = EK80Splitter.build_raw_index(view_path)
+    assert channels[:1] == ["WBT 1-1 ES38B"] and (index['dg_type'] == b'RAW3').sum() == 3
+    assert set(np.array(channels)[index['channel'][index['dg_type'] == b'RAW3']]) == {"WBT 1-1 ES38B"}
+
+
+@pytest.mark.parametrize("suffix, compress", [(".gz", gzip.compress), (".bz2", bz2.compress)])
+def test_compressed_raw(tmp_path, suffix, compress):
+    path = str(tmp_path / "ek80.raw")
+    write_ek80(path, 3)
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path + suffix, 'wb') as f:
+        f.write(compress(data))
+    assert EK80Splitter.is_compressed(path + suffix) and EK80Splitter.raw_basename(path + suffix) == path
+
+    # Indexed and viewed as the uncompressed file
+    index, channels = EK80Splitter.build_raw_index(path)
+    compressed_index, compressed_channels = EK80Splitter.build_raw_index(path + suffix)
+    assert compressed_index.tobytes() == index.tobytes() and compressed_channels == channels
+    for view in [None, 'FM']:
+        with EK80Splitter.raw_view(path, view) as view_path:
+            with open(view_path, 'rb') as f:
+                expected = f.read()
+        with EK80Splitter.raw_view(path + suffix, view) as view_path:
+            with open(view_path, 'rb') as f:
+                assert f.read() == expected
+
+
+@pytest.mark.parametrize("sentence, values", [
+    ("$GPGGA,120000,6030.000,N,00515.000,E,1,08,1.0,0.0,M,,,,*47", {"latitude": 60.5, "longitude": 5.25}),
+    ("$INGGA,120000,6030.000,S,00515.000,W,2,08,1.0,0.0,M,,,,*47", {"latitude": -60.5, "longitude": -5.25}),
+    ("$GPGGA,120000,6030.000,N,00515.000,E,0,00,,,M,,,,*47", {}),
+    ("$GPGGA,120000,,,,,1,08,1.0,0.0,M,,,,*47", {}),
+    ("$GPGLL,6030.000,N,00515.000,E,120000,A,A*47", {"latitude": 60.5, "longitude": 5.25}),
+    ("$GPGLL,6030.000,N,00515.000,E,120000,V,N*47", {}),
+    ("$GPRMC,120000,A,6030.000,N,00515.000,E,10.5,90.0,010120,,,A*47", {"latitude": 60.5, "longitude": 5.25, "speed": 10.5}),
+    ("$GPRMC,120000,V,6030.000,N,00515.000,E,10.5,90.0,010120,,,N*47", {}),
+    ("$GPVTG,90.0,T,,M,10.5,N,19.4,K*47", {"speed": 10.5}),
+    ("$VDVLW,1234.5,N,12.5,N*47", {"log_distance": 12.5}),
+    ("$HEHDT,271.5,T*47", {"heading": 271.5}),
+    ("$GPGGA,120000,60x30,N,00515.000,E,1,08,1.0,0.0,M,,,,*47", {}),
+    ("$GPZDA,120000,01,01,2020,,*47", {}),
+    ("", {}),
+])
+def test_parse_nmea(sentence, values):
+    assert EK80Splitter.parse_nmea(sentence) == pytest.approx(values)
+
+
+def test_read_navigation(tmp_path):
+    # An EK60 file: the heave of the first channel, and a position sentence written after the
+    # ping it belongs to; an EK80 file: the motion datagrams
+    path = str(tmp_path / "ek60.raw")
+    t0 = np.datetime64('2020-01-01T00:00:00')
+    with open(path, 'wb') as f:
+        for i in range(3):
+            t = t0 + np.timedelta64(i, 's')
+            f.write(raw0(t, 1, 38000.0, 10, heave = 0.5 * i))
+            f.write(raw0(t, 2, 120000.0, 10, heave = 9.0))
+            f.write(nme0(t - np.timedelta64(500, 'ms'), b'$GPGGA,000000,6000.000,N,00500.000,E,1,08,1.0,0.0,M,,,,*00\r\n$GPVTG,90.0,T,,M,10.0,N,18.5,K*00\r\n'))
+    columns = EK80Splitter.read_navigation(path)
+    assert sorted(columns) == sorted(["time"] + EK80Splitter.nav_fields)
+    assert np.all(np.diff(columns["time"]) >= np.timedelta64(0))
+    assert columns["time"][0] == np.datetime64('2019-12-31T23:59:59.500', 'ns')
+    heave = columns["heave"][~np.isnan(columns["heave"])]
+    assert heave.tolist() == [0.0, 0.5, 1.0]
+    assert np.all(columns["latitude"][~np.isnan(columns["latitude"])] == 60.0)
+    assert np.all(columns["longitude"][~np.isnan(columns["longitude"])] == 5.0)
+    assert np.sum(columns["speed"] == 10.0) == 3
+
+    path = str(tmp_path / "ek80.raw")
+    write_ek80(path, 2)
+    with open(path, 'ab') as f:
+        f.write(mru0(t0 + np.timedelta64(1500, 'ms'), 0.25, 1.0, -1.0, 45.0))
+    columns = EK80Splitter.read_navigation(path)
+    motion = ~np.isnan(columns["heave"])
+    assert np.array_equal(columns["time"][motion], [np.datetime64('2020-01-01T00:00:01.500', 'ns')])
+    assert [columns[field][motion][0] for field in ["heave", "roll", "pitch", "heading"]] == [0.25, 1.0, -1.0, 45.0]
+    assert np.sum(columns["latitude"] == 60.0) == 2
@@ -0,0 +1,803 @@
+import datetime
+import gzip
+import json
+import os
+import io
+import shutil
+import tarfile
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import xarray as xr
+import zarr
+
+from test_ek80splitter import write_ek60, write_ek80
+
+# Needs pyEcholab and the other dependencies of the preprocessor
+CRIMAC_preprocess = pytest.importorskip("CRIMAC_preprocess")
+
+
+def file_table_ds(file_table, file_index):
+    ping_time = np.datetime64('2020-01-01T00:00:00', 'ns') + np.arange(len(file_index)) * np.timedelta64(1, 's')
+    ds = xr.Dataset(coords=dict(ping_time=ping_time, file_index=("ping_time", np.array(file_index, dtype='int32'))))
+    ds.attrs["file_table"] = file_table
+    return ds
+
+
+def test_get_file_table():
+    entries = [{"name": "a.raw", "hash": "1", "ping_start": 0, "ping_stop": 2}]
+    # A list in zarr attributes, a JSON string in NetCDF attributes
+    assert CRIMAC_preprocess.get_file_table(file_table_ds(entries, [0, 0])) == entries
+    assert CRIMAC_preprocess.get_file_table(file_table_ds(json.dumps(entries), [0, 0])) == entries
+    assert CRIMAC_preprocess.get_file_table(xr.Dataset()) == []
+
+
+def test_raw_hashes(tmp_path):
+    path = str(tmp_path / "a.raw")
+    write_ek60(path, [500, 480])
+    with open(path, 'rb') as f, gzip.open(path + '.gz', 'wb') as out:
+        shutil.copyfileobj(f, out)
+
+    # Both hashes are of the raw content, the same for a compressed copy
+    assert CRIMAC_preprocess.raw_index_hash(path + '.gz') == CRIMAC_preprocess.raw_index_hash(path)
+    assert CRIMAC_preprocess.file_content_hash(path + '.gz') == CRIMAC_preprocess.file_content_hash(path)
+
+    # The datagram index hash changes with the content, and is the same with the sidecar
+    index_hash = CRIMAC_preprocess.raw_index_hash(path)
+    assert CRIMAC_preprocess.raw_index_hash(path, str(tmp_path)) == index_hash
+    write_ek60(path, [500, 481])
+    assert CRIMAC_preprocess.raw_index_hash(path) != index_hash
+
+
+def test_compressed_raw_files(tmp_path):
+    write_ek80(str(tmp_path / "b.raw"), 2)
+    with open(str(tmp_path / "b.raw"), 'rb') as f, gzip.open(str(tmp_path / "a.raw.gz"), 'wb') as out:
+        shutil.copyfileobj(f, out)
+    (tmp_path / "c.txt").write_text("")
+    assert CRIMAC_preprocess.list_raw_files(str(tmp_path)) == ["a.raw.gz", "b.raw"]
+    assert CRIMAC_preprocess.ek_detect(str(tmp_path / "a.raw.gz")) == "EK80"
+
+
+def test_decode_raw_file():
+    entries = [{"name": "a.raw"}, {"name": "b.raw"}]
+    ds = CRIMAC_preprocess.decode_raw_file(file_table_ds(json.dumps(entries), [0, 0, 1, 1, 1]))
+    assert ds.raw_file.dims == ("ping_time",)
+    assert ds.raw_file.values.tolist() == ["a.raw", "a.raw", "b.raw", "b.raw", "b.raw"]
+
+    # Datasets with raw_file already are left as they are
+    assert CRIMAC_preprocess.decode_raw_file(ds) is ds
+
+
+def seconds(*values):
+    return np.datetime64('2020-01-01T00:00:00', 'ns') + np.array(values) * np.timedelta64(1000, 'ms')
+
+
+def test_align_index():
+    times = seconds(0, 10, 20)
+    pings = seconds(-1, 4, 6, 10, 25, 90)
+    assert CRIMAC_preprocess.align_index(times, pings, "nearest").tolist() == [0, 0, 1, 1, 2, 2]
+    assert CRIMAC_preprocess.align_index(times, pings, "previous").tolist() == [-1, 0, 0, 1, 2, 2]
+    tolerance = np.timedelta64(5, 's')
+    assert CRIMAC_preprocess.align_index(times, pings, "nearest", tolerance).tolist() == [0, 0, 1, 1, 2, -1]
+    assert CRIMAC_preprocess.align_index(times[:0], pings).tolist() == [-1] * 6
+    with pytest.raises(ValueError):
+        CRIMAC_preprocess.align_index(times, pings, "cubic")
+
+
+def test_carry_over():
+    # The last records of a file align the first pings of the next one
+    carry = CRIMAC_preprocess.CarryOver(span = np.timedelta64(30, 's'))
+    first = CRIMAC_preprocess.align_stream(seconds(0, 20, 40, 60), [1.0, 2.0, 3.0, 4.0], seconds(10, 55), "previous", carry, "heave")
+    assert first.tolist() == [1.0, 3.0]
+    second = CRIMAC_preprocess.align_stream(seconds(100), [5.0], seconds(65, 101), "previous", carry, "heave")
+    assert second.tolist() == [4.0, 5.0]
+    # Only the records within span of the end of a file are kept
+    times, values = carry.streams["heave"]
+    assert values.tolist() == [5.0]
+
+    # Without the carry-over the first ping has no record
+    assert np.isnan(CRIMAC_preprocess.align_stream(seconds(100), [5.0], seconds(65), "previous")[0])
+
+    # A tail that is not older than the next file is not prepended
+    times, values = carry.extend("heave", seconds(50, 200), np.array([6.0, 7.0]))
+    assert values.tolist() == [6.0, 7.0]
+
+
+def test_resample_cumulative():
+    rng = np.random.default_rng(0)
+    values = rng.uniform(1, 2, (3, 40))
+    r_s = np.arange(40) * 0.2 + 0.1
+    r_t = np.arange(25) * 0.3 + 0.15
+    edges_s = CRIMAC_preprocess._binEdges(r_s)
+    edges_t = CRIMAC_preprocess._binEdges(r_t)
+
+    # Same bins give the source back
+    assert np.allclose(CRIMAC_preprocess._resampleCumulative(values, edges_s, edges_s), values)
+
+    # The same linear combination as _resampleWeight inside the source
+    out = CRIMAC_preprocess._resampleCumulative(values, edges_s, edges_t)
+    W = CRIMAC_preprocess._resampleWeight(r_t, r_s)
+    expected = CRIMAC_preprocess._regrid(values.T, W, 3).T
+    inside = edges_t[1:] <= edges_s[-1]
+    assert np.allclose(out[:, inside], expected[:, inside])
+    assert np.all(np.isnan(out[:, ~inside]))
+
+    # Target bins overlapping a NaN are NaN
+    values[1, 10] = np.nan
+    out = CRIMAC_preprocess._resampleCumulative(values, edges_s, edges_t)
+    overlap = (edges_t[:-1] < edges_s[11]) & (edges_t[1:] > edges_s[10])
+    assert np.array_equal(np.isnan(out[1]), overlap | ~inside)
+
+    # A shift of one bin moves the values by one bin, the uncovered bin is NaN
+    shifted = CRIMAC_preprocess._resampleCumulative(values, edges_s, edges_s, np.full(3, 0.2))
+    assert np.allclose(shifted[0, 1:], values[0, :-1])
+    assert np.isnan(shifted[0, 0])
+
+
+def test_depth_grid_sv():
+    range_values = np.arange(20) * 0.5 + 0.25
+    sv = np.full((2, 3, 20), -70.0)
+    sv[:, :, 10] = -40.0
+    draft = np.array([[1.0, 1.0, 1.0], [0.0, 0.0, 0.0]])
+    heave = np.array([0.0, 0.5, np.nan])
+    out = CRIMAC_preprocess.depth_grid_sv(sv, range_values, draft, heave)
+
+    # The depth axis continues the range bins down by the largest draft + heave
+    depth = CRIMAC_preprocess.depth_axis(range_values, draft, heave)
+    assert np.allclose(depth, np.arange(23) * 0.5 + 0.25)
+    assert out.shape == (2, 3, 23)
+
+    # Moved down by draft + heave bins, keeping the deepest samples, with NaN above the
+    # transducer and below the shifted range
+    assert np.allclose(out[0, 0, 2:22], sv[0, 0])
+    assert np.all(np.isnan(out[0, 0, :2])) and np.isnan(out[0, 0, 22])
+    assert np.allclose(out[0, 1, 3:], sv[0, 1])
+    assert np.allclose(out[1, 2, :20], sv[1, 2])
+    assert out[1, 1, 11] == pytest.approx(-40.0)
+
+    # or on a given depth axis (that of the previous raw files)
+    out = CRIMAC_preprocess.depth_grid_sv(sv, range_values, draft, heave, range_values)
+    assert out.shape == sv.shape
+    assert np.allclose(out[0, 0, 2:], sv[0, 0, :-2])
+
+
+def test_detect_bottom():
+    range_values = np.arange(300) * 0.1 + 0.05
+    sv = np.full((4, 300), -90.0)
+    echo = {148: -60.0, 149: -35.0, 150: -25.0, 151: -15.0, 152: -10.0, 153: -20.0}
+    for i in [0, 2, 3]:
+        for j, value in echo.items():
+            sv[i, j] = value
+    # Ping 1 has no bottom, ping 3 a strong echo near the surface and missing samples
+    sv[3, 20] = 0.0
+    sv[3, 200:] = np.nan
+    start = np.array([50, 50, 200, 50])
+    stop = np.full(4, 300)
+
+    bottom = CRIMAC_preprocess.detect_bottom(sv, range_values, start, stop)
+    assert bottom.tolist() == [150, -1, -1, 150]
+
+    # The backstep goes back above the threshold while within backstep of the peak
+    bottom = CRIMAC_preprocess.detect_bottom(sv, range_values, start, stop, backstep = 30.0)
+    assert bottom.tolist() == [149, -1, -1, 149]
+
+    # Not above start
+    assert CRIMAC_preprocess.detect_bottom(sv, range_values, np.full(4, 151), stop)[0] == 151
+
+
+def ping_store(path, n):
+    group = zarr.open_group(str(path), mode = 'w')
+    sv = group.create_dataset("sv", data = np.arange(2 * n * 3, dtype = 'f4').reshape(2, n, 3), chunks = (1, 4, 3))
+    sv.attrs["_ARRAY_DIMENSIONS"] = ["frequency", "ping_time", "range"]
+    heave = group.create_dataset("heave", data = np.arange(n, dtype = 'f8'), chunks = (4,))
+    heave.attrs["_ARRAY_DIMENSIONS"] = ["ping_time"]
+    frequency = group.create_dataset("frequency", data = np.array([38000.0, 200000.0]))
+    frequency.attrs["_ARRAY_DIMENSIONS"] = ["frequency"]
+    return group
+
+
+@pytest.mark.parametrize("shift", [5, 2, -1, -3])
+def test_shift_pings(tmp_path, shift):
+    n = 10
+    group = ping_store(tmp_path / "out.zarr", n)
+    sv = group["sv"][:]
+    CRIMAC_preprocess.shift_pings(group, 6, shift)
+
+    # The pings before start are kept, the pings from start on are moved
+    assert group["sv"].shape == (2, n + shift, 3)
+    assert np.array_equal(group["sv"][:, :6 + min(shift, 0)], sv[:, :6 + min(shift, 0)])
+    assert np.array_equal(group["sv"][:, 6 + shift:], sv[:, 6:])
+    assert np.array_equal(group["heave"][6 + shift:], np.arange(6, n))
+    assert np.array_equal(group["frequency"][:], [38000.0, 200000.0])
+
+
+def echolab_channel(n_ping = 30, step = 0.2, n_range = 200, frequency = 38000.0):
+    # A channel whose power and sv follow pyEcholab's EK60 convention: the TVG range
+    # corrected by two samples, and an effective pulse duration shorter than the nominal one
+    rng = np.random.default_rng(1)
+    range_values = np.arange(n_range) * step
+    cal = types.SimpleNamespace(gain = 25.0, sa_correction = -0.6, equivalent_beam_angle = -20.7, absorption_coefficient = 0.01,
+                                sound_velocity = 1490.0, transmit_power = np.where(np.arange(n_ping) % 7 == 0, 1000.0, 2000.0), pulse_length = 0.001)
+    power = rng.uniform(-120, -60, (n_ping, n_range))
+    constant = CRIMAC_preprocess.calibration_constant(cal.gain, cal.sa_correction, cal.equivalent_beam_angle, cal.transmit_power,
+                                                      0.7 * cal.pulse_length, cal.sound_velocity, frequency)
+    sv = power + CRIMAC_preprocess.power_tvg(range_values, 2 * step, 0.01)[None, :] - constant[:, None]
+    sample = lambda data, r: types.SimpleNamespace(data = data, range = r, frequency = frequency, ping_time = np.arange(n_ping))
+    raw_data = types.SimpleNamespace(get_calibration = lambda: cal, get_power = lambda calibration = None: sample(power, range_values))
+    return raw_data, sample(sv, range_values)
+
+
+def power_dataset(power, params, range_values, frequency = 38000.0):
+    ds = xr.Dataset({name: (["frequency", "ping_time"], np.asarray(params[name])[None, :]) for name in CRIMAC_preprocess.power_variables},
+                    coords = dict(frequency = [frequency], range = range_values))
+    ds["power"] = (["frequency", "ping_time", "range"], power[None])
+    return ds
+
+
+def test_sv_from_power():
+    raw_data, sv_obj = echolab_channel()
+    power, params = CRIMAC_preprocess.process_power(raw_data, sv_obj.range, sv_obj, sv_obj.data)
+    assert np.allclose(params["range_offset"], 0.4)
+    assert np.allclose(params["sv_offset"], -10 * np.log10(0.7))
+
+    # The sv it replaces in the zarr output, at every sample
+    ds = power_dataset(power, params, sv_obj.range)
+    assert np.allclose(CRIMAC_preprocess.sv_from_power(ds).values[0], sv_obj.data, atol = 1e-9)
+
+    # And it moves with the calibration parameters
+    ds["gain"] = ds.gain + 0.5
+    ds["absorption_coefficient"] = ds.absorption_coefficient + 0.02
+    expected = sv_obj.data - 1.0 + 2 * 0.02 * np.maximum(sv_obj.range - 0.4, 0)[None, :]
+    assert np.allclose(CRIMAC_preprocess.sv_from_power(ds).values[0], expected, atol = 1e-9)
+
+
+def test_sv_from_power_regridded():
+    # A channel regridded onto the reference range gives its regridded sv
+    raw_data, sv_obj = echolab_channel(step = 0.15)
+    reference_range = np.arange(150) * 0.2 + 0.1
+    sv_data = CRIMAC_preprocess.regrid_sv(sv_obj, reference_range)
+    power, params = CRIMAC_preprocess.process_power(raw_data, reference_range, sv_obj, sv_data)
+    assert np.allclose(params["range_offset"], 0.3)
+    ds = power_dataset(power, params, reference_range)
+    assert np.allclose(CRIMAC_preprocess.sv_from_power(ds).values[0], sv_data, atol = 1e-9, equal_nan = True)
+
+
+def test_cache_carry_over(tmp_path):
+    raw_fname = str(tmp_path / "a.raw")
+    with open(raw_fname, "wb") as f:
+        f.write(b"raw")
+    carry = CRIMAC_preprocess.CarryOver()
+    key = CRIMAC_preprocess.cache_key(raw_fname, 38000, carry = carry)
+
+    # The records carried over to the next raw file are cached with the dataset
+    carry.extend("heave", seconds(0, 10), np.array([1.0, 2.0]))
+    ds = file_table_ds([], [0, 0])
+    CRIMAC_preprocess.cache_store(str(tmp_path), key, ds, carry = carry)
+    restored = CRIMAC_preprocess.CarryOver()
+    cached = CRIMAC_preprocess.cache_load(str(tmp_path), key, restored)
+    assert "carry_over" not in cached.attrs
+    assert restored.get_state() == carry.get_state()
+    assert restored.streams["heave"][0].dtype == np.dtype('datetime64[ns]')
+
+    # and the key depends on the records carried over from the previous raw file
+    assert CRIMAC_preprocess.cache_key(raw_fname, 38000, carry = restored) != key
+    assert CRIMAC_preprocess.cache_key(raw_fname, 38000, carry = CRIMAC_preprocess.CarryOver()) == key
+
+
+def test_run_plugins_failure(tmp_path):
+    def plugin(ds, context):
+        ds["extra"] = ds.sv * 2
+        if context.state.setdefault("runs", 0) > 0:
+            ds["partial"] = ds.sv
+            raise RuntimeError("failed")
+        context.state["runs"] += 1
+        return ds
+
+    CRIMAC_preprocess.register_plugin("test_failing", plugin)
+    contexts = {"test_failing": CRIMAC_preprocess.PluginContext(str(tmp_path / "out"), 38000)}
+    ds = xr.Dataset(dict(sv = (["ping_time"], np.arange(3.0))), coords = dict(ping_time = seconds(0, 1, 2)))
+    out, timing = CRIMAC_preprocess.run_plugins(ds, ["test_failing"], contexts)
+    assert set(out.data_vars) == {"sv", "extra"} and set(ds.data_vars) == {"sv"}
+
+    # A failure keeps the variables of the previous raw files (filled with NaN) and drops
+    # those the plugin added before raising
+    out, timing = CRIMAC_preprocess.run_plugins(ds, ["test_failing"], contexts)
+    assert set(out.data_vars) == {"sv", "extra"}
+    assert np.isnan(out.extra.values).all()
+    assert set(ds.data_vars) == {"sv"}
+
+
+def test_sink_write_failure(tmp_path, capsys):
+    class Sink(CRIMAC_preprocess.OutputSink):
+        extension = ".out"
+
+        def write(self, ds, fn):
+            if fn == "b.raw":
+                raise ValueError("disk full")
+            self.written = self.write_first_loop
+
+    sink = Sink(str(tmp_path / "out"))
+    sink.start()
+    for fn in ["b.raw", "c.raw"]:
+        sink.submit(None, fn)
+    sink.close()
+    out = capsys.readouterr().out
+    assert "Wrote b.raw" not in out and "Wrote c.raw" in out
+    assert "Unable to write data from b.raw" in out and "disk full" in out
+    # the first raw file written still starts the output
+    assert sink.failed == ["b.raw"] and sink.written
+
+
+def survey_dataset(n_ping = 60, n_range = 30, step = 0.013, seed = 0):
+    # Two channels of sv on a straight line, the log repeating its reading at ping n_ping // 2
+    rng = np.random.default_rng(seed)
+    distance = 3.0 + np.append(np.arange(n_ping // 2), np.arange(n_ping // 2 - 1, n_ping - 1)) * step
+    sv = -70 + 5 * rng.standard_normal((2, n_ping, n_range))
+    return xr.Dataset(
+        dict(sv = (["frequency", "ping_time", "range"], sv),
+             transducer_draft = (["frequency", "ping_time"], np.full((2, n_ping), 5.0)),
+             distance = (["ping_time"], distance)),
+        coords = dict(frequency = [38000.0, 120000.0], ping_time = seconds(*np.arange(n_ping)),
+                      range = np.arange(n_range) * 0.5 + 0.25))
+
+
+def split_restarting(ds):
+    # The dataset as two raw files, the log restarting from 0 in the second
+    n = len(ds.ping_time) // 2
+    first = ds.isel(ping_time = slice(0, n))
+    second = ds.isel(ping_time = slice(n, None)).copy()
+    second["distance"] = second.distance - second.distance[0]
+    return first, second
+
+
+def write_sink(sink_class, path, parts, **attrs):
+    sink = sink_class(str(path))
+    for name, value in attrs.items():
+        setattr(sink, name, value)
+    for i, part in enumerate(parts):
+        sink.write(part, "part%d.raw" % i)
+    return zarr.open_group(sink.target_fname, mode = 'r')
+
+
+def test_continue_distance():
+    distance, offset = CRIMAC_preprocess.continue_distance(np.array([1.0, 2.0, 0.5, 1.0]))
+    assert np.allclose(distance, [1.0, 2.0, 2.0, 2.5]) and offset == pytest.approx(1.5)
+    # A restart in the next raw file, and the offset of the previous ones
+    distance, offset = CRIMAC_preprocess.continue_distance(np.array([0.0, 0.25]), 2.5, 1.5)
+    assert np.allclose(distance, [2.5, 2.75]) and offset == pytest.approx(2.5)
+
+
+def test_nasc_sink_split(tmp_path):
+    ds = survey_dataset()
+    whole = write_sink(CRIMAC_preprocess.NASCSink, tmp_path / "whole", [ds], distance_step = 0.1, depth_step = 5.0)
+    split = write_sink(CRIMAC_preprocess.NASCSink, tmp_path / "split", split_restarting(ds), distance_step = 0.1, depth_step = 5.0)
+    assert np.array_equal(whole["distance"][:], split["distance"][:])
+    assert np.array_equal(whole["ping_count"][:], split["ping_count"][:])
+    assert np.allclose(whole["sa_sum"][:], split["sa_sum"][:])
+    assert whole["ping_count"][:].sum() == 2 * len(ds.ping_time)
+
+
+@pytest.mark.parametrize("axis, step", [("ping_time", 7.0), ("distance", 0.05)])
+def test_regular_sink_split(tmp_path, axis, step):
+    ds = survey_dataset()
+    whole = write_sink(CRIMAC_preprocess.RegularSink, tmp_path / "whole", [ds], axis = axis, step = step)
+    split = write_sink(CRIMAC_preprocess.RegularSink, tmp_path / "split", split_restarting(ds), axis = axis, step = step)
+    assert np.array_equal(whole[axis][:], split[axis][:])
+    assert np.allclose(whole["sv"][:], split["sv"][:], equal_nan = True)
+    assert np.isfinite(split["sv"][:]).all()
+
+    # A raw file going back (dropped in time, continued after the others in distance) does not
+    # overwrite the bins of the previous raw files
+    sv = split["sv"][:]
+    write_sink(CRIMAC_preprocess.RegularSink, tmp_path / "split", [ds.isel(ping_time = slice(0, 20))], axis = axis, step = step)
+    again = zarr.open_group(str(tmp_path / "split") + "_regular.zarr", mode = 'r')["sv"][:]
+    assert again.shape[1] == sv.shape[1] if axis == "ping_time" else again.shape[1] > sv.shape[1]
+    assert np.array_equal(again[:, :sv.shape[1] - 1], sv[:, :-1], equal_nan = True)
+
+
+def annotated_store(path, heave):
+    # A zarr output of 10 pings with one annotation partition
+    n_ping = 10
+    ds = xr.Dataset(
+        dict(sv = (["frequency", "ping_time", "range"], np.full((1, n_ping, 20), -70.0)),
+             transducer_draft = (["frequency", "ping_time"], np.full((1, n_ping), 5.0)),
+             heave = (["ping_time"], np.full(n_ping, heave))),
+        coords = dict(frequency = [38000.0], ping_time = seconds(*np.arange(n_ping)), range = np.arange(20) + 0.5))
+    ds.chunk({"ping_time": 5}).to_zarr(str(path) + ".zarr")
+    rows = dict(ping_time = seconds(2, 2), mask_depth_upper = [8.0, 10.0], mask_depth_lower = [16.0, 12.0],
+                priority = [2, 1], acoustic_category = ["layer", "school"], proportion = [0.5, 1.0],
+                object_id = ["a", "b"], channel_id = ["c", "c"], work_file = ["w", "w"])
+    table = pa.table(rows, schema = CRIMAC_preprocess.annotation_schema)
+    CRIMAC_preprocess.write_annotation_partition(str(path) + "_work.parquet", "2020-01-01", table)
+
+
+def test_rasterize_annotations(tmp_path):
+    out_fname = str(tmp_path / "out")
+    annotated_store(out_fname, heave = 1.0)
+    CRIMAC_preprocess.rasterize_annotations(out_fname, proportion = False)
+    group = zarr.open_group(out_fname + ".zarr")
+    categories = group["annotation"].attrs["categories"]
+    labels = group["annotation"][2, :]
+
+    # Depths less draft and heave, and the lowest priority value wins where the masks overlap
+    painted = [categories[code - 1] if code > 0 else None for code in labels]
+    assert painted[:2] == [None, None] and painted[2:4] == ["layer", "layer"]
+    assert painted[4:6] == ["school", "school"] and painted[6:10] == ["layer"] * 4 and painted[10] is None
+    assert "annotation_proportion" not in group
+
+    # Asking for the proportion on a store rasterized without it writes it
+    CRIMAC_preprocess.rasterize_annotations(out_fname, proportion = True)
+    group = zarr.open_group(out_fname + ".zarr")
+    assert np.allclose(group["annotation_proportion"][2, 2:10], [0.5, 0.5, 1.0, 1.0, 0.5, 0.5, 0.5, 0.5])
+
+
+def raw_file_dataset(name, n_ping = 20, n_range = 40):
+    # A processed raw file (as process_raw_file returns it) of two channels, one ping a second
+    # from the start time in its name (..-DYYYYMMDD-THHMMSS.raw)
+    start = np.datetime64(datetime.datetime.strptime("".join(name.split(".")[0].split("-")[-2:]), "D%Y%m%dT%H%M%S"), "ns")
+    rng = np.random.default_rng(int(start.astype('int64') // 10 ** 9) % 1000)
+    sv = -80 + 10 * rng.standard_normal((2, n_ping, n_range))
+    ds = xr.Dataset(
+        dict(sv = (["frequency", "ping_time", "range"], sv),
+             transducer_draft = (["frequency", "ping_time"], np.full((2, n_ping), 5.0)),
+             heave = (["ping_time"], rng.standard_normal(n_ping) * 0.2),
+             pitch = (["ping_time"], np.zeros(n_ping)),
+             roll = (["ping_time"], np.zeros(n_ping)),
+             heading = (["ping_time"], np.full(n_ping, 90.0)),
+             speed = (["ping_time"], np.full(n_ping, 10.0)),
+             distance = (["ping_time"], np.arange(n_ping) * 0.003)),
+        coords = dict(frequency = [38000.0, 200000.0], ping_time = start + np.arange(n_ping) * np.timedelta64(1, 's'),
+                      range = np.arange(n_range) * 0.5 + 0.25))
+    ds.coords["channel_id"] = ("frequency", ["WBT 1", "WBT 2"])
+    ds.coords["latitude"] = ("ping_time", 60 + np.arange(n_ping) * 1e-4)
+    ds.coords["longitude"] = ("ping_time", 5 + np.arange(n_ping) * 1e-4)
+    ds.coords["file_index"] = ("ping_time", np.zeros(n_ping, dtype='int32'))
+    ds.attrs["file_table"] = json.dumps([{"name": name, "hash": "h" + name, "ping_start": 0, "ping_stop": n_ping}])
+    return ds
+
+
+@pytest.fixture
+def cruise(tmp_path, monkeypatch):
+    # A directory of raw files named by their start time, processed into raw_file_dataset
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    calls = []
+
+    def process_raw_file(raw_fname, main_frequency, reference_range = None, *args, **kwargs):
+        calls.append(os.path.basename(raw_fname))
+        return raw_file_dataset(os.path.basename(raw_fname))
+
+    def add(minute):
+        (raw_dir / ("2020102-D20200302-T03%02d00.raw" % minute)).write_bytes(b"raw %d" % minute)
+
+    monkeypatch.setattr(CRIMAC_preprocess, "process_raw_file", process_raw_file)
+    monkeypatch.setattr(CRIMAC_preprocess, "get_pyecholab_rev", lambda: "test")
+    return types.SimpleNamespace(dir = str(raw_dir), work_dir = str(tmp_path / "work"), out = str(tmp_path / "out"), add = add, calls = calls)
+
+
+def test_cache(cruise, tmp_path):
+    for minute in range(3):
+        cruise.add(minute)
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    options = dict(write_output = True, out_fname = cruise.out, overwrite = True, cache_dir = cache_dir)
+    CRIMAC_preprocess.raw_to_grid_multiple(cruise.dir, cruise.work_dir, **options)
+    with xr.open_zarr(cruise.out + ".zarr") as ds:
+        first = ds.load()
+    assert len(cruise.calls) == 3 and len(os.listdir(cache_dir)) == 3
+
+    # A second run reads the cache and writes the same output
+    CRIMAC_preprocess.raw_to_grid_multiple(cruise.dir, cruise.work_dir, **options)
+    with xr.open_zarr(cruise.out + ".zarr") as ds:
+        xr.testing.assert_identical(ds.load().drop_attrs(), first.drop_attrs())
+    assert len(cruise.calls) == 3
+
+    # The key follows the raw content and the options
+    raw_fname = cruise.dir + "/" + cruise.calls[0]
+    key = CRIMAC_preprocess.cache_key(raw_fname, 38000)
+    assert CRIMAC_preprocess.cache_key(raw_fname, 38000) == key
+    for changed in [dict(main_frequency = 200000), dict(raw_view = "CW"), dict(depth_grid = True), dict(store_power = True)]:
+        assert CRIMAC_preprocess.cache_key(raw_fname, **dict(dict(main_frequency = 38000), **changed)) != key
+    with open(raw_fname, "ab") as f:
+        f.write(b"more")
+    assert CRIMAC_preprocess.cache_key(raw_fname, 38000) != key
+
+    # and the least recently used datasets are evicted
+    entries = sorted(os.listdir(cache_dir))
+    os.utime(cache_dir + "/" + entries[0], (0, 0))
+    CRIMAC_preprocess.cache_evict(cache_dir, CRIMAC_preprocess._dir_size(cache_dir) - CRIMAC_preprocess._dir_size(cache_dir + "/" + entries[0]))
+    assert sorted(os.listdir(cache_dir)) == entries[1:]
+
+
+def test_multiple_outputs(cruise):
+    for minute in range(2):
+        cruise.add(minute)
+    options = dict(write_output = True, out_fname = cruise.out, output_type = "zarr,netcdf4", resume = True)
+    CRIMAC_preprocess.raw_to_grid_multiple(cruise.dir, cruise.work_dir, **options)
+
+    # Resuming processes the new raw files once for both outputs
+    cruise.add(2)
+    CRIMAC_preprocess.raw_to_grid_multiple(cruise.dir, cruise.work_dir, **options)
+    assert cruise.calls == ["2020102-D20200302-T030%d00.raw" % minute for minute in range(3)]
+    expected = xr.concat([raw_file_dataset(name) for name in cruise.calls], dim = "ping_time")
+    with xr.open_zarr(cruise.out + ".zarr") as zarr_ds, xr.open_dataset(cruise.out + ".nc") as netcdf_ds:
+        for ds in [zarr_ds, netcdf_ds]:
+            assert np.array_equal(ds.ping_time.values, expected.ping_time.values)
+            assert np.allclose(ds.sv.values, expected.sv.values)
+            assert [entry["name"] for entry in CRIMAC_preprocess.get_file_table(ds)] == cruise.calls
+
+
+def test_ping_table(cruise):
+    for minute in range(3):
+        cruise.add(minute)
+    CRIMAC_preprocess.raw_to_grid_multiple(cruise.dir, cruise.work_dir, write_output = True, out_fname = cruise.out, output_type = "ping_table")
+    pings = CRIMAC_preprocess.read_ping_table(cruise.out)
+    assert pings.num_rows == 60 and sorted(set(pings.column("raw_file").to_pylist())) == cruise.calls
+    draft = CRIMAC_preprocess.read_ping_table(cruise.out, table_name = "draft")
+    assert draft.num_rows == 120 and np.all(draft.column("transducer_draft").to_numpy() == 5.0)
+
+    # Time, bounding box and polygon queries
+    ping_time = pings.column("ping_time").to_numpy()
+    selected = CRIMAC_preprocess.read_ping_table(cruise.out, start_time = ping_time[25], end_time = ping_time[34])
+    assert selected.num_rows == 10
+    bbox = (5.0, 60.0, 5.00045, 60.00045)
+    assert CRIMAC_preprocess.read_ping_table(cruise.out, bbox = bbox).num_rows == 3 * 5
+    triangle = [(4.9999, 59.9999), (5.0022, 59.9999), (4.9999, 60.0022)]
+    inside = CRIMAC_preprocess.read_ping_table(cruise.out, polygon = triangle, columns = ["longitude", "latitude"])
+    assert inside.num_rows == 3 * 11
+
+
+def test_update_chunk_index():
+    index = {"chunk_size": 4, "time_min": [], "time_max": [], "lat_min": [], "lat_max": [],
+             "lon_min": [], "lon_max": [], "range_max": []}
+    ping_time = np.datetime64("2020-01-01", "ns") + np.arange(10) * np.timedelta64(1, 's')
+    latitude = 60 + np.arange(10.0)
+    longitude = 5 + np.arange(10.0)
+    longitude[9] = np.nan
+    extent = np.vstack([np.full(10, 20.0), np.full(10, 10.0)])
+    extent[1, 4:] = np.nan
+
+    # Appending in two parts (the second starting inside chunk 1) gives the index of all the pings
+    CRIMAC_preprocess.update_chunk_index(index, 0, ping_time[:6], latitude[:6], longitude[:6], extent[:, :6])
+    CRIMAC_preprocess.update_chunk_index(index, 6, ping_time[6:], latitude[6:], longitude[6:], extent[:, 6:])
+    times = ping_time.astype('int64')
+    assert index["time_min"] == [times[0], times[4], times[8]]
+    assert index["time_max"] == [times[3], times[7], times[9]]
+    assert np.array_equal(CRIMAC_preprocess._json_array(index["lat_max"]), [63, 67, 69])
+    assert np.array_equal(CRIMAC_preprocess._json_array(index["lon_max"]), [8, 12, 13])
+    range_max = np.array([CRIMAC_preprocess._json_array(x) for x in index["range_max"]])
+    assert np.array_equal(range_max, [[20, 10], [20, np.nan], [20, np.nan]], equal_nan = True)
+    json.dumps(index)
+
+
+def test_select(cruise):
+    for minute in range(3):
+        cruise.add(minute)
+    CRIMAC_preprocess.raw_to_grid_multiple(cruise.dir, cruise.work_dir, write_output = True, out_fname = cruise.out)
+    store = cruise.out + ".zarr"
+    index = zarr.open_group(store, mode = 'r').attrs["chunk_index"]
+    assert index == CRIMAC_preprocess.build_chunk_index(store)
+
+    with xr.open_zarr(store) as ds:
+        full = ds.load()
+    start, stop = full.ping_time.values[[5, 44]]
+    bbox = (5.00045, 60.0, 5.00155, 60.01)
+    subset = CRIMAC_preprocess.select(store, time = (start, stop), bbox = bbox, frequency = 38000.0, depth = (1.0, 5.0))
+    expected = full.isel(ping_time = slice(5, 45)).sel(frequency = [38000.0], range = slice(1.0, 5.0))
+    expected = expected.isel(ping_time = np.flatnonzero((expected.longitude.values >= bbox[0]) & (expected.longitude.values <= bbox[2])))
+    assert subset.sizes == {"frequency": 1, "ping_time": 2 * 11, "range": 8}
+    xr.testing.assert_identical(subset.load().drop_attrs(), expected.drop_attrs())
+
+    # Only the chunks the index keeps are read (one chunk of 20 pings per raw file here)
+    group = zarr.open_group(store)
+    group.attrs["chunk_index"] = CRIMAC_preprocess.update_chunk_index(
+        dict(index, chunk_size = 20, time_min = [], time_max = [], lat_min = [], lat_max = [], lon_min = [], lon_max = [], range_max = []),
+        0, full.ping_time.values, full.latitude.values, full.longitude.values, np.full((2, 60), 19.75))
+    zarr.consolidate_metadata(store)
+    subset = CRIMAC_preprocess.select(store, time = full.ping_time.values[[25, 50]])
+    assert np.array_equal(subset.ping_time.values, full.ping_time.values[25:51])
+    assert CRIMAC_preprocess.select(store, depth = (20.0, 30.0)).sizes["ping_time"] == 0
+
+
+@pytest.fixture
+def work_files(tmp_path, monkeypatch):
+    # .work/.idx pairs of raw files, a .work file holding one "<ping time> <category>" line per
+    # annotation, parsed by a stand-in for the annotationtools readers (in threads, the stand-in
+    # is not seen by spawned processes)
+    raw_dir = tmp_path / "raw"
+    work_dir = tmp_path / "work"
+    raw_dir.mkdir()
+    work_dir.mkdir()
+
+    def work_to_annotation(work, idx_fname):
+        if work == "unreadable":
+            raise ValueError(work)
+        rows = [line.split() for line in work.splitlines()]
+        df = pd.DataFrame(dict(ping_time = pd.to_datetime([row[0] for row in rows]), mask_depth_upper = 1.0, mask_depth_lower = 2.0,
+                               priority = 1, acoustic_category = [row[1] for row in rows], proportion = 1.0, object_id = "o", channel_id = "c"))
+        return types.SimpleNamespace(df_ = df)
+
+    def write(name, *lines):
+        (raw_dir / (name + ".raw")).write_bytes(b"raw")
+        (raw_dir / (name + ".idx")).write_bytes(b"idx")
+        (work_dir / (name + ".work")).write_text("\n".join(lines))
+
+    monkeypatch.setattr(CRIMAC_preprocess, "readers", types.SimpleNamespace(work_reader = lambda fname: open(fname).read(), work_to_annotation = work_to_annotation))
+    monkeypatch.setattr(CRIMAC_preprocess, "ProcessPoolExecutor", lambda max_workers, mp_context: ThreadPoolExecutor(max_workers))
+
+    def run():
+        raw_fname = sorted(fn for fn in os.listdir(raw_dir) if fn.endswith(".raw"))
+        return CRIMAC_preprocess.process_annotations(str(raw_dir), str(work_dir), raw_fname, str(tmp_path / "out"))
+
+    return types.SimpleNamespace(write = write, run = run, work_dir = work_dir, out = str(tmp_path / "out"))
+
+
+def partition_rows(pq_dir):
+    # Rows of each day partition, as (work file, ping time, category) sorted
+    rows = {}
+    for part in sorted(os.listdir(pq_dir)):
+        if part.startswith("date="):
+            table = pq.read_table(pq_dir + "/" + part + "/part-0.parquet", schema = CRIMAC_preprocess.annotation_schema)
+            rows[part[5:]] = sorted(zip(table.column("work_file").to_pylist(), table.column("ping_time").to_numpy().astype(str), table.column("acoustic_category").to_pylist()))
+    return rows
+
+
+def test_process_annotations(work_files, capsys):
+    work_files.write("a", "2020-01-01T23:00:00 school", "2020-01-02T01:00:00 layer")
+    work_files.write("b", "2020-01-02T02:00:00 school", "2020-01-02T02:00:01 school")
+    work_files.write("c", "unreadable")
+    pq_dir = work_files.run()
+    assert "Something went wrong when reading the WORK file" in capsys.readouterr().out
+    assert partition_rows(pq_dir) == {
+        "2020-01-01": [("a.work", "2020-01-01T23:00:00.000000000", "school")],
+        "2020-01-02": [("a.work", "2020-01-02T01:00:00.000000000", "layer"),
+                       ("b.work", "2020-01-02T02:00:00.000000000", "school"), ("b.work", "2020-01-02T02:00:01.000000000", "school")]}
+
+    # Queries prune on the day partitions
+    table = CRIMAC_preprocess.read_annotations(work_files.out, start_time = "2020-01-02T00:00", acoustic_category = "school")
+    assert sorted(table.column("work_file").to_pylist()) == ["b.work", "b.work"]
+    table = CRIMAC_preprocess.read_annotations(work_files.out, end_time = "2020-01-02T01:30", columns = ["ping_time"])
+    assert table.num_rows == 2 and table.column_names == ["ping_time"]
+
+
+def test_process_annotations_incremental(work_files, capsys):
+    work_files.write("a", "2020-01-01T23:00:00 school")
+    work_files.write("b", "2020-01-02T02:00:00 school")
+    work_files.write("c", "2020-01-03T02:00:00 layer")
+    pq_dir = work_files.run()
+    with open(pq_dir + "/_manifest.json") as f:
+        manifest = json.load(f)
+    assert manifest["b.work"]["days"] == ["2020-01-02"]
+    capsys.readouterr()
+    work_files.run()
+    assert "Annotations are up to date" in capsys.readouterr().out
+
+    # A changed work file is parsed again, its old and new days are rewritten and the others left alone
+    os.utime(pq_dir + "/date=2020-01-01/part-0.parquet", (0, 0))
+    work_files.write("b", "2020-01-03T05:00:00 school", "2020-01-04T05:00:00 layer")
+    work_files.run()
+    assert "Processing 1 new or changed work files, removing 0" in capsys.readouterr().out
+    assert os.path.getmtime(pq_dir + "/date=2020-01-01/part-0.parquet") == 0
+    assert partition_rows(pq_dir) == {
+        "2020-01-01": [("a.work", "2020-01-01T23:00:00.000000000", "school")],
+        "2020-01-03": [("b.work", "2020-01-03T05:00:00.000000000", "school"), ("c.work", "2020-01-03T02:00:00.000000000", "layer")],
+        "2020-01-04": [("b.work", "2020-01-04T05:00:00.000000000", "layer")]}
+    with open(pq_dir + "/_manifest.json") as f:
+        updated = json.load(f)
+    assert updated["b.work"]["days"] == ["2020-01-03", "2020-01-04"] and updated["b.work"]["hash"] != manifest["b.work"]["hash"]
+    assert updated["a.work"] == manifest["a.work"]
+
+    # A removed work file drops its annotations and manifest entry
+    os.remove(work_files.work_dir / "c.work")
+    work_files.run()
+    assert [row[0] for row in partition_rows(pq_dir)["2020-01-03"]] == ["b.work"]
+    with open(pq_dir + "/_manifest.json") as f:
+        assert sorted(json.load(f)) == ["a.work", "b.work"]
+
+    # Without a manifest the dataset is rebuilt from scratch
+    os.remove(pq_dir + "/_manifest.json")
+    work_files.run()
+    assert sorted(partition_rows(pq_dir)) == ["2020-01-01", "2020-01-03", "2020-01-04"]
+    assert os.path.getmtime(pq_dir + "/date=2020-01-01/part-0.parquet") != 0
+
+
+def test_export_patches(tmp_path):
+    out_fname = str(tmp_path / "out")
+    annotated_store(out_fname, heave = 1.0)
+    CRIMAC_preprocess.rasterize_annotations(out_fname, proportion = False)
+    layer = zarr.open_group(out_fname + ".zarr")["annotation"].attrs["categories"].index("layer") + 1
+
+    # One shard per chunk of 5 pings, of the 4 patches of 5 x 5 in it
+    export_dir = CRIMAC_preprocess.export_patches(out_fname, patch_size = (5, 5))
+    with open(export_dir + "/manifest.json") as f:
+        manifest = json.load(f)
+    assert manifest["patch_size"] == [1, 5, 5] and manifest["frequency"] == [38000.0] and manifest["n_patches"] == 8
+    assert [(shard["name"], shard["ping_start"], shard["ping_stop"]) for shard in manifest["shards"]] == [("shard-00000.tar", 0, 5), ("shard-00001.tar", 5, 10)]
+    assert manifest["shards"][0]["categories"] == {"0": 2, str(layer): 2} and manifest["shards"][1]["categories"] == {"0": 4}
+
+    with tarfile.open(export_dir + "/shard-00000.tar") as tar:
+        names = tar.getnames()
+        assert names[:3] == ["000000000_00000.sv.npy", "000000000_00000.annotation.npy", "000000000_00000.json"]
+        assert len(names) == 4 * 3
+        meta = json.load(tar.extractfile("000000000_00005.json"))
+        sv = np.load(io.BytesIO(tar.extractfile("000000000_00005.sv.npy").read()))
+        labels = np.load(io.BytesIO(tar.extractfile("000000000_00005.annotation.npy").read()))
+    assert meta == {"ping_start": 0, "range_start": 5, "ping_time": str(seconds(0)[0]), "category": layer}
+    assert sv.shape == (1, 5, 5) and np.all(sv == -70.0)
+    assert np.array_equal(labels, zarr.open_group(out_fname + ".zarr")["annotation"][0:5, 5:10])
+
+    # Sampling at most one patch of each category per chunk
+    export_dir = CRIMAC_preprocess.export_patches(out_fname, patch_size = (5, 5), max_per_category = 1)
+    with open(export_dir + "/manifest.json") as f:
+        manifest = json.load(f)
+    assert [shard["categories"] for shard in manifest["shards"]] == [{"0": 1, str(layer): 1}, {"0": 1}]
+    assert CRIMAC_preprocess.export_patches(out_fname, patch_size = (6, 5)) is None
+
+
+def test_coarsen_sv():
+    sv = np.array([[[-60.0, -70.0, -80.0], [-60.0, np.nan, -80.0], [-50.0, -50.0, np.nan]]])
+    coarse = CRIMAC_preprocess.coarsen_sv(sv, 2)
+    # Means in the linear domain, over the samples each (partial) block has
+    linear = 10 ** (sv[0] / 10)
+    expected = [[np.nanmean(linear[:2, :2]), np.nanmean(linear[:2, 2])], [np.nanmean(linear[2, :2]), np.nan]]
+    assert coarse.shape == (1, 2, 2) and coarse.dtype == np.float32
+    assert np.allclose(coarse[0], 10 * np.log10(expected), equal_nan = True)
+
+
+def test_pyramid(cruise):
+    # The levels are appended raw file by raw file (20 pings, not a multiple of the factors)
+    for minute in range(3):
+        cruise.add(minute)
+    CRIMAC_preprocess.raw_to_grid_multiple(cruise.dir, cruise.work_dir, write_output = True, out_fname = cruise.out)
+    store = cruise.out + ".zarr"
+    with xr.open_zarr(store) as ds:
+        full = ds.load()
+    group = zarr.open_group(store)
+    assert group["pyramid"].attrs["n_pings"] == 60
+    for f in CRIMAC_preprocess.pyramid_factors:
+        with xr.open_zarr(store, group = "pyramid/" + str(f)) as level:
+            assert np.allclose(level.sv.values, CRIMAC_preprocess.coarsen_sv(full.sv.values, f), equal_nan = True)
+            assert np.array_equal(level.ping_time.values, full.ping_time.values[::f])
+            assert np.array_equal(level.range.values, full.range.values[::f])
+
+    # The coarsest level with enough pings and samples is opened, else the full resolution
+    assert CRIMAC_preprocess.open_overview(store, time_res = 7, range_res = 5).sizes == {"frequency": 2, "ping_time": 8, "range": 5}
+    assert CRIMAC_preprocess.open_overview(store, time_res = 61, range_res = 5).sizes["ping_time"] == 60
+
+    # Levels out of step with the store are rebuilt
+    before = group["pyramid/8/sv"][:]
+    group["pyramid"].attrs["n_pings"] = 100
+    CRIMAC_preprocess.update_pyramid(store)
+    assert group["pyramid"].attrs["n_pings"] == 60 and np.array_equal(group["pyramid/8/sv"][:], before, equal_nan = True)
+
+
+@pytest.mark.parametrize("reduce", ["mean", "max"])
+def test_render_echogram(reduce):
+    rng = np.random.default_rng(0)
+    sv = -70 + 10 * rng.standard_normal((2, 30, 12))
+    sv[0, 3:9, :] = np.nan
+    sv[1, :, 4] = np.nan
+    ds = xr.Dataset(dict(sv = (["frequency", "ping_time", "range"], sv)))
+
+    # Each pixel reduces the samples of its columns and rows in the linear domain
+    columns = (np.arange(30) * 4) // 30
+    rows = (np.arange(12) * 3) // 12
+    expected = np.full((2, 3, 4), np.nan)
+    for i in range(2):
+        for r in range(3):
+            for c in range(4):
+                linear = 10 ** (sv[i][np.ix_(columns == c, rows == r)] / 10)
+                if np.any(~np.isnan(linear)):
+                    expected[i, r, c] = 10 * np.log10(np.nanmax(linear) if reduce == "max" else np.nanmean(linear))
+
+    # The same raster whatever the ping chunks (here splitting pixel columns)
+    for chunked in [ds, ds.chunk({"ping_time": 7})]:
+        raster, vmin, vmax = CRIMAC_preprocess.render_echogram(chunked, width = 4, height = 3, reduce = reduce)
+        assert np.allclose(raster, expected, equal_nan = True)
+        assert (vmin, vmax) == (np.nanmin(sv), np.nanmax(sv))
+    assert CRIMAC_preprocess.render_echogram(ds, width = 100, height = 100)[0].shape == (2, 12, 30)